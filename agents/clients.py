@@ -0,0 +1,76 @@
+import os
+import threading
+import api.util as util
+
+# API clients shared by every agent in a process. They are built on first use rather than at import
+# time, so importing an agent module doesn't need credentials or the (slow to import) openai and
+# langchain packages, and process pool workers only pay for the clients they actually use.
+# Requests go through agents.gateway, which does the rate limiting and retrying, so the clients don't retry.
+#
+# LLM_BASE_URL points both clients at another server speaking the same API, such as the stub server in
+# agents/stub_llm.py. No credentials are needed then unless they are given.
+
+CREDENTIALS_PATH = "credentials.json"
+
+# Connections kept open per client, enough for the gateway's default max_concurrency.
+MAX_CONNECTIONS = 64
+
+# Sampling parameters of azure_chat, which also go into the keys of its cached responses.
+AZURE_CHAT_PARAMS = {"temperature": 0.2, "max_tokens": 1024}
+
+_clients = {}
+_lock = threading.Lock()
+
+def base_url():
+    """The server set by LLM_BASE_URL (e.g. http://127.0.0.1:8000), or None for the providers' own."""
+    url = os.environ.get("LLM_BASE_URL")
+    return url.rstrip("/") if url else None
+
+def _shared(name, factory):
+    # Keyed by pid as well, so a worker forked after the parent built a client makes its own
+    # instead of reusing the parent's connection pool.
+    key = (name, os.getpid())
+    if key not in _clients:
+        with _lock:
+            if key not in _clients:
+                _clients[key] = factory()
+    return _clients[key]
+
+def openai_client():
+    """The process's openai.Client, using the key in credentials.json, or else OPENAI_API_KEY."""
+    def factory():
+        import httpx
+        import openai
+        if os.path.exists(CREDENTIALS_PATH):
+            api_key = util.load_json(CREDENTIALS_PATH)["openai_api_key"]
+        elif os.environ.get("OPENAI_API_KEY"):
+            # The RAP reasoners' models used to read their key from here.
+            api_key = os.environ["OPENAI_API_KEY"]
+        elif base_url() is not None:
+            api_key = "stub"
+        else:
+            raise ValueError(f"No OpenAI API key, add it to {CREDENTIALS_PATH} or set OPENAI_API_KEY")
+        return openai.Client(
+            api_key=api_key,
+            base_url=f"{base_url()}/v1" if base_url() is not None else None,
+            max_retries=0,
+            http_client=openai.DefaultHttpxClient(limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)),
+        )
+    return _shared("openai", factory)
+
+def azure_chat():
+    """The process's LangChain AzureChatOpenAI, configured from the AZURE_OPENAI_* environment variables."""
+    def factory():
+        from langchain_openai import AzureChatOpenAI
+        endpoint = {}
+        if base_url() is not None:
+            endpoint = {"azure_endpoint": base_url(), "api_key": os.environ.get("AZURE_OPENAI_API_KEY", "stub")}
+        return AzureChatOpenAI(
+            azure_deployment='gpt-35-turbo',
+            openai_api_version='2024-10-21',
+            request_timeout=60,
+            max_retries=0,
+            **AZURE_CHAT_PARAMS,
+            **endpoint,
+        )
+    return _shared("azure_chat", factory)
@@ -0,0 +1,243 @@
+import asyncio
+import email.utils
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Callable, Optional
+import fire
+import api.tracing as tracing
+import api.metrics as metrics
+from agents.clients import _shared
+
+# Every LLM request goes through the process's Gateway, which
+#   - waits for a share of the deployment's requests-per-minute and tokens-per-minute budget, kept in
+#     token buckets in a SQLite file so that all worker processes draw from the same budget,
+#   - keeps at most max_concurrency requests per deployment in flight in this process,
+#   - retries rate-limited, overloaded and failed requests with jittered exponential backoff, waiting
+#     at least as long as the Retry-After (or x-ratelimit-reset-*) headers ask, and tells the other
+#     processes to hold off as well.
+# The clients in agents/clients.py pool their connections and leave retrying to the gateway.
+#
+# Limits are per deployment (the model or Azure deployment name), from the LLM_GATEWAY_LIMITS
+# environment variable, a JSON object such as
+#   {"default": {"requests_per_minute": 500}, "gpt-4-1106-preview": {"tokens_per_minute": 300000}}
+
+DEFAULT_LIMITER_PATH = "llm_gateway.db"
+
+@dataclass
+class Limits:
+    requests_per_minute : float = 500
+    tokens_per_minute : float = 150_000
+    max_concurrency : int = 32 # requests in flight per process (and as many again per event loop)
+    max_attempts : int = 8
+    max_backoff : float = 60.0 # seconds, for retries without a header saying how long to wait
+
+def limits(deployment : str) -> Limits:
+    configured = json.loads(os.environ.get("LLM_GATEWAY_LIMITS", "{}"))
+    return Limits(**{**configured.get("default", {}), **configured.get(deployment, {})})
+
+def estimate_tokens(messages : list, max_tokens : int = 256) -> int:
+    """Rough token count of a request, to reserve before it is sent: about 4 characters per token of
+    the prompt, plus the completion's limit. It is corrected once the response reports its usage."""
+    return len(json.dumps(messages, default=str)) // 4 + max_tokens
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY, -- deployment:requests or deployment:tokens
+    level REAL NOT NULL, -- negative while requests are waiting for their reservation
+    updated_at REAL NOT NULL,
+    blocked_until REAL NOT NULL DEFAULT 0 -- set when the API says to back off
+);
+"""
+
+class RateLimiter:
+    """Token buckets shared by every process that opens the same path. A bucket refills at its rate
+    up to one minute's worth, and reserve takes from it right away, so its level goes negative while
+    reservations are queued and each caller waits until its own reservation is covered."""
+
+    def __init__(self, path : str = DEFAULT_LIMITER_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def _update(self, changes : dict, per_minute : dict, block : float = 0.0) -> float:
+        # Applies changes to the named buckets in one transaction and returns how long to wait.
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                wait = 0.0
+                for name, amount in changes.items():
+                    rate = per_minute[name] / 60
+                    row = self.connection.execute("SELECT level, updated_at, blocked_until FROM buckets WHERE name = ?", (name,)).fetchone()
+                    level, updated_at, blocked_until = row if row is not None else (per_minute[name], now, 0.0)
+                    level = min(per_minute[name], level + (now - updated_at) * rate) - amount
+                    blocked_until = max(blocked_until, now + block)
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO buckets (name, level, updated_at, blocked_until) VALUES (?, ?, ?, ?)",
+                        (name, level, now, blocked_until),
+                    )
+                    wait = max(wait, -level / rate if level < 0 else 0.0, blocked_until - now)
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return wait
+
+    @staticmethod
+    def _buckets(deployment : str, limits : Limits) -> dict:
+        return {f"{deployment}:requests": limits.requests_per_minute, f"{deployment}:tokens": limits.tokens_per_minute}
+
+    def reserve(self, deployment : str, limits : Limits, tokens : int) -> float:
+        """Reserves one request and tokens tokens, and returns the seconds to wait before sending it."""
+        per_minute = self._buckets(deployment, limits)
+        requests, tokens_name = per_minute
+        return self._update({requests: 1, tokens_name: tokens}, per_minute)
+
+    def refund(self, deployment : str, limits : Limits, tokens : float):
+        """Gives back tokens that were reserved but not used (negative to charge more)."""
+        per_minute = self._buckets(deployment, limits)
+        self._update({f"{deployment}:tokens": -tokens}, per_minute)
+
+    def block(self, deployment : str, limits : Limits, seconds : float):
+        """Makes every process wait seconds before its next request to deployment."""
+        per_minute = self._buckets(deployment, limits)
+        self._update({name: 0 for name in per_minute}, per_minute, block=seconds)
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def retry_after(headers) -> Optional[float]:
+    """Seconds the API asked to wait, from Retry-After (seconds or an HTTP date), retry-after-ms, or
+    OpenAI's x-ratelimit-reset-requests/-tokens ("1s", "6m0s", "20ms"). None if there is no such header."""
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    if headers.get("retry-after"):
+        value = headers["retry-after"]
+        try:
+            return float(value)
+        except ValueError:
+            date = email.utils.parsedate_to_datetime(value)
+            return max(0.0, date.timestamp() - time.time())
+    resets = [
+        sum(float(amount) * _UNITS[unit] for amount, unit in _DURATION.findall(headers[name]))
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if headers.get(name)
+    ]
+    return max(resets) if resets else None
+
+def _retryable(error : Exception) -> bool:
+    import openai
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and (error.status_code in (408, 409, 429) or error.status_code >= 500)
+
+class Gateway:
+    def __init__(self, limiter_path : str = DEFAULT_LIMITER_PATH):
+        self.limiter = RateLimiter(limiter_path)
+        self.semaphores = {}
+        self.lock = threading.Lock()
+        # Not the random module, which belongs to the game.
+        self.rng = random.Random()
+
+    def _semaphore(self, deployment : str, limits : Limits):
+        with self.lock:
+            if deployment not in self.semaphores:
+                self.semaphores[deployment] = threading.BoundedSemaphore(limits.max_concurrency)
+            return self.semaphores[deployment]
+
+    def _backoff(self, deployment : str, limits : Limits, error : Exception, attempt : int) -> float:
+        # Full jitter, so that processes that were throttled together don't retry together.
+        delay = self.rng.uniform(0, min(limits.max_backoff, 2 ** attempt))
+        asked = retry_after(getattr(getattr(error, "response", None), "headers", None))
+        if asked is not None:
+            delay = asked + self.rng.uniform(0, 1)
+            self.limiter.block(deployment, limits, asked)
+        tracing.current_span().add("request_retries")
+        metrics.count("request_retries")
+        tracing.current_span().add("backoff_seconds", delay)
+        return delay
+
+    def _waited(self, wait : float) -> float:
+        if wait > 0:
+            tracing.current_span().add("throttled_seconds", wait)
+        return wait
+
+    def request(self, deployment : str, send : Callable, tokens : int = 0, used_tokens : Optional[Callable] = None):
+        """Calls send() once the deployment's limits allow it, retrying on transient errors. tokens
+        is the estimated size of the request (see estimate_tokens); used_tokens(response), if given,
+        gives the actual size so that the budget can be corrected."""
+        limits_ = limits(deployment)
+        with self._semaphore(deployment, limits_):
+            for attempt in range(limits_.max_attempts):
+                time.sleep(self._waited(self.limiter.reserve(deployment, limits_, tokens)))
+                try:
+                    response = send()
+                except Exception as error:
+                    # The failed request's tokens weren't used, whether or not it is retried.
+                    self.limiter.refund(deployment, limits_, tokens)
+                    if not _retryable(error) or attempt == limits_.max_attempts - 1:
+                        raise
+                    time.sleep(self._backoff(deployment, limits_, error, attempt))
+                    continue
+                if used_tokens is not None:
+                    self.limiter.refund(deployment, limits_, tokens - used_tokens(response))
+                metrics.note_attempt(attempt)
+                return response
+
+    def _async_semaphore(self, deployment : str, limits : Limits) -> asyncio.Semaphore:
+        # One per event loop, since an asyncio.Semaphore belongs to the loop it is first used on.
+        key = (deployment, asyncio.get_running_loop())
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = asyncio.Semaphore(limits.max_concurrency)
+            return self.semaphores[key]
+
+    async def arequest(self, deployment : str, send : Callable, tokens : int = 0, used_tokens : Optional[Callable] = None):
+        """request for coroutines: send() returns an awaitable. Waiting for a slot or for the budget
+        doesn't block the event loop, and the limiter's SQLite calls, which may wait on another
+        process's lock, run in a thread."""
+        limits_ = limits(deployment)
+        async with self._async_semaphore(deployment, limits_):
+            for attempt in range(limits_.max_attempts):
+                await asyncio.sleep(self._waited(await asyncio.to_thread(self.limiter.reserve, deployment, limits_, tokens)))
+                try:
+                    response = await send()
+                except Exception as error:
+                    await asyncio.to_thread(self.limiter.refund, deployment, limits_, tokens)
+                    if not _retryable(error) or attempt == limits_.max_attempts - 1:
+                        raise
+                    await asyncio.sleep(await asyncio.to_thread(self._backoff, deployment, limits_, error, attempt))
+                    continue
+                if used_tokens is not None:
+                    await asyncio.to_thread(self.limiter.refund, deployment, limits_, tokens - used_tokens(response))
+                metrics.note_attempt(attempt)
+                return response
+
+def gateway() -> Gateway:
+    """The process's Gateway."""
+    return _shared("gateway", lambda: Gateway(os.environ.get("LLM_GATEWAY_PATH", DEFAULT_LIMITER_PATH)))
+
+def _status(path = DEFAULT_LIMITER_PATH):
+    """Prints the level of every bucket, as of its last update."""
+    connection = sqlite3.connect(path)
+    now = time.time()
+    for name, level, updated_at, blocked_until in connection.execute("SELECT * FROM buckets ORDER BY name"):
+        blocked = f", blocked for {blocked_until - now:.1f}s" if blocked_until > now else ""
+        print(f"{name:<40} {level:>12.1f} ({now - updated_at:.0f}s ago{blocked})")
+
+def _limits(deployment):
+    """Prints the limits that apply to deployment."""
+    print(asdict(limits(deployment)))
+
+if __name__ == "__main__":
+    fire.Fire({"status": _status, "limits": _limits})
@@ -1,16 +1,20 @@
 from collections import defaultdict
 from dataclasses import dataclass, field
-from api.classes import Agent, AvailableActions, Action, Observation, Rules
+from api.classes import Agent, AvailableActions, Action, Observation, Rules, GameResult
+from typing import Optional
 import random
-import openai
 import api.util as util
+import api.tracing as tracing
+import api.metrics as metrics
+import time
+from agents.clients import openai_client, azure_chat, AZURE_CHAT_PARAMS
+from agents.llm_cache import lookup, store
+from agents.gateway import gateway, estimate_tokens
 import ast
 import json
-from PIL import Image
 import base64
 from io import BytesIO
 import re
-from langchain_openai import AzureChatOpenAI
 
 
 action_format_instructions_no_openended = """\
@@ -29,24 +33,17 @@ Return actions in json with the following keys.
 Include the openended response only if you have chosen an openended action.
 """
 
-openai_client = openai.Client(
-    api_key=util.load_json("credentials.json")["openai_api_key"]
-)
-
 model='gpt-35-turbo'
 
-chat = AzureChatOpenAI(
-    azure_deployment='gpt-35-turbo',
-    openai_api_version='2024-10-21',
-    temperature=0.2,
-    max_tokens=1024,
-    request_timeout=60
-)
+def chat_messages(messages):
+    """messages as LangChain message objects, which its chat models take instead of dicts.
+    Imported here rather than at the top for the same reason as agents.clients."""
+    from langchain_core.messages import convert_to_messages
+    return convert_to_messages(messages)
 
 tokens = defaultdict(int)
 def completions(*args, **kwargs):
-    generations = chat.generate()
-    ret = openai_client.chat.completions.create(*args, **kwargs)
+    ret = openai_client().chat.completions.create(*args, **kwargs)
 
     model = kwargs["model"]
     tokens[f"{model}_input"] += ret.usage.prompt_tokens
@@ -62,11 +59,95 @@ class OpenAITextAgent(Agent):
     max_retries: int = 3
     transparent_reasoning: bool = False
     mode: int = 0  # 0 = normal, 1 = chain of thought, 2 = babble and prune
+    # Start every request of a game with the same messages (see game_prefix), so the provider's
+    # prompt caching can reuse them. Off by default to keep the published agents' prompts.
+    stable_prefix: bool = False
+    # Overrides LLM_CACHE_MAX_TEMPERATURE for this agent's requests, which are sampled at temperature
+    # 0.2 and so bypass agents.llm_cache by default. E.g. 0.2 reuses a response for a repeated prompt.
+    cache_max_temperature: Optional[float] = None
+    # (rules, prompt, details_dict) of the current game, see rules_prompt.
+    _rules_prompt: Optional[tuple] = field(default=None, init=False, repr=False)
 
     def print(self, *args, **kwargs):
         if self.transparent_reasoning:
             print(self.agent_type_id, *args, **kwargs)
 
+    def generate(self, messages) -> str:
+        key, content = lookup(model, messages, AZURE_CHAT_PARAMS, max_temperature=self.cache_max_temperature)
+        if content is not None:
+            tracing.current_span().add("cached_requests")
+            return content
+        parent = tracing.current_span()
+        start = time.perf_counter()
+        with tracing.span("llm_request", model=model) as request_span:
+            generations = gateway().request(model, lambda: azure_chat().generate([chat_messages(messages)]), *self.request_size(messages))
+        content = self.record_generations(generations, request_span, parent, time.perf_counter() - start)
+        store(key, model, content)
+        return content
+
+    async def agenerate(self, messages) -> str:
+        key, content = lookup(model, messages, AZURE_CHAT_PARAMS, max_temperature=self.cache_max_temperature)
+        if content is not None:
+            tracing.current_span().add("cached_requests")
+            return content
+        parent = tracing.current_span()
+        start = time.perf_counter()
+        with tracing.span("llm_request", model=model) as request_span:
+            generations = await gateway().arequest(model, lambda: azure_chat().agenerate([chat_messages(messages)]), *self.request_size(messages))
+        content = self.record_generations(generations, request_span, parent, time.perf_counter() - start)
+        store(key, model, content)
+        return content
+
+    def request_size(self, messages):
+        # The estimated tokens of a request and how to read the actual ones from its response, for the gateway.
+        return estimate_tokens(messages, AZURE_CHAT_PARAMS["max_tokens"]), lambda generations: generations.llm_output['token_usage']['total_tokens']
+
+    def record_generations(self, generations, request_span = tracing.NOOP_SPAN, parent = tracing.NOOP_SPAN, seconds = 0.0) -> str:
+        usage = generations.llm_output['token_usage']
+        # The part of the prompt the provider served from its prefix cache.
+        cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+        tokens[f"{model}_input"] += usage['prompt_tokens']
+        tokens[f"{model}_cached_input"] += cached
+        tokens[f"{model}_output"] += usage['completion_tokens']
+        request_span.set(prompt_tokens=usage['prompt_tokens'], cached_prompt_tokens=cached, completion_tokens=usage['completion_tokens'])
+        # Totals over all of a decision's requests end up on the take_action span.
+        parent.add("llm_requests")
+        parent.add("prompt_tokens", usage['prompt_tokens'])
+        parent.add("cached_prompt_tokens", cached)
+        parent.add("completion_tokens", usage['completion_tokens'])
+        # Requests go to the Azure deployment whatever the agent's openai_model, so that is the model
+        # recorded; the metrics are per agent anyway.
+        metrics.record_call(model, usage['prompt_tokens'], usage['completion_tokens'], cached, seconds)
+        return generations.generations[0][0].message.content
+
+    def rules_prompt(self, rules: Rules) -> tuple[str, dict]:
+        """The start of every prompt, which only depends on the rules, and the headings of the
+        additional details that the model can expand."""
+        prompt = f"You are playing a game called {rules.title}. The rules are as follows:\n{rules.summary}\n"
+        details_dict = {}
+        if rules.additional_details != None:
+            prompt += "The following are headings with additional information about the rules that you can expand by taking the action Explain(<heading key>).\n"
+            details_dict = {
+                f"H{i+1}": topic for i, topic in enumerate(rules.additional_details)
+            }
+            prompt += json.dumps(details_dict, indent=4)
+        return prompt, details_dict
+
+    def game_prefix(self, rules_prompt: str) -> list[dict]:
+        """With stable_prefix, the messages that every request of a game starts with: the system
+        message, the rules and the response format, identical byte for byte from turn to turn.
+        Everything that changes (observation, actions, retries) comes after them."""
+        return [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": rules_prompt + "\n# Response format\n" + action_format_instructions_with_openended},
+        ]
+
+    def on_game_start(self, rules: Rules, seat: int):
+        self._rules_prompt = (rules, *self.rules_prompt(rules))
+
+    def on_game_end(self, result: Optional[GameResult]):
+        self._rules_prompt = None
+
     def take_action(
         self,
         rules: Rules,
@@ -74,16 +155,50 @@ class OpenAITextAgent(Agent):
         available_actions: AvailableActions,
         show_state: bool,
     ):
+        with tracing.span("take_action", agent_type_id=self.agent_type_id, model=self.openai_model, mode=self.mode):
+            conversation = self.conversation(rules, observation, available_actions)
+            try:
+                messages = next(conversation)
+                while True:
+                    messages = conversation.send(self.generate(messages))
+            except StopIteration as stop:
+                return stop.value
+
+    async def take_action_async(
+        self,
+        rules: Rules,
+        observation: Observation,
+        available_actions: AvailableActions,
+        show_state: bool,
+    ):
+        with tracing.span("take_action", agent_type_id=self.agent_type_id, model=self.openai_model, mode=self.mode):
+            conversation = self.conversation(rules, observation, available_actions)
+            try:
+                messages = next(conversation)
+                while True:
+                    messages = conversation.send(await self.agenerate(messages))
+            except StopIteration as stop:
+                return stop.value
+
+    def conversation(
+        self,
+        rules: Rules,
+        observation: Observation,
+        available_actions: AvailableActions,
+    ):
+        """Generator holding the prompting logic. Yields the messages to send to the model, receives the
+        model's response and returns the chosen Action, so the same logic drives both the synchronous
+        and the asynchronous take_action."""
         messages = [{"role": "system", "content": self.system_message}]
         valid_actions = []
-        prompt = f"You are playing a game called {rules.title}. The rules are as follows:\n{rules.summary}\n"
-        if rules.additional_details != None:
-            prompt += "The following are headings with additional information about the rules that you can expand by taking the action Explain(<heading key>).\n"
-            details_dict = {
-                f"H{i+1}": topic for i, topic in enumerate(rules.additional_details)
-            }
-            prompt += json.dumps(details_dict, indent=4)
-            #valid_actions.extend(f"Explain({h})" for h in list(details_dict.keys()))
+        # Agents used outside of play_match don't get on_game_start.
+        if self._rules_prompt is None or self._rules_prompt[0] is not rules:
+            self._rules_prompt = (rules, *self.rules_prompt(rules))
+        _, prompt, details_dict = self._rules_prompt
+        if self.stable_prefix:
+            messages = self.game_prefix(prompt)
+            prompt = ""
+        #valid_actions.extend(f"Explain({h})" for h in list(details_dict.keys()))
 
         prompt += f"\n# Observation\nThe following describes the current state of the game:\n{observation.text}\n"
         # if observation.image is not None:
@@ -138,11 +253,12 @@ class OpenAITextAgent(Agent):
         prompt += f"\n# Actions\n"
         prompt += f"{available_actions.instructions}\n"
         if len(list(available_actions.openended.keys())) > 0:
-            prompt += action_format_instructions_with_openended
+            if not self.stable_prefix:
+                prompt += action_format_instructions_with_openended
             prompt += "The following are openended actions you can take\n"
             prompt += str(list(available_actions.openended.keys())) + "\n"
             valid_actions += list(available_actions.openended)
-        else:
+        elif not self.stable_prefix:
             prompt += action_format_instructions_no_openended
 
         if len(list(available_actions.predefined.keys())) > 0:
@@ -165,10 +281,7 @@ class OpenAITextAgent(Agent):
             prompt += "First, let's reason out loud about which action you should take to maximize your probability of winning."
             messages.append({"role": "user", "content": prompt})
 
-            generations = chat.generate([messages])
-            responses = [
-                chat_gen.message.content for chat_gen in generations.generations[0]]
-            response = responses[0]
+            response = yield messages
 
             # print(f"\nGENERATIONS!!!\n: {generations}\n")
 
@@ -186,10 +299,6 @@ class OpenAITextAgent(Agent):
             print(f"\n\n {self.agent_type_id} PROMPT:\n", prompt)
             print(f"\n\n {self.agent_type_id}'s RESPONSE:\n", response)
 
-            tokens[f"{model}_input"] += generations.llm_output['token_usage']['prompt_tokens']
-            tokens[f"{model}_output"] += generations.llm_output['token_usage']['completion_tokens']
-            # print("*******************", tokens)
-
             messages.append({"role": "assistant", "content": response})
             prompt = ""
 
@@ -202,10 +311,7 @@ class OpenAITextAgent(Agent):
 
             messages.append({"role": "user", "content": prompt})
 
-            generations = chat.generate([messages])
-            responses = [
-                chat_gen.message.content for chat_gen in generations.generations[0]]
-            response = responses[0]
+            response = yield messages
 
             # response = (
             #     completions(
@@ -220,10 +326,6 @@ class OpenAITextAgent(Agent):
 
             print(f"\n\n {self.agent_type_id} PROMPT:\n", prompt)
             print(f"\n\n {self.agent_type_id}'s RESPONSE:\n", response)
-
-            tokens[f"{model}_input"] += generations.llm_output['token_usage']['prompt_tokens']
-            tokens[f"{model}_output"] += generations.llm_output['token_usage']['completion_tokens']
-            # print("*******************", tokens)
             
             messages.append({"role": "assistant", "content": response})
             prompt = ""
@@ -237,14 +339,9 @@ class OpenAITextAgent(Agent):
         messages.append({"role": "user", "content": prompt})
 
         result = None
-        for _ in range(self.max_retries):
-            generations = chat.generate([messages])
-
-            # print("GENERATIONS!!!:\n", generations)
-
-            responses = [
-                chat_gen.message.content for chat_gen in generations.generations[0]]
-            response = responses[0]
+        for attempt in range(self.max_retries):
+            tracing.current_span().set(retries=attempt)
+            response = yield messages
 
             # response = (
             #     completions(
@@ -260,10 +357,6 @@ class OpenAITextAgent(Agent):
 
             print(f"\n\n {self.agent_type_id} PROMPT:\n", prompt)
             print(f"\n\n {self.agent_type_id}'s RESPONSE:\n", response)
-
-            tokens[f"{model}_input"] += generations.llm_output['token_usage']['prompt_tokens']
-            tokens[f"{model}_output"] += generations.llm_output['token_usage']['completion_tokens']
-            # print("*******************", tokens)
             
             messages.append({"role": "assistant", "content": response})
             # print("GPT responded with", response)
@@ -273,6 +366,7 @@ class OpenAITextAgent(Agent):
                 action["action"]
             except:
                 print(f"\n\n{self.agent_type_id} returned invalid JSON")
+                metrics.count("json_failures")
                 continue
 
             if (
@@ -280,6 +374,7 @@ class OpenAITextAgent(Agent):
                 and "openended_response" not in action
             ):
                 print(f"\n\n{self.agent_type_id} chose openended action but didn't include response", action)
+                metrics.count("invalid_actions")
                 error_message = "You chose an openended action, and so your json must have an 'openended_response' key."
                 messages.append({"role": "user", "content": error_message})
                 continue
@@ -288,6 +383,7 @@ class OpenAITextAgent(Agent):
                 explain = re.findall(r"Explain\((H\d+)\)", action["action"])
                 if len(explain):
                     print(f"\n\n{self.agent_type_id} is asking for rules explanation.")
+                    metrics.count("explain_lookups")
                     rule = details_dict[explain[0]]
                     desc = rules.additional_details[rule]
                     messages.append({"role": "user", "content": desc})
@@ -296,11 +392,13 @@ class OpenAITextAgent(Agent):
                 explain = re.findall(r"Explain\((.+)\)", action["action"])
                 if len(explain):
                     print(f"\n\n{self.agent_type_id} is asking for action explanation.")
+                    metrics.count("explain_lookups")
                     desc = available_actions.predefined.get(explain[0], "") + available_actions.openended.get(explain[0], "")
                     messages.append({"role": "user", "content": desc})
                     continue
             except:
                 print(f"\n\n{self.agent_type_id} tried asking for an expalanation but failed.")
+                metrics.count("invalid_actions")
                 error_message = "This is an invalid Explain action."
                 messages.append({"role": "user", "content": error_message})
                 continue
@@ -311,6 +409,7 @@ class OpenAITextAgent(Agent):
                 break
 
             print(f"\n\n{self.agent_type_id} returned invalid action", action)
+            metrics.count("invalid_actions")
             error_message = f"{action['action']} is not one of the valid actions. "
             error_message += "As a reminder, the valid actions are as follows:\n"
             error_message += f"{str(list(valid_actions))}\n"
@@ -320,6 +419,8 @@ class OpenAITextAgent(Agent):
             print(
                 f"\n\nWARNING: {self.agent_type_id} returned too many invalid actions after {self.max_retries} tries"
             )
+            tracing.current_span().set(gave_up=True)
+            metrics.count("fallbacks")
             return Action(action_id=None)
 
         return Action(
@@ -0,0 +1,179 @@
+import fire
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+from agents.clients import _shared
+import api.metrics as metrics
+
+# Responses to LLM requests, kept on disk so that reruns, replays and other processes don't pay for a
+# request that has been made before. Entries are keyed by a hash of the model, the messages and the
+# sampling parameters. By default only requests whose response doesn't depend on sampling (temperature
+# 0, or log probabilities) are cached; LLM_CACHE_MAX_TEMPERATURE raises that limit, e.g. to rerun a
+# tournament with the responses it got the first time.
+#
+# Configured from the environment:
+#   LLM_CACHE=0                    disables the cache
+#   LLM_CACHE_PATH                 defaults to llm_cache.db
+#   LLM_CACHE_MAX_ENTRIES          least recently used entries beyond this are evicted (default 100000)
+#   LLM_CACHE_MAX_TEMPERATURE      requests with a higher temperature bypass the cache (default 0)
+#
+# OpenAITextAgent samples at temperature 0.2 (AZURE_CHAT_PARAMS), so by default none of its requests
+# are cached. Raise LLM_CACHE_MAX_TEMPERATURE, or set the agent's cache_max_temperature, to cache them.
+#
+# lookup counts every request in the current match's metrics (see api.metrics), as cached_responses,
+# cache_misses or cache_bypassed, and LLMCache.stats() has the same counts for the process.
+
+DEFAULT_CACHE_PATH = "llm_cache.db"
+
+# Requests that don't set a temperature get the API's default.
+DEFAULT_TEMPERATURE = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY, -- request_key of the request
+    model TEXT NOT NULL,
+    response TEXT NOT NULL, -- JSON, in whatever form the caller stored it
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS responses_by_last_used ON responses (last_used);
+"""
+
+class LLMCache:
+    """SQLite-backed LRU cache of LLM responses.
+
+    Like MatchStore, each process opens its own (llm_cache() does so), and SQLite makes the reads and
+    writes of many processes safe. Within a process the connection is shared by the threads of
+    concurrent games under a lock."""
+
+    def __init__(self, path : str = DEFAULT_CACHE_PATH, max_entries : int = 100_000, max_temperature : float = 0.0, evict_every : int = 100):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_temperature = max_temperature
+        self.evict_every = evict_every
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.puts = 0
+        # This process's counters.
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    @classmethod
+    def from_environment(cls) -> Optional["LLMCache"]:
+        if os.environ.get("LLM_CACHE", "1") == "0":
+            return None
+        return cls(
+            os.environ.get("LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+            int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 100_000)),
+            float(os.environ.get("LLM_CACHE_MAX_TEMPERATURE", 0.0)),
+        )
+
+    def request_key(self, model : str, messages : list, params : dict = {}, deterministic : bool = False, max_temperature : Optional[float] = None) -> Optional[str]:
+        """The key of a request, or None if its response shouldn't be cached. deterministic marks
+        requests whose response doesn't depend on the temperature, such as log probabilities.
+        max_temperature overrides the cache's for this request."""
+        temperature = params.get("temperature", DEFAULT_TEMPERATURE)
+        if not deterministic and temperature > (self.max_temperature if max_temperature is None else max_temperature):
+            with self.lock:
+                self.bypassed += 1
+            return None
+        # Sorted keys and no whitespace, so equal requests hash the same however they were built.
+        canonical = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key : Optional[str]):
+        """The response stored for key, or None."""
+        if key is None:
+            return None
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        return json.loads(row["response"])
+
+    def put(self, key : Optional[str], model : str, response):
+        """Stores a JSON-serializable response under key, evicting the least recently used entries
+        once there are more than max_entries."""
+        if key is None:
+            return
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, model, json.dumps(response), now, now),
+            )
+            self.puts += 1
+            # Counting the entries on every put would cost more than the put itself.
+            if self.puts % self.evict_every == 0:
+                self._evict()
+
+    def _evict(self):
+        excess = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+
+    def stats(self) -> dict:
+        row = self.connection.execute("SELECT COUNT(*) AS entries, COALESCE(SUM(hits), 0) AS hits FROM responses").fetchone()
+        return {
+            "path": self.path,
+            "entries": row["entries"],
+            "stored_hits": row["hits"], # over the life of the cache, across processes
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+        }
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM responses")
+
+def llm_cache() -> Optional[LLMCache]:
+    """The process's LLMCache, or None if it is disabled."""
+    return _shared("llm_cache", LLMCache.from_environment)
+
+def lookup(model : str, messages : list, params : dict = {}, deterministic : bool = False, max_temperature : Optional[float] = None):
+    """(key, cached response or None) for a request, through the process's cache. Once the response
+    is in, it should be passed to store with the key."""
+    cache = llm_cache()
+    if cache is None:
+        return None, None
+    key = cache.request_key(model, messages, params, deterministic, max_temperature)
+    response = cache.get(key)
+    metrics.count("cached_responses" if response is not None else "cache_misses" if key is not None else "cache_bypassed")
+    return key, response
+
+def store(key : Optional[str], model : str, response):
+    if key is not None:
+        llm_cache().put(key, model, response)
+
+def _stats(path = DEFAULT_CACHE_PATH):
+    """Prints the number of cached responses and how often they were reused, per model."""
+    cache = LLMCache(path)
+    stats = cache.stats()
+    print(f"{stats['entries']} responses, reused {stats['stored_hits']} times ({cache.path})")
+    query = "SELECT model, COUNT(*) AS entries, SUM(hits) AS hits FROM responses GROUP BY model ORDER BY entries DESC"
+    for row in cache.connection.execute(query):
+        print(f"    {row['model']:<28} {row['entries']:>8} responses {row['hits']:>8} hits")
+
+def _clear(path = DEFAULT_CACHE_PATH):
+    LLMCache(path).clear()
+
+if __name__ == "__main__":
+    fire.Fire({"stats": _stats, "clear": _clear})
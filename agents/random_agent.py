@@ -5,7 +5,8 @@ import random
 @dataclass
 class RandomAgent(Agent):
     agent_type_id : str = "random"
+    rng : random.Random = field(default_factory=random.Random, repr=False) # kept separate from the game's random stream
 
     def take_action(self, rules : Rules, observation: Observation, available_actions: AvailableActions, show_state : bool):
         actions = list(available_actions.predefined.keys()) + list(available_actions.openended.keys())
-        return Action(action_id=random.choice(actions), openended_response="")
\ No newline at end of file
+        return Action(action_id=self.rng.choice(actions), openended_response="")
\ No newline at end of file
@@ -1,6 +1,10 @@
 from dataclasses import dataclass, field
-from api.classes import Action, Agent, AvailableActions, Observation, Rules
+from api.classes import Action, Agent, AvailableActions, GameResult, Observation, Rules
+from typing import Optional
 import re
+import threading
+import api.tracing as tracing
+import api.metrics as metrics
 from .reasoners.base import Reasoner, SearchConfig, WorldModel
 from .reasoners.algorithm import MCTS
 from .chat import *
@@ -9,6 +13,29 @@ from .func import *
 from .definitions import *
 
 
+class TracedMCTS(MCTS):
+    """MCTS with a span around each search and each of its iterations."""
+
+    def search(self):
+        self._iteration = 0
+        with tracing.span("mcts.search", n_iters=self.n_iters, depth_limit=self.depth_limit):
+            super().search()
+
+    def iterate(self, node):
+        with tracing.span("mcts.iterate", iteration=self._iteration) as iteration_span:
+            self._iteration += 1
+            path = super().iterate(node)
+            iteration_span.set(path_length=len(path), terminal=path[-1].is_terminal)
+            return path
+
+
+# The search caches in func.py are shared by every RAP agent in the process, so they are only cleared
+# once no game that uses them is in progress.
+_games_in_progress = 0
+_games_lock = threading.Lock()
+_search_caches = (step, win_probability, is_terminal, get_actions, others_actions, calculate_reward, intuitions, self_eval)
+
+
 @dataclass
 class ReasoningViaPlanning(Agent, WorldModel, SearchConfig):
     """Inherents Agent from api.classes, and WorldModel and SearchConfig
@@ -22,12 +49,31 @@ class ReasoningViaPlanning(Agent, WorldModel, SearchConfig):
     completions: CompletionsFunction = None
     probabilities: ProbabilitiesFunction = None
     _init_state: GameState = None
+    _rules_context: tuple = None  # (rules, context builder) of the current game
+
 
     def __post_init__(self):
         """MCTS only needs to be instantiated once."""
-        mcts = MCTS(depth_limit=DEPTH_LIMIT)
+        mcts = TracedMCTS(depth_limit=DEPTH_LIMIT)
         self.reasoner = Reasoner(world_model=self, search_config=self, search_algo=mcts)
 
+    def on_game_start(self, rules: Rules, seat: int):
+        """Loads the prompt templates and fills in the rules once per game rather than every turn."""
+        global _games_in_progress
+        self._rules_context = (rules, context_builder_factory(rules))
+        with _games_lock:
+            _games_in_progress += 1
+
+    def on_game_end(self, result: Optional[GameResult]):
+        """Releases the game's search caches, whose entries are keyed by that game's states."""
+        global _games_in_progress
+        self._rules_context = None
+        with _games_lock:
+            _games_in_progress -= 1
+            if _games_in_progress == 0:
+                for function in _search_caches:
+                    function.cache_clear()
+
     def log(self, s):
         """print() to console only with transparent reasoning."""
         if self.transparent_reasoning:
@@ -40,7 +86,19 @@ class ReasoningViaPlanning(Agent, WorldModel, SearchConfig):
         available_actions: AvailableActions,
         show_state: bool,
     ) -> Action:
-        self.context_builder = context_builder_factory(rules)
+        with tracing.span("take_action", agent_type_id=self.agent_type_id, api=["random", "human", "openai"][self.agent_type]):
+            return self._take_action(rules, observation, available_actions)
+
+    def _take_action(
+        self,
+        rules: Rules,
+        observation: Observation,
+        available_actions: AvailableActions,
+    ) -> Action:
+        if self._rules_context is not None and self._rules_context[0] is rules:
+            self.context_builder = self._rules_context[1]
+        else:
+            self.context_builder = context_builder_factory(rules)
         self._completions, self._probabilities = [
             random_api(),
             human_api(),
@@ -98,6 +156,7 @@ class ReasoningViaPlanning(Agent, WorldModel, SearchConfig):
             return action
         except Exception as e:
             self.log(f"MCTS threw an error: {e=}. Returning default action.")
+            metrics.count("fallbacks")
 
             return Action(action_id=None)
 
@@ -111,6 +170,12 @@ class ReasoningViaPlanning(Agent, WorldModel, SearchConfig):
         self, state: GameState, action: Action
     ) -> tuple[GameState, dict[str, float]]:
         """From WorldModel; called by MCTS."""
+        with tracing.span("rap.step", depth=state.depth):
+            return self._step(state, action)
+
+    def _step(
+        self, state: GameState, action: Action
+    ) -> tuple[GameState, dict[str, float]]:
         try:
             oth = others_actions(state, *self.completions)
         except Exception as e:
@@ -160,6 +225,12 @@ class ReasoningViaPlanning(Agent, WorldModel, SearchConfig):
         self, state: GameState, action: Action
     ) -> tuple[float, dict[str, float]]:
         """From SearchConfig; called by MCTS."""
+        with tracing.span("rap.fast_reward", depth=state.depth):
+            return self._fast_reward(state, action)
+
+    def _fast_reward(
+        self, state: GameState, action: Action
+    ) -> tuple[float, dict[str, float]]:
         actions = get_actions(state, *self.completions)
         int = intuitions(state, actions, *self.probabilities)
         int = int[actions.index(action)]
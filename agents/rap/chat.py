@@ -1,39 +1,43 @@
 from api.classes import Rules
 import api.util as util
-import openai
+import api.tracing as tracing
+import api.metrics as metrics
+import time
+from agents.clients import openai_client
+from agents.llm_cache import lookup, store
+from agents.gateway import gateway, estimate_tokens
 import random
 from .definitions import *
 import math
 from functools import partial
+from typing import TYPE_CHECKING
 
-from PIL import Image
 import base64
 from io import BytesIO
 
-openai_client = openai.Client(
-    api_key=util.load_json("credentials.json")["openai_api_key"]
-)
+if TYPE_CHECKING:
+    from PIL import Image
 
 
 def context_builder_factory(rules: Rules) -> ContextBuilder:
     """Makes a context builder with substitutions for game rules."""
     context_templates = util.load_json("agents/rap/context_templates.json")
+    example = context_templates["example"]
+
+    if rules.additional_details:
+        topics = context_templates["additional_topics"]
+        topics = topics.format(
+            topics=", ".join(list(rules.additional_details))
+            if rules.additional_details
+            else "none"
+        )
+    else:
+        topics = ""
 
     def context_builder(template: str, observation: str, **kwargs: str) -> ContextType:
-        example = context_templates["example"]
         prefix = context_templates["prefix"]
         messages = context_templates[template]
 
-        if rules.additional_details:
-            topics = context_templates["additional_topics"]
-            topics = topics.format(
-                topics=", ".join(list(rules.additional_details))
-                if rules.additional_details
-                else "none"
-            )
-        else:
-            topics = ""
-
         prefix = prefix.format(title=rules.title, summary=rules.summary, observation=observation, topics=topics)
 
         return [
@@ -51,51 +55,83 @@ def context_builder_factory(rules: Rules) -> ContextBuilder:
     return context_builder
 
 
+def record_usage(usage, request_span, parent, model="", seconds=0.0):
+    """Puts a response's token counts on its llm_request span, adds them to the enclosing span and
+    records the call in the match's metrics."""
+    # The part of the prompt the provider served from its prefix cache.
+    cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None) or 0
+    request_span.set(prompt_tokens=usage.prompt_tokens, cached_prompt_tokens=cached, completion_tokens=usage.completion_tokens)
+    parent.add("llm_requests")
+    parent.add("prompt_tokens", usage.prompt_tokens)
+    parent.add("cached_prompt_tokens", cached)
+    parent.add("completion_tokens", usage.completion_tokens)
+    metrics.record_call(model, usage.prompt_tokens, usage.completion_tokens, cached, seconds)
+
+
+def total_tokens(response) -> int:
+    return response.usage.total_tokens
+
+
 def openai_api(model="gpt-4-1106-preview") -> tuple[CompletionsFunction, ProbabilitiesFunction]:
     """Returns a CompletionsFunction and a ProbabilitiesFunction that
     interacts with GPT4."""
 
     def completions(context: ContextType) -> str:
-        return (
-            openai_client.chat.completions.create(
-                model=model, messages=context
+        key, content = lookup(model, context)
+        if content is not None:
+            tracing.current_span().add("cached_requests")
+            return content
+        parent = tracing.current_span()
+        start = time.perf_counter()
+        with tracing.span("llm_request", model=model, kind="completions") as request_span:
+            response = gateway().request(
+                model,
+                lambda: openai_client().chat.completions.create(model=model, messages=context),
+                estimate_tokens(context),
+                total_tokens,
             )
-            .choices[0]
-            .message.content
-        )
+        record_usage(response.usage, request_span, parent, model, time.perf_counter() - start)
+        store(key, model, response.choices[0].message.content)
+        return response.choices[0].message.content
 
     def probabilities(
         context: ContextType, tokens: list[str] = ["yes", "no"]
     ) -> dict[str, float]:
         n = min(len(tokens), 5)  # OpenAI doesn't allow more than 5
+        params = {"logprobs": True, "top_logprobs": n, "max_tokens": 1}
 
-        top_logprobs = (
-            openai_client.chat.completions.create(
-                model=model,
-                messages=context,
-                logprobs=True,
-                top_logprobs=n,
-                max_tokens=1,
-            )
-            .choices[0]
-            .logprobs.content[0]
-            .top_logprobs
-        )
+        # The log probabilities don't depend on the temperature, so they can always be cached.
+        key, top_logprobs = lookup(model, context, params, deterministic=True)
+        if top_logprobs is not None:
+            tracing.current_span().add("cached_requests")
+        else:
+            parent = tracing.current_span()
+            start = time.perf_counter()
+            with tracing.span("llm_request", model=model, kind="probabilities") as request_span:
+                response = gateway().request(
+                    model,
+                    lambda: openai_client().chat.completions.create(model=model, messages=context, **params),
+                    estimate_tokens(context, 1),
+                    total_tokens,
+                )
+            record_usage(response.usage, request_span, parent, model, time.perf_counter() - start)
+            top_logprobs = [(tlp.token, tlp.logprob) for tlp in response.choices[0].logprobs.content[0].top_logprobs]
+            store(key, model, top_logprobs)
 
         def unnorm_prob(token: str):
             """Return the unnormalized probability of a token."""
             return math.exp(
                 next(
                     (
-                        tlp.logprob
-                        for tlp in top_logprobs
-                        if tlp.token.lower() == str(token).lower()
+                        logprob
+                        for candidate, logprob in top_logprobs
+                        if candidate.lower() == str(token).lower()
                     ),
                     -100,
                 )
             )
 
-        p_total = sum(math.exp(tlp.logprob) for tlp in top_logprobs)
+        p_total = sum(math.exp(logprob) for _, logprob in top_logprobs)
         return {token: unnorm_prob(token) / p_total for token in tokens}
 
     return completions, probabilities
@@ -104,12 +140,13 @@ def openai_api(model="gpt-4-1106-preview") -> tuple[CompletionsFunction, Probabi
 def random_api() -> tuple[CompletionsFunction, ProbabilitiesFunction]:
     """Returns completions and probabilities that return random responses.
     Useful for debugging."""
+    rng = random.Random()  # don't consume the game's random stream
 
     def randstr() -> str:
         """There is a probability that this returns the same string in different
         calls which could make debugging confusing."""
         return "".join(
-            random.choices("abcdefghijklmnopqrstuvwxyz", k=random.randint(5, 10))
+            rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(5, 10))
         )
 
     def completions(context: ContextType) -> str:
@@ -118,7 +155,7 @@ def random_api() -> tuple[CompletionsFunction, ProbabilitiesFunction]:
     def probabilities(
         context: ContextType, tokens: list[str, str] = ["yes", "no"]
     ) -> dict[str, float]:
-        return {token: random.random() for token in tokens}
+        return {token: rng.random() for token in tokens}
 
     return completions, probabilities
 
@@ -141,30 +178,34 @@ def human_api() -> tuple[CompletionsFunction, ProbabilitiesFunction]:
     return completions, probabilities
 
 
-def image_description(image: Image, rules: Rules) -> str:
+def image_description(image: "Image", rules: Rules) -> str:
     """Gets GPT4 description of image. Doesn't need to fit with rest of code
     so it's kinda a standalone function."""
     buffered = BytesIO()
     image.save(buffered, format="JPEG")
     base64_image = base64.b64encode(buffered.getvalue())
 
-    c = openai_client.chat.completions.create(
-        model="gpt-4-vision-preview",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"You are playing a game called {rules.title}. The rules are as follows: {rules.summary}.\nThis image is your observation of the game. Describe what's going on in the image.",
-                    },
-                    {
-                        "type": "image",
-                        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
-                    },
-                ],
-            }
-        ],
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": f"You are playing a game called {rules.title}. The rules are as follows: {rules.summary}.\nThis image is your observation of the game. Describe what's going on in the image.",
+                },
+                {
+                    "type": "image",
+                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
+                },
+            ],
+        }
+    ]
+    # The image is billed by size rather than by its length in the request, so the estimate is rough.
+    c = gateway().request(
+        "gpt-4-vision-preview",
+        lambda: openai_client().chat.completions.create(model="gpt-4-vision-preview", messages=messages),
+        estimate_tokens(messages[0]["content"][0]["text"]) + 1000,
+        total_tokens,
     )
 
     return c.choices[0].message.content
@@ -1,4 +1,5 @@
 from .chat import *
+import api.metrics as metrics
 import re
 
 
@@ -14,6 +15,7 @@ def lookup_monad(completions: CompletionsFunction, rules: Rules) -> CompletionsF
             if re.match(rules_lookup_re, ret):
                 rule = re.findall(rules_lookup_re, ret)[0]
                 if rule in rules.additional_details:
+                    metrics.count("explain_lookups")
                     context.append({"role": "assistant", "content": ret})
                     context.append(
                         {"role": "user", "content": rules.additional_details[rule]}
@@ -1,12 +1,15 @@
-from typing import Generic, TypeVar, Union, NamedTuple, Protocol, Optional, runtime_checkable, Tuple
+from typing import Generic, TypeVar, Union, NamedTuple, Protocol, Optional, runtime_checkable, Tuple, TYPE_CHECKING
 from abc import ABC, abstractmethod
 
 import numpy as np
-from transformers import StoppingCriteriaList
 from datetime import datetime
 import os, sys, pickle
 from tqdm import tqdm
-import torch
+
+# transformers and torch are only needed by the HF language models and Evaluator.evaluate, and are
+# slow to import (or not installed at all when only the OpenAI backend is used).
+if TYPE_CHECKING:
+    from transformers import StoppingCriteriaList
 
 State = TypeVar("State")
 Action = TypeVar("Action")
@@ -33,7 +36,7 @@ class LanguageModel(ABC):
                  eos_token_id: Union[None, str, int, list[str, int]] = None,
                  hide_input: bool = True,
                  output_log_probs: bool = False,
-                 stopping_criteria: Optional[StoppingCriteriaList] = None,
+                 stopping_criteria: Optional["StoppingCriteriaList"] = None,
                  **kwargs) -> GenerateOutput:
         """Generate text from a list of prompts.
 
@@ -175,6 +178,8 @@ class Evaluator():
                  resume=0,
                  log_dir=None):
 
+        import torch
+
         self.dataset = list(self.full_dataset)[resume:]
         try:
             algo_name = reasoner.search_algo.__class__.__name__
@@ -0,0 +1,329 @@
+import ast
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+import fire
+import api.util as util
+
+# A local stand-in for the chat completions API, for load-testing the harness (concurrency, the
+# gateway's rate limiting, schedulers) without spending money. It answers POSTs to any path ending in
+# /chat/completions, so both the openai client (/v1/chat/completions) and AzureChatOpenAI
+# (/openai/deployments/<deployment>/chat/completions) can use it. To point the agents at it:
+#   python3 agents/stub_llm.py --port 8000 --latency '{"distribution": "lognormal", "median": 0.8, "sigma": 0.5}'
+#   LLM_BASE_URL=http://127.0.0.1:8000 python3 api/play_game.py --agent_2_path agents.gpt.GPT4 ...
+#
+# Responses are valid moves by default: the OpenAITextAgent's JSON answer picks one of the actions its
+# prompt lists, the RAP agent's <state>/<actions>/<others> completions are filled with filler text, and
+# log probability requests get random top_logprobs over the answers the prompt asks for (yes/no, or
+# the numbers of the listed actions). A script, a JSON list of {"pattern": regex, "response": text} or
+# {"pattern": regex, "top_logprobs": {token: logprob}}, overrides them for the requests whose last
+# message matches the pattern.
+
+WORDS = "the a left right door prize board piece move opponent card player token corner center open closed".split()
+
+def sample_latency(latency : dict, rng : random.Random) -> float:
+    """Seconds to wait before responding, from a spec such as
+    {"distribution": "constant", "seconds": 0.5}, {"distribution": "uniform", "low": 0.2, "high": 2},
+    {"distribution": "lognormal", "median": 0.8, "sigma": 0.5} or {"distribution": "exponential", "mean": 1}."""
+    distribution = latency.get("distribution", "constant")
+    if distribution == "constant":
+        return latency.get("seconds", 0.0)
+    if distribution == "uniform":
+        return rng.uniform(latency.get("low", 0.0), latency["high"])
+    if distribution == "lognormal":
+        return rng.lognormvariate(math.log(latency["median"]), latency.get("sigma", 0.5))
+    if distribution == "exponential":
+        return rng.expovariate(1 / latency["mean"])
+    raise ValueError(f"Unknown latency distribution {distribution}")
+
+def count_tokens(text : str) -> int:
+    # Same rough rule as agents.gateway.estimate_tokens.
+    return max(1, len(text) // 4)
+
+def message_text(message : dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+def last_prompt(messages : list) -> str:
+    # The OpenAITextAgent asks again without a new message after a response that isn't JSON.
+    prompts = [message_text(message) for message in messages if message.get("role") != "assistant"]
+    return prompts[-1] if prompts else ""
+
+class StubLLM:
+    """The behaviour of the server: latency, injected errors, a requests-per-minute quota and the
+    responses themselves. Shared by the server's request threads."""
+
+    def __init__(
+        self,
+        latency : dict = {"distribution": "constant", "seconds": 0.0},
+        seconds_per_token : float = 0.0,
+        error_rate : float = 0.0,
+        rate_limit_rate : float = 0.0,
+        retry_after : float = 1.0,
+        requests_per_minute : Optional[float] = None,
+        invalid_rate : float = 0.0,
+        script : Optional[list] = None,
+        seed : Optional[int] = None,
+        max_prefixes : int = 100_000,
+    ):
+        """error_rate and rate_limit_rate are the shares of requests answered with a 500 and a 429
+        (with a Retry-After of retry_after seconds). requests_per_minute, if set, is a quota like the
+        provider's, beyond which requests get a 429 saying how long until the next one is allowed.
+        invalid_rate is the share of completions answered with text that isn't a valid move.
+        max_prefixes bounds the prompt prefixes remembered for cached_tokens."""
+        self.latency = latency
+        self.seconds_per_token = seconds_per_token
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.requests_per_minute = requests_per_minute
+        self.invalid_rate = invalid_rate
+        self.script = [(re.compile(rule["pattern"], re.S), rule) for rule in script or []]
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.allowance = requests_per_minute or 0.0
+        self.allowance_at = time.monotonic()
+        # Hashes of the most recently seen conversation prefixes, least recent first, to report cached
+        # prompt tokens like the provider. Bounded like the provider's cache, so memory stays flat.
+        self.prefixes = OrderedDict()
+        self.max_prefixes = max_prefixes
+        self.stats = {"requests": 0, "completed": 0, "errors": 0, "rate_limited": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def _random(self) -> float:
+        with self.lock:
+            return self.rng.random()
+
+    def _choice(self, options : list):
+        with self.lock:
+            return self.rng.choice(options)
+
+    def _filler(self, words : int = 8) -> str:
+        with self.lock:
+            return " ".join(self.rng.choices(WORDS, k=words))
+
+    def _quota_wait(self) -> float:
+        # Seconds until the quota allows this request, 0 if it does now (and then it is taken).
+        if self.requests_per_minute is None:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.requests_per_minute, self.allowance + (now - self.allowance_at) * self.requests_per_minute / 60)
+            self.allowance_at = now
+            if self.allowance < 1:
+                return (1 - self.allowance) * 60 / self.requests_per_minute
+            self.allowance -= 1
+            return 0.0
+
+    def rejection(self) -> Optional[tuple]:
+        """(status, headers, message) if the request should fail, else None."""
+        wait = self._quota_wait()
+        if wait > 0:
+            return 429, {"retry-after": f"{wait:.3f}"}, "Requests per minute quota exceeded."
+        r = self._random()
+        if r < self.rate_limit_rate:
+            return 429, {"retry-after": str(self.retry_after)}, "Rate limit reached (injected)."
+        if r < self.rate_limit_rate + self.error_rate:
+            return 500, {}, "Internal server error (injected)."
+        return None
+
+    def _scripted(self, prompt : str, key : str):
+        for pattern, rule in self.script:
+            if key in rule and pattern.search(prompt):
+                return rule[key]
+        return None
+
+    def content(self, messages : list) -> str:
+        prompt = last_prompt(messages)
+        scripted = self._scripted(prompt, "response")
+        if scripted is not None:
+            return scripted
+        if self._random() < self.invalid_rate:
+            return "I'm not sure what to do here."
+
+        # The OpenAITextAgent's final question, or its follow-up after an invalid answer.
+        conversation = "\n".join(message_text(message) for message in messages)
+        if "'action' key" in prompt or "valid actions are as follows" in prompt:
+            predefined = re.findall(r"contains one of the following valid actions:\n(\[.*?\])\n", conversation)
+            openended = re.findall(r"your response to the prompt:\n(\[.*?\])", conversation)
+            predefined = ast.literal_eval(predefined[-1]) if predefined else []
+            openended = ast.literal_eval(openended[-1]) if openended else []
+            if predefined or openended:
+                action = self._choice(predefined + openended)
+                response = {"action": action}
+                if action in openended:
+                    response["openended_response"] = self._filler()
+                return json.dumps(response)
+
+        # The RAP agent's completions ask for an answer between <tag> and </tag>.
+        tags = re.findall(r"between <(\w+)> and </\w+>", prompt)
+        if tags:
+            tag = tags[-1]
+            if tag == "actions":
+                with self.lock:
+                    count = self.rng.randint(2, 4)
+                body = "\n".join(f"{i}. {self._filler(3)}" for i in range(count))
+                return f"<actions>\n{body}\n</actions>"
+            return f"<{tag}>{self._filler()}</{tag}>"
+        return self._filler(20)
+
+    def top_logprobs(self, messages : list, n : int) -> list[tuple[str, float]]:
+        prompt = last_prompt(messages)
+        scripted = self._scripted(prompt, "top_logprobs")
+        if scripted is not None:
+            return list(scripted.items())[:n]
+        if "yes/no" in prompt:
+            tokens = ["yes", "no"]
+        else:
+            # The numbered actions of the RAP agent's action_select prompt.
+            listed = re.findall(r"^(\d+)\. ", "\n".join(message_text(message) for message in messages), re.M)
+            tokens = list(dict.fromkeys(listed)) or [str(i) for i in range(n)]
+        with self.lock:
+            tokens = self.rng.sample(tokens, min(n, len(tokens)))
+            weights = [self.rng.random() + 1e-3 for _ in tokens]
+        total = sum(weights)
+        return [(token, math.log(weight / total)) for token, weight in zip(tokens, weights)]
+
+    def cached_tokens(self, messages : list) -> int:
+        # Like the provider, the longest previously seen prefix of whole messages counts as cached,
+        # once it is at least 1024 tokens.
+        cached, length, prefix = 0, 0, None
+        with self.lock:
+            for message in messages:
+                length += count_tokens(message_text(message))
+                prefix = hash((prefix, json.dumps(message, sort_keys=True, default=str)))
+                if prefix in self.prefixes:
+                    cached = length
+                    self.prefixes.move_to_end(prefix)
+                else:
+                    self.prefixes[prefix] = None
+                    if len(self.prefixes) > self.max_prefixes:
+                        self.prefixes.popitem(last=False)
+        return cached if cached >= 1024 else 0
+
+    def completion(self, body : dict, model : str) -> dict:
+        messages = body.get("messages", [])
+        logprobs = None
+        if body.get("logprobs"):
+            top_logprobs = self.top_logprobs(messages, body.get("top_logprobs") or 1)
+            content = top_logprobs[0][0]
+            logprobs = {"content": [{
+                "token": content,
+                "logprob": top_logprobs[0][1],
+                "bytes": list(content.encode()),
+                "top_logprobs": [{"token": token, "logprob": logprob, "bytes": list(token.encode())} for token, logprob in top_logprobs],
+            }]}
+        else:
+            content = self.content(messages)
+        prompt_tokens = sum(count_tokens(message_text(message)) for message in messages)
+        completion_tokens = count_tokens(content)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "logprobs": logprobs,
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": self.cached_tokens(messages)},
+            },
+        }
+
+    def delay(self, response : dict) -> float:
+        with self.lock:
+            seconds = sample_latency(self.latency, self.rng)
+        return seconds + self.seconds_per_token * response["usage"]["completion_tokens"]
+
+    def count(self, name : str, n : int = 1):
+        with self.lock:
+            self.stats[name] += n
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, as the clients pool their connections
+
+    def _send(self, status : int, payload : dict, headers : dict = {}):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send(200, self.server.stub.stats)
+        else:
+            self._send(404, {"error": {"message": f"No route {self.path}"}})
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = self.path.split("?")[0]
+        if not path.endswith("/chat/completions"):
+            self._send(404, {"error": {"message": f"No route {self.path}"}})
+            return
+        # Azure names the deployment in the path rather than the body.
+        deployment = re.findall(r"/deployments/([^/]+)/", path)
+        model = body.get("model") or (deployment[0] if deployment else "stub")
+
+        stub.count("requests")
+        stub.count("in_flight")
+        try:
+            rejection = stub.rejection()
+            if rejection is not None:
+                status, headers, message = rejection
+                stub.count("rate_limited" if status == 429 else "errors")
+                # Failures come back quickly, as the provider's do.
+                self._send(status, {"error": {"message": message, "type": "stub", "code": str(status)}}, headers)
+                return
+            response = stub.completion(body, model)
+            time.sleep(stub.delay(response))
+            stub.count("completed")
+            self._send(200, response)
+        finally:
+            stub.count("in_flight", -1)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(host : str = "127.0.0.1", port : int = 8000, **stub_kwargs) -> ThreadingHTTPServer:
+    """A server (not yet serving) answering with a StubLLM(**stub_kwargs). port 0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.stub = StubLLM(**stub_kwargs)
+    return server
+
+def serve(host = "127.0.0.1", port = 8000, script_path = None, **stub_kwargs):
+    """Runs the stub server until interrupted. Takes StubLLM's arguments, plus script_path, a JSON file
+    with the script."""
+    script = util.load_json(script_path) if script_path is not None else None
+    server = make_server(host, port, script=script, **stub_kwargs)
+    print(f"Stub LLM listening on http://{host}:{server.server_address[1]}, set LLM_BASE_URL to point the agents at it")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stub.stats))
+        server.server_close()
+
+if __name__ == "__main__":
+    fire.Fire(serve)
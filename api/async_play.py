@@ -0,0 +1,82 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from api.classes import Agent
+from api.play_game import play_match, may_start
+
+# Games are synchronous, so each running game lives on a lightweight thread that only executes
+# engine code. Whenever an agent with a native take_action_async has to decide, the game thread
+# hands the coroutine to the shared event loop and blocks until it resolves. All of the waiting on
+# LLM requests therefore happens on one event loop, while the game classes run unchanged.
+# Concurrent games share the random module, so matches played this way record their actions but no
+# seed, and api.replay leaves them out. For the same reason the two legs of a mirrored pair wouldn't
+# get the same deal, so iter_matches in api.play_game doesn't combine pairs with concurrency.
+
+def is_async_agent(agent_class) -> bool:
+    return agent_class.take_action_async is not Agent.take_action_async
+
+def bridge_agent_class(agent_class, loop: asyncio.AbstractEventLoop):
+    """Returns a subclass of agent_class whose take_action yields to the event loop."""
+    if not is_async_agent(agent_class):
+        # Purely synchronous agents just run on the game thread.
+        return agent_class
+
+    def take_action(self, rules, observation, available_actions, show_state):
+        # The coroutine runs in a copy of this thread's context, so the agent's spans stay under this
+        # game's turn span and its metrics with this game's match.
+        coroutine = agent_class.take_action_async(self, rules, observation, available_actions, show_state)
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    return type(agent_class.__name__, (agent_class,), {
+        "take_action": take_action,
+        "__module__": agent_class.__module__,
+        "__qualname__": agent_class.__qualname__,
+    })
+
+async def play_matches(agent_1_class, agent_2_class, game_class, num_matches = 1, max_concurrent = 100, show_state=False, agent_1_kwargs = {}, agent_2_kwargs = {}, stop = None, specs = None):
+    """Asynchronously yields a MatchResult for each match as it finishes.
+    Up to max_concurrent games are in flight at once. Once the optional threading.Event stop is set,
+    no new games are started but the ones in flight are still played to the end.
+    specs optionally gives the play_match keyword arguments of each match (see api.play_game.match_specs)."""
+    specs = specs if specs is not None else [{} for _ in range(num_matches)]
+    loop = asyncio.get_running_loop()
+    agent_1_class = bridge_agent_class(agent_1_class, loop)
+    agent_2_class = bridge_agent_class(agent_2_class, loop)
+    # Restoring the random state around each decision would clobber the other games' draws.
+    match = partial(play_match, agent_1_class, agent_2_class, game_class, show_state, agent_1_kwargs, agent_2_kwargs, isolate_agent_rng=False)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrent, num_matches)), thread_name_prefix="game") as executor:
+        pending = set()
+        started = 0
+        while True:
+            while started < len(specs) and len(pending) < max_concurrent and may_start(specs[started], stop):
+                pending.add(loop.run_in_executor(executor, partial(match, **specs[started])))
+                started += 1
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                yield finished.result()
+
+def iter_matches(agent_1_class, agent_2_class, game_class, num_matches = 1, max_concurrent = 100, show_state=False, agent_1_kwargs = {}, agent_2_kwargs = {}, stop = None, specs = None):
+    """Synchronous view of play_matches for callers that are not running an event loop."""
+    results = queue.Queue()
+
+    async def drain():
+        try:
+            async for result in play_matches(agent_1_class, agent_2_class, game_class, num_matches, max_concurrent, show_state, agent_1_kwargs, agent_2_kwargs, stop, specs):
+                results.put(result)
+        except BaseException as e:
+            results.put(e)
+        finally:
+            results.put(None)
+
+    thread = threading.Thread(target=asyncio.run, args=(drain(),), daemon=True)
+    thread.start()
+    while (result := results.get()) is not None:
+        if isinstance(result, BaseException):
+            raise result
+        yield result
+    thread.join()
@@ -0,0 +1,168 @@
+import fire
+import api.util as util
+import contextlib
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from agents.random_agent import RandomAgent
+from api.play_game import play_match
+import api.registry as registry
+
+# TicTacToe is the near-zero-cost baseline for measuring the harness itself.
+BASELINE = "tic_tac_toe"
+
+DEFAULT_RESULTS_DIR = "benchmarks"
+
+def timed_agent_class(agent_class, timestamps):
+    """Returns a subclass of agent_class that appends (start, end) to timestamps for every decision."""
+    def take_action(self, *args, **kwargs):
+        start = time.perf_counter()
+        action = agent_class.take_action(self, *args, **kwargs)
+        timestamps.append((start, time.perf_counter()))
+        return action
+
+    return type(agent_class.__name__, (agent_class,), {
+        "take_action": take_action,
+        "__module__": agent_class.__module__,
+        "__qualname__": agent_class.__qualname__,
+    })
+
+def _agent_kwargs(seed):
+    # RandomAgent draws from its own rng rather than the game's, so it is seeded from the match seed
+    # too, to make a run reproducible from its seed. Teammates share their side's rng.
+    return {"rng": random.Random(f"{seed}:1")}, {"rng": random.Random(f"{seed}:2")}
+
+def _play_raw(agent_class, game_class, seed):
+    # The game on its own, without play_match's recording and agent wrapping, to measure the harness against.
+    random.seed(seed)
+    agent_1_kwargs, agent_2_kwargs = _agent_kwargs(seed)
+    game = game_class(agent_1_kwargs=agent_1_kwargs, agent_2_kwargs=agent_2_kwargs)
+    game.init_game(agent_class, agent_class)
+    game.play()
+
+def bench_game(game_path, num_games = 1000, max_seconds = None, seed = 0, harness = True):
+    """Plays RandomAgent against itself num_games times (or until max_seconds have passed).
+    A turn's engine latency is the time from the end of the previous decision (or the start of the
+    match) to the start of this one, i.e. everything but the agent itself."""
+    game_class = util.import_class(game_path)
+    timestamps = []
+    agent_class = timed_agent_class(RandomAgent, timestamps)
+    engine_latencies = []
+    agent_time = 0.0
+    played = 0
+    turns = 0
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        while played < num_games and (max_seconds is None or time.perf_counter() - start < max_seconds):
+            timestamps.clear()
+            match_start = time.perf_counter()
+            if harness:
+                play_match(agent_class, agent_class, game_class, False, *_agent_kwargs(seed + played), seed=seed + played)
+            else:
+                _play_raw(agent_class, game_class, seed + played)
+            previous = match_start
+            for decision_start, decision_end in timestamps:
+                engine_latencies.append(decision_start - previous)
+                agent_time += decision_end - decision_start
+                previous = decision_end
+            played += 1
+            turns += len(timestamps)
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(engine_latencies) if engine_latencies else np.zeros(1)
+    return {
+        "game": game_class.id,
+        "game_path": game_path,
+        "games": played,
+        "turns": turns,
+        "seconds": elapsed,
+        "games_per_second": played / elapsed,
+        "turns_per_second": turns / elapsed,
+        "engine_latency_p50_ms": float(np.percentile(latencies, 50)) * 1e3,
+        "engine_latency_p99_ms": float(np.percentile(latencies, 99)) * 1e3,
+        "agent_seconds": agent_time,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, # ru_maxrss is in KB on Linux
+    }
+
+def _in_fresh_process(function, *args):
+    # A freshly spawned process per title so that peak RSS belongs to that title alone.
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+def harness_overhead(num_games = 2000, seed = 0):
+    """Per-turn cost of play_match (seeding, recording, agent wrapping) measured on TicTacToe, whose
+    engine does almost nothing: the difference between playing through play_match and playing directly."""
+    path = registry.get(BASELINE).class_path
+    raw = _in_fresh_process(bench_game, path, num_games, None, seed, False)
+    harnessed = _in_fresh_process(bench_game, path, num_games, None, seed, True)
+    return {
+        "raw_seconds_per_turn": raw["seconds"] / raw["turns"],
+        "harness_seconds_per_turn": harnessed["seconds"] / harnessed["turns"],
+        "overhead_us_per_turn": (harnessed["seconds"] / harnessed["turns"] - raw["seconds"] / raw["turns"]) * 1e6,
+        "raw": raw,
+        "harness": harnessed,
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(titles = None, num_games = 1000, max_seconds = None, seed = 0, results_dir = DEFAULT_RESULTS_DIR, overhead = True, cold_start = True):
+    """Benchmarks the game engines with RandomAgent and saves the results as JSON in results_dir.
+    titles defaults to every game in the paper (rating.games). max_seconds caps the time spent on
+    each title, which is useful for slow engines like hive."""
+    if titles is None:
+        titles = [spec.id for spec in registry.paper_games()]
+    elif isinstance(titles, str):
+        titles = [titles]
+
+    results = {
+        "created_at": time.time(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "num_games": num_games,
+        "max_seconds": max_seconds,
+        "games": {},
+    }
+    print(f"{'game':<22} {'games':>6} {'turns':>8} {'games/s':>9} {'turns/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'rss MB':>8}")
+    for title in titles:
+        r = _in_fresh_process(bench_game, registry.get(title).class_path, num_games, max_seconds, seed)
+        results["games"][title] = r
+        print(f"{title:<22} {r['games']:>6} {r['turns']:>8} {r['games_per_second']:>9.2f} {r['turns_per_second']:>10.1f} {r['engine_latency_p50_ms']:>8.3f} {r['engine_latency_p99_ms']:>8.3f} {r['peak_rss_mb']:>8.1f}")
+
+    if overhead:
+        results["harness_overhead"] = harness_overhead(seed=seed)
+        print(f"\nHarness overhead: {results['harness_overhead']['overhead_us_per_turn']:.1f} us per turn (TicTacToe baseline)")
+
+    if cold_start:
+        print("")
+        results["cold_start"] = registry.cold_start(titles)
+
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    util.save_json(results, path)
+    print(f"Results saved to {path}")
+
+def compare(baseline_path, current_path):
+    """Prints the per-game throughput ratio of two saved benchmark runs (above 1 means current is faster)."""
+    baseline = util.load_json(baseline_path)
+    current = util.load_json(current_path)
+    print(f"{'game':<22} {'turns/s':>10} {'vs baseline':>12} {'p99 ms':>8} {'vs baseline':>12}")
+    for title, r in current["games"].items():
+        if title not in baseline["games"]:
+            continue
+        b = baseline["games"][title]
+        print(f"{title:<22} {r['turns_per_second']:>10.1f} {r['turns_per_second'] / b['turns_per_second']:>11.2f}x {r['engine_latency_p99_ms']:>8.3f} {r['engine_latency_p99_ms'] / b['engine_latency_p99_ms']:>11.2f}x")
+
+if __name__ == "__main__":
+    fire.Fire({"run": run, "compare": compare, "overhead": harness_overhead})
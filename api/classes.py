@@ -1,13 +1,17 @@
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Tuple, TYPE_CHECKING
 from dataclasses import dataclass, field
 from abc import abstractmethod
-from PIL import Image
+import asyncio
+
+if TYPE_CHECKING:
+    # Only needed for the annotation; games that render images import PIL themselves.
+    from PIL import Image
 
 
 @dataclass
 class Observation:
     text : str
-    image : Image = None
+    image : "Image" = None
 
 @dataclass
 class AvailableActions:
@@ -23,16 +27,39 @@ class Action:
     def __str__(self):
         return self.action_id if self.openended_response is None else f"{self.action_id}: {self.openended_response}"
 
+@dataclass
+class GameResult:
+    scores : Tuple[float, float] # of the first and second team, as returned by Game.play
+    seat : int # 0 if the agent played for the first team, 1 for the second
+
+    @property
+    def score(self) -> float:
+        return self.scores[self.seat]
+
 @dataclass
 class Agent:
     team_id : int
     agent_id : int
     agent_type_id : str
 
+    def on_game_start(self, rules : "Rules", seat : int):
+        # Called once before the game's first turn with the rules every turn will be given and the agent's
+        # seat (0 for the first team). Agents can precompute anything that only depends on the rules here.
+        pass
+
+    def on_game_end(self, result : Optional[GameResult]):
+        # Called once after the game, with None if it ended with an exception. Per-game resources should be released here.
+        pass
+
     @abstractmethod
     def take_action(self, rules : dict, observation: Observation, available_actions : AvailableActions, show_state : bool) -> Action:
         pass
 
+    async def take_action_async(self, rules : dict, observation: Observation, available_actions : AvailableActions, show_state : bool) -> Action:
+        # Agents that spend their time waiting on I/O (e.g. LLM requests) should override this.
+        # By default the synchronous take_action runs in a worker thread so it doesn't block the event loop.
+        return await asyncio.to_thread(self.take_action, rules, observation, available_actions, show_state)
+
 @dataclass
 class Rules:
     title: str
@@ -0,0 +1,159 @@
+import json
+import os
+import sqlite3
+import time
+from typing import Optional
+
+DEFAULT_STORE_PATH = "matches.db"
+LEGACY_JSON_PATH = "matches.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    game TEXT NOT NULL,
+    agent_1 TEXT NOT NULL,
+    agent_2 TEXT NOT NULL,
+    agent_1_score REAL NOT NULL,
+    agent_2_score REAL NOT NULL,
+    agent_1_seat INTEGER, -- 0 if agent 1 was the game's first agent, 1 otherwise
+    created_at REAL,
+    duration REAL, -- seconds
+    turns INTEGER, -- number of agent decisions
+    seed INTEGER,
+    metadata TEXT, -- JSON object with anything else worth keeping about the match
+    pair_id TEXT -- shared by the two mirrored matches of a pair (same seed, seats swapped), NULL otherwise
+);
+CREATE INDEX IF NOT EXISTS matches_by_game_and_agents ON matches (game, agent_1, agent_2);
+CREATE TABLE IF NOT EXISTS match_actions (
+    match_id INTEGER PRIMARY KEY REFERENCES matches (id),
+    actions TEXT NOT NULL -- JSON list of [agent_id, action_id, openended_response] ([agent_id, null] if the agent returned None), in the order they were taken
+);
+"""
+
+def _row_to_record(row : sqlite3.Row) -> dict:
+    record = dict(row)
+    record["metadata"] = json.loads(record["metadata"]) if record["metadata"] else {}
+    return record
+
+class MatchStore:
+    """SQLite-backed store of match results.
+
+    Each process should open its own MatchStore. SQLite serializes writers, so appends from many
+    processes are atomic, and lookups by game and agent pair go through an index instead of
+    scanning every match."""
+
+    def __init__(self, path : str = DEFAULT_STORE_PATH, legacy_json : Optional[str] = LEGACY_JSON_PATH):
+        is_new = not os.path.exists(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        # WAL lets readers proceed while another process is appending.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        # Stores created before pair_id existed.
+        if "pair_id" not in [row["name"] for row in self.connection.execute("PRAGMA table_info(matches)")]:
+            self.connection.execute("ALTER TABLE matches ADD COLUMN pair_id TEXT")
+
+        # Seed a freshly created store with the published matches so existing data stays visible.
+        if is_new and legacy_json and os.path.exists(legacy_json):
+            self.import_json(legacy_json, only_if_empty=True)
+
+    def close(self):
+        self.connection.close()
+
+    def append(self, game : str, agent_1 : str, agent_1_score : float, agent_2 : str, agent_2_score : float, agent_1_seat : Optional[int] = None, duration : Optional[float] = None, turns : Optional[int] = None, seed : Optional[int] = None, metadata : Optional[dict] = None, actions : Optional[list] = None, pair_id : Optional[str] = None) -> int:
+        """Appends one match (and, if given, its action stream) and returns its id."""
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO matches (game, agent_1, agent_2, agent_1_score, agent_2_score, agent_1_seat, created_at, duration, turns, seed, metadata, pair_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (game, agent_1, agent_2, agent_1_score, agent_2_score, agent_1_seat, time.time(), duration, turns, seed, json.dumps(metadata, default=str) if metadata is not None else None, pair_id),
+            )
+            if actions is not None:
+                self.connection.execute(
+                    "INSERT INTO match_actions (match_id, actions) VALUES (?, ?)",
+                    (cursor.lastrowid, json.dumps(actions, default=str)),
+                )
+        return cursor.lastrowid
+
+    def records(self, game : Optional[str] = None, agents : Optional[tuple] = None, after_id : Optional[int] = None) -> list[dict]:
+        """Returns full match rows, optionally restricted to a game and/or an (unordered) agent pair.
+        With after_id, only matches appended after that one are returned, for following a growing store."""
+        query = "SELECT * FROM matches"
+        clauses, params = [], []
+        if after_id is not None:
+            clauses.append("id > ?")
+            params.append(after_id)
+        if game is not None:
+            clauses.append("game = ?")
+            params.append(game)
+        if agents is not None:
+            agent_1, agent_2 = agents
+            clauses.append("((agent_1 = ? AND agent_2 = ?) OR (agent_1 = ? AND agent_2 = ?))")
+            params += [agent_1, agent_2, agent_2, agent_1]
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY id"
+
+        return [_row_to_record(row) for row in self.connection.execute(query, params)]
+
+    def record(self, match_id : int) -> Optional[dict]:
+        row = self.connection.execute("SELECT * FROM matches WHERE id = ?", (match_id,)).fetchone()
+        return _row_to_record(row) if row is not None else None
+
+    def actions(self, match_id : int) -> Optional[list]:
+        """Returns the recorded action stream of a match, or None if it wasn't recorded."""
+        row = self.connection.execute("SELECT actions FROM match_actions WHERE match_id = ?", (match_id,)).fetchone()
+        return json.loads(row["actions"]) if row is not None else None
+
+    def replayable_ids(self, game : Optional[str] = None) -> list[int]:
+        query = "SELECT m.id FROM matches m JOIN match_actions a ON a.match_id = m.id WHERE m.seed IS NOT NULL"
+        params = []
+        if game is not None:
+            query += " AND m.game = ?"
+            params.append(game)
+        return [row["id"] for row in self.connection.execute(query + " ORDER BY m.id", params)]
+
+    def matches(self, game : Optional[str] = None, agents : Optional[tuple] = None) -> list[dict]:
+        """Returns matches in the matches.json format, i.e. {"game": ..., agent_1: score, agent_2: score}.
+        That format can't represent an agent playing itself, so such matches are left out."""
+        return [
+            {"game": r["game"], r["agent_1"]: r["agent_1_score"], r["agent_2"]: r["agent_2_score"]}
+            for r in self.records(game, agents)
+            if r["agent_1"] != r["agent_2"]
+        ]
+
+    def clusters(self, game : Optional[str] = None, agents : Optional[tuple] = None) -> list[Optional[str]]:
+        """The pair_id of each match that matches(game, agents) returns, in the same order (None for
+        matches that weren't played as a pair). Statistics use it to keep correlated matches together."""
+        return [r["pair_id"] for r in self.records(game, agents) if r["agent_1"] != r["agent_2"]]
+
+    def agents(self) -> list[str]:
+        """Every agent id in the store, in the order they first played."""
+        query = (
+            "SELECT agent FROM (SELECT agent_1 AS agent, id FROM matches UNION ALL SELECT agent_2, id FROM matches) "
+            "GROUP BY agent ORDER BY MIN(id)"
+        )
+        return [row["agent"] for row in self.connection.execute(query)]
+
+    def import_json(self, json_path : str, only_if_empty : bool = False):
+        with open(json_path, "r", encoding="utf-8") as f:
+            matches = json.load(f)
+        with self.connection:
+            # Take the write lock up front so two processes creating the store at once don't both import.
+            self.connection.execute("BEGIN IMMEDIATE")
+            if only_if_empty and self.connection.execute("SELECT COUNT(*) FROM matches").fetchone()[0] > 0:
+                return
+            for match in matches:
+                (agent_1, agent_1_score), (agent_2, agent_2_score) = [(k, v) for k, v in match.items() if k != "game"]
+                self.connection.execute(
+                    "INSERT INTO matches (game, agent_1, agent_2, agent_1_score, agent_2_score) VALUES (?, ?, ?, ?, ?)",
+                    (match["game"], agent_1, agent_2, agent_1_score, agent_2_score),
+                )
+
+    def export_json(self, json_path : str):
+        """Writes the store in the matches.json format for publishing."""
+        with open(json_path, "w") as f:
+            json.dump(self.matches(), f, indent=4)
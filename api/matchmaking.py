@@ -0,0 +1,193 @@
+import fire
+import api.util as util
+import random
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+from api.play_game import record_match
+from api.match_store import MatchStore, DEFAULT_STORE_PATH
+from api.tournament import _spec, _play_job_match
+from rating import OnlineRatings, fisher_information, ilsr_points
+
+# Instead of playing a fixed number of matches per pair, the matchmaker keeps picking the (game, agent
+# pair) whose next match is expected to shrink the uncertainty of that game's pairwise win probabilities
+# the most, until every win probability is known to within target_se. The uncertainty of a win
+# probability p shrinks with p (1 - p), so a pair whose result is already clear (gpt-4 vs random) needs
+# few matches, and the budget goes to close and under-sampled pairs instead.
+#
+# It takes the tournament manifest format (see api/tournament.py). A game spec may also have a "cost",
+# e.g. its typical duration relative to the other games, which the expected gain is divided by.
+
+class Matchmaker:
+    def __init__(self, agents : list[str], games : list[str], target_se : float = 0.05, prior : float = 0.5, costs : dict = {}):
+        """agents and games are ids as recorded in the store. prior is the number of pseudo-comparisons
+        each way between every pair. It keeps the ratings finite when a pair's results are all one way
+        and the uncertainty finite for agents that haven't played."""
+        self.agents = agents
+        self.games = games
+        self.target_se = target_se
+        self.prior = prior
+        self.costs = costs
+        self.ratings = OnlineRatings(agents)
+        # Matches that have been handed out but haven't finished, per game and pair.
+        self.pending = defaultdict(Counter)
+        self.params = {}
+
+    def sync(self, store : MatchStore):
+        self.ratings.sync(store)
+
+    def _points(self, game : str) -> np.ndarray:
+        n = len(self.ratings.agents)
+        return self.ratings.points[game] if game in self.ratings.points else np.zeros((n, n))
+
+    def posterior(self, game : str) -> np.ndarray:
+        """Ratings for game regularized by the prior, warm-started from the previous ones."""
+        points = self._points(game)
+        previous = self.params.get(game)
+        if previous is not None and len(previous) < len(points):
+            previous = np.append(previous, np.zeros(len(points) - len(previous)))
+        self.params[game] = ilsr_points(points, alpha=self.prior, initial_params=previous)
+        return self.params[game]
+
+    def covariance(self, game : str) -> np.ndarray:
+        """Rating covariance for game, counting matches in flight as if they had already been played
+        (their information barely depends on the result)."""
+        points = self._points(game).copy()
+        for (i, j), count in self.pending[game].items():
+            points[i, j] += count / 2
+            points[j, i] += count / 2
+        return np.linalg.pinv(fisher_information(points, self.posterior(game), self.prior))
+
+    def _pool(self) -> list[int]:
+        return [self.ratings.index[agent] for agent in self.agents]
+
+    def standard_errors(self, game : str) -> np.ndarray:
+        """Standard errors of the ratings of agents in game."""
+        return np.sqrt(np.diag(self.covariance(game)))[self._pool()]
+
+    def _state(self, game : str):
+        # The pool's covariance, the information w = p (1 - p) of one match between each pair, and the
+        # variance of the rating difference of each pair.
+        pool = self._pool()
+        covariance = self.covariance(game)[np.ix_(pool, pool)]
+        params = self.params[game][pool]
+        p = 1 / (1 + np.exp(params[None, :] - params[:, None]))
+        variance = np.diag(covariance)
+        return covariance, p * (1 - p), variance[:, None] + variance[None, :] - 2 * covariance
+
+    def win_probability_errors(self, game : str) -> np.ndarray:
+        """Delta-method standard errors of the pairwise win probabilities, p (1 - p) sd(r_i - r_j)."""
+        _, w, difference_variance = self._state(game)
+        return w * np.sqrt(np.maximum(difference_variance, 0))
+
+    def gains(self, game : str) -> np.ndarray:
+        """gains[a, b] is how much one more match between agents[a] and agents[b] is expected to reduce
+        the summed variance of game's pairwise win probabilities, sum_ij w_ij^2 v_ij^T C v_ij with
+        v_ij = e_i - e_j. By Sherman-Morrison, one match between k and l (u = e_k - e_l) lowers each
+        v^T C v by w_kl (v^T C u)^2 / (1 + w_kl u^T C u), and summed over the pairs that is
+        w_kl u^T C L C u / (1 + w_kl u^T C u), with L the graph Laplacian of the weights w_ij^2."""
+        covariance, w, difference_variance = self._state(game)
+        laplacian = np.diag((w ** 2).sum(axis=1)) - w ** 2
+        spread = covariance @ laplacian @ covariance
+        spread_difference = np.diag(spread)[:, None] + np.diag(spread)[None, :] - 2 * spread
+        gains = w * spread_difference / (1 + w * difference_variance)
+        np.fill_diagonal(gains, 0)
+        return gains
+
+    def converged(self, game : str) -> bool:
+        return self.win_probability_errors(game).max() <= self.target_se
+
+    def next_match(self):
+        """The (game, agent_1, agent_2) to play next, or None once every game has converged."""
+        best, best_gain = None, 0.0
+        for game in self.games:
+            if self.converged(game):
+                continue
+            gains = self.gains(game) / self.costs.get(game, 1)
+            a, b = np.unravel_index(np.argmax(gains), gains.shape)
+            if gains[a, b] > best_gain:
+                best, best_gain = (game, self.agents[a], self.agents[b]), gains[a, b]
+        return best
+
+    def _pair(self, agent_1 : str, agent_2 : str):
+        i, j = self.ratings.index[agent_1], self.ratings.index[agent_2]
+        return (min(i, j), max(i, j))
+
+    def start(self, game : str, agent_1 : str, agent_2 : str):
+        self.pending[game][self._pair(agent_1, agent_2)] += 1
+
+    def finish(self, game : str, agent_1 : str, agent_1_score : float, agent_2 : str, agent_2_score : float):
+        self.pending[game][self._pair(agent_1, agent_2)] -= 1
+        self.ratings.add(game, agent_1, agent_1_score, agent_2, agent_2_score)
+
+    def report(self, standings : bool = False) -> str:
+        lines = []
+        for game in self.games:
+            lines.append(f"{game}: {self.ratings.matches[game]} matches, largest win probability standard error {self.win_probability_errors(game).max():.3f}")
+            if standings:
+                errors = self.standard_errors(game)
+                params = self.params[game][self._pool()]
+                for k in np.argsort(-params):
+                    lines.append(f"    {self.agents[k]:<20} {params[k]:7.3f} +- {1.96 * errors[k]:.3f}")
+        return "\n".join(lines)
+
+def run_matchmaking(manifest_path, target_se = 0.05, max_matches = 1000, workers = 1, prior = 0.5, show_state = False, save_results = True, store_path = DEFAULT_STORE_PATH):
+    """Plays the matches the Matchmaker asks for, up to workers at a time, until every pairwise win
+    probability in every game of the manifest has a standard error of at most target_se, or until
+    max_matches have been played. Matches
+    already in the store count, so an interrupted run continues where it stopped."""
+    manifest = util.load_json(manifest_path)
+    agents = {key: _spec(spec) for key, spec in manifest["agents"].items()}
+    games = {key: _spec(spec) for key, spec in manifest["games"].items()}
+    # The matchmaker works with the ids the store uses, so it can pick up matches played before.
+    agent_keys = {util.import_class(spec["path"]).agent_type_id: key for key, spec in agents.items()}
+    game_keys = {util.import_class(spec["path"]).id: key for key, spec in games.items()}
+
+    store = MatchStore(store_path)
+    matchmaker = Matchmaker(
+        list(agent_keys), list(game_keys), target_se, prior,
+        costs={game_id: games[key].get("cost", 1) for game_id, key in game_keys.items()},
+    )
+    matchmaker.sync(store)
+    print(matchmaker.report())
+
+    def submit(executor, game_id, agent_1_id, agent_2_id):
+        agent_1, agent_2 = agents[agent_keys[agent_1_id]], agents[agent_keys[agent_2_id]]
+        match_args = (agent_1["path"], agent_2["path"], games[game_keys[game_id]]["path"], show_state, agent_1.get("kwargs", {}), agent_2.get("kwargs", {}))
+        if executor is not None:
+            return executor.submit(_play_job_match, *match_args)
+        future = Future()
+        future.set_result(_play_job_match(*match_args))
+        return future
+
+    played = 0
+    pending = {}
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=random.seed) if workers > 1 else None
+    try:
+        while True:
+            while len(pending) < max(1, workers) and played + len(pending) < max_matches:
+                choice = matchmaker.next_match()
+                if choice is None:
+                    break
+                matchmaker.start(*choice)
+                pending[submit(executor, *choice)] = choice
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                game_id, agent_1_id, agent_2_id = pending.pop(future)
+                result = future.result()
+                matchmaker.finish(game_id, agent_1_id, result.agent_1_score, agent_2_id, result.agent_2_score)
+                if save_results:
+                    record_match(store, game_id, agent_1_id, agent_2_id, result)
+                played += 1
+                print(f"[{played}] {game_id}: {agent_1_id} {result.agent_1_score} - {result.agent_2_score} {agent_2_id}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print("")
+    print(matchmaker.report(standings=True))
+
+if __name__ == "__main__":
+    fire.Fire(run_matchmaking)
@@ -0,0 +1,171 @@
+import contextvars
+import fire
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Optional
+from api.match_store import MatchStore, DEFAULT_STORE_PATH
+
+# Per-agent accounting of a match's LLM calls and decision outcomes. play_match collects a MatchMetrics
+# for every match and stores its summary in the match's metadata, under "metrics". Agents report to
+# whichever match and agent is current, so they need no reference to either:
+#   metrics.record_call(model, prompt_tokens, completion_tokens, seconds=...) after every LLM response
+#   metrics.count("json_failures") etc. for everything else worth counting (see EVENTS)
+# Outside of play_match both are no-ops. Each call is also kept as a record, up to MAX_CALL_RECORDS per
+# agent, with the index of the gateway attempt that succeeded (the gateway calls note_attempt).
+
+# Counted per agent. Agents may count other events as well.
+EVENTS = (
+    "json_failures", # the response wasn't the JSON asked for
+    "invalid_actions", # the response named an action that isn't available, or left out a required part
+    "explain_lookups", # Explain() or rule() requests for more detail about the rules or an action
+    "fallbacks", # the agent gave up on the decision and returned a default action
+    "cached_responses", # answered from agents.llm_cache without a request
+    "cache_misses", # looked up in agents.llm_cache but not found
+    "cache_bypassed", # not cacheable, because of their temperature
+    "request_retries", # requests the gateway had to send again
+)
+
+# Per-call records kept per agent and match, beyond which calls only go into the totals.
+MAX_CALL_RECORDS = 256
+
+_match = contextvars.ContextVar("match_metrics", default=None)
+_agent = contextvars.ContextVar("metrics_agent", default=None)
+_attempt = contextvars.ContextVar("request_attempt", default=0)
+
+class MatchMetrics:
+    def __init__(self, game : Optional[str] = None):
+        self.game = game
+        self.agents = {} # agent_id -> tags and totals
+
+    def register(self, agent, seat : int):
+        self.agents[agent.agent_id] = {
+            "agent_type_id": agent.agent_type_id,
+            "seat": seat,
+            "team_id": agent.team_id,
+            "decisions": 0,
+            "llm_calls": 0,
+            "prompt_tokens": 0,
+            "cached_prompt_tokens": 0,
+            "completion_tokens": 0,
+            "llm_seconds": 0.0,
+            **{event: 0 for event in EVENTS},
+            "calls_per_decision": Counter(),
+            "models": {}, # model -> the LLM call totals above, for that model's calls
+            "calls": [], # the first MAX_CALL_RECORDS calls, in order
+        }
+
+    def _totals(self, agent_id) -> Optional[dict]:
+        return self.agents.get(agent_id)
+
+    def summary(self) -> dict:
+        """JSON-ready totals per agent (keyed by agent_id), for the match's metadata."""
+        agents = {}
+        for agent_id, totals in self.agents.items():
+            totals = dict(totals, models={model: dict(t) for model, t in totals["models"].items()}, calls=list(totals["calls"]))
+            # How many decisions took 1, 2, 3... LLM calls, which is where extra round trips show up.
+            totals["calls_per_decision"] = {str(calls): n for calls, n in sorted(totals["calls_per_decision"].items())}
+            agents[str(agent_id)] = totals
+        return {"game": self.game, "agents": agents}
+
+@contextmanager
+def collect(match_metrics : MatchMetrics):
+    """Makes match_metrics the current match's for the duration of the with block."""
+    token = _match.set(match_metrics)
+    try:
+        yield match_metrics
+    finally:
+        _match.reset(token)
+
+@contextmanager
+def acting(agent):
+    """Attributes what happens in the with block (one of agent's decisions) to agent."""
+    match_metrics = _match.get()
+    totals = match_metrics._totals(agent.agent_id) if match_metrics is not None else None
+    if totals is None:
+        yield
+        return
+    token = _agent.set([agent.agent_id, 0])
+    try:
+        yield
+    finally:
+        calls = _agent.get()[1]
+        _agent.reset(token)
+        totals["decisions"] += 1
+        totals["calls_per_decision"][calls] += 1
+
+def current():
+    """(match metrics, [agent_id, calls so far in the decision]) or (None, None)."""
+    return _match.get(), _agent.get()
+
+def count(event : str, n : float = 1):
+    match_metrics, agent = current()
+    if match_metrics is None or agent is None:
+        return
+    totals = match_metrics.agents[agent[0]]
+    totals[event] = totals.get(event, 0) + n
+
+def note_attempt(attempt : int):
+    """Called by the gateway when a request succeeds, with the index of the attempt (0 if it wasn't retried)."""
+    _attempt.set(attempt)
+
+def record_call(model : str, prompt_tokens : int, completion_tokens : int, cached_prompt_tokens : int = 0, seconds : float = 0.0):
+    match_metrics, agent = current()
+    attempt = _attempt.get()
+    _attempt.set(0)
+    if match_metrics is None or agent is None:
+        return
+    agent[1] += 1
+    totals = match_metrics.agents[agent[0]]
+    if len(totals["calls"]) < MAX_CALL_RECORDS:
+        totals["calls"].append({
+            "decision": totals["decisions"],
+            "call": agent[1], # 1 for a decision's first call, 2 for its first follow-up...
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "cached_prompt_tokens": cached_prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "seconds": seconds,
+            "attempt": attempt, # of the gateway's attempts at the request, 0 for the first
+        })
+    per_model = totals["models"].setdefault(model, {"llm_calls": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0, "llm_seconds": 0.0})
+    for t in (totals, per_model):
+        t["llm_calls"] += 1
+        t["prompt_tokens"] += prompt_tokens
+        t["cached_prompt_tokens"] += cached_prompt_tokens
+        t["completion_tokens"] += completion_tokens
+        t["llm_seconds"] += seconds
+
+def summarize(game = None, store_path = DEFAULT_STORE_PATH):
+    """Totals of the metrics stored with matches, per agent type and seat, e.g.
+    `python api/metrics.py --game hive`."""
+    totals = defaultdict(Counter)
+    calls_per_decision = defaultdict(Counter)
+    models = defaultdict(lambda: defaultdict(Counter))
+    for record in MatchStore(store_path).records(game):
+        for agent in record["metadata"].get("metrics", {}).get("agents", {}).values():
+            key = (agent["agent_type_id"], agent["seat"])
+            totals[key]["matches"] += 1
+            for name, value in agent.items():
+                if isinstance(value, (int, float)) and name not in ("seat", "team_id"):
+                    totals[key][name] += value
+            calls_per_decision[key].update({int(calls): n for calls, n in agent["calls_per_decision"].items()})
+            for model, model_totals in agent.get("models", {}).items():
+                models[key][model].update(model_totals)
+
+    print(f"{'agent':<24} {'seat':>4} {'decisions':>9} {'calls/dec':>9} {'prompt tok':>11} {'cached':>7} {'compl tok':>10} {'s/call':>7} {'json':>5} {'invalid':>7} {'explain':>7} {'fallback':>8} {'retries':>7}")
+    for (agent_type_id, seat), t in sorted(totals.items()):
+        decisions = max(t["decisions"], 1)
+        print(
+            f"{agent_type_id:<24} {seat:>4} {t['decisions']:>9} {t['llm_calls'] / decisions:>9.2f} {t['prompt_tokens']:>11} "
+            f"{t['cached_prompt_tokens'] / max(t['prompt_tokens'], 1):>7.1%} {t['completion_tokens']:>10} {t['llm_seconds'] / max(t['llm_calls'], 1):>7.2f} "
+            f"{t['json_failures']:>5} {t['invalid_actions']:>7} {t['explain_lookups']:>7} {t['fallbacks']:>8} {t['request_retries']:>7}"
+        )
+        if t["cached_responses"] or t["cache_misses"] or t["cache_bypassed"]:
+            print(f"{'':<29} LLM cache: {t['cached_responses']} hits, {t['cache_misses']} misses, {t['cache_bypassed']} bypassed")
+        if t["llm_calls"]:
+            print(f"{'':<29} calls per decision: {dict(sorted(calls_per_decision[(agent_type_id, seat)].items()))}")
+        for model, m in sorted(models[(agent_type_id, seat)].items()):
+            print(f"{'':<29} {model}: {m['llm_calls']} calls, {m['prompt_tokens']} prompt tokens ({m['cached_prompt_tokens'] / max(m['prompt_tokens'], 1):.1%} cached), {m['completion_tokens']} completion tokens, {m['llm_seconds'] / max(m['llm_calls'], 1):.2f} s/call")
+
+if __name__ == "__main__":
+    fire.Fire(summarize)
@@ -2,10 +2,258 @@ import fire
 import api.util as util
 import random
 import os
+import time
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+from api.match_store import MatchStore, DEFAULT_STORE_PATH
+from api.stopping import make_stopping_rule
+from api.profiling import MatchProfiler
+import api.tracing as tracing
+import api.metrics as metrics
+from api.classes import GameResult
 
 K = 32
 
-def play_game(agent_1_path, agent_2_path, game_path, num_matches = 1, save_results = True, show_state=False, agent_1_kwargs = {}, agent_2_kwargs = {}):
+@dataclass
+class MatchResult:
+    agent_1_score : float
+    agent_2_score : float
+    agent_1_seat : int = 0 # 0 if agent 1 was the game's first agent, 1 otherwise
+    duration : float = 0.0 # seconds
+    turns : int = 0 # number of agent decisions
+    seed : Optional[int] = None # the random module is seeded with this right before seating is decided, None if the match can't be replayed
+    actions : list = field(default_factory=list) # [agent_id, action_id, openended_response] for every decision, in order
+    metadata : dict = field(default_factory=dict) # class paths and kwargs needed to replay the match
+    pair_id : Optional[str] = None # shared by the two mirrored matches of a pair (see match_specs)
+
+class MatchRecorder:
+    """Observes every agent decision made during a match."""
+
+    def __init__(self, isolate_agent_rng : bool = True, profiler : Optional[MatchProfiler] = None):
+        self.turns = 0
+        self.actions = []
+        self.agents = [] # every agent the game created, in order
+        self.metrics = metrics.MatchMetrics()
+        self.isolate_agent_rng = isolate_agent_rng
+        self.profiler = profiler
+
+    def take_action(self, agent_class, agent, rules, observation, available_actions, show_state):
+        # Anything an agent (or a library it calls) draws from the random module would shift the
+        # game's random stream, and then replaying the recorded actions would diverge. Restoring the
+        # state afterwards keeps the game's stream a function of the seed and the actions alone.
+        with tracing.span("turn", turn=self.turns, agent_type_id=agent.agent_type_id, agent_id=agent.agent_id), metrics.acting(agent), \
+                self.profiler.phase("take_action") if self.profiler is not None else nullcontext():
+            state = random.getstate() if self.isolate_agent_rng else None
+            action = agent_class.take_action(agent, rules, observation, available_actions, show_state)
+            if state is not None:
+                random.setstate(state)
+            self.record_decision(agent, observation, available_actions, action)
+        return action
+
+    def play(self, game, seated_classes) -> Tuple[float, float]:
+        """Plays a game whose agents init_game created from seated_classes (first team first), calling
+        the agents' on_game_start and on_game_end hooks around it."""
+        state = random.getstate() if self.isolate_agent_rng else None
+        for agent in self.agents:
+            self.metrics.register(agent, seated_classes.index(type(agent)))
+            agent.on_game_start(game.rules, seated_classes.index(type(agent)))
+        if state is not None:
+            random.setstate(state)
+        scores = None
+        try:
+            scores = game.play()
+        finally:
+            for agent in self.agents:
+                seat = seated_classes.index(type(agent))
+                agent.on_game_end(GameResult(tuple(scores), seat) if scores is not None else None)
+        return scores
+
+    def record_decision(self, agent, observation, available_actions, action):
+        self.turns += 1
+        if action is None:
+            self.actions.append([agent.agent_id, None])
+        else:
+            self.actions.append([agent.agent_id, action.action_id, action.openended_response])
+
+def instrument_agent_class(agent_class, recorder : MatchRecorder):
+    """Returns a subclass of agent_class whose decisions go through recorder.
+    Games instantiate agents from the classes they are given, so this needs no changes to the games."""
+    def __init__(self, *args, **kwargs):
+        agent_class.__init__(self, *args, **kwargs)
+        recorder.agents.append(self)
+
+    def take_action(self, rules, observation, available_actions, show_state):
+        return recorder.take_action(agent_class, self, rules, observation, available_actions, show_state)
+
+    return type(agent_class.__name__, (agent_class,), {
+        "__init__": __init__,
+        "take_action": take_action,
+        "__module__": agent_class.__module__,
+        "__qualname__": agent_class.__qualname__,
+    })
+
+def play_match(agent_1_class, agent_2_class, game_class, show_state=False, agent_1_kwargs = {}, agent_2_kwargs = {}, seed = None, isolate_agent_rng = True, profile_dir = None, agent_1_seat = None, pair_id = None) -> MatchResult:
+    """Plays a single match with randomized seating, unless agent_1_seat is given. Given the same seed
+    and the same agent actions, the match plays out identically, which is what api.replay relies on.
+    With a profile_dir, the match is profiled (see api.profiling) and the profile is written there,
+    named by game, seed and agent 1's seat, since the two legs of a pair share their seed."""
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(32)
+    metadata = {
+        "game_path": util.class_path(game_class),
+        "agent_1_path": util.class_path(agent_1_class),
+        "agent_2_path": util.class_path(agent_2_class),
+        "agent_1_kwargs": agent_1_kwargs,
+        "agent_2_kwargs": agent_2_kwargs,
+    }
+    profiler = MatchProfiler() if profile_dir is not None else None
+    recorder = MatchRecorder(isolate_agent_rng, profiler)
+    recorder.metrics.game = game_class.id
+    agent_1_class = instrument_agent_class(agent_1_class, recorder)
+    agent_2_class = instrument_agent_class(agent_2_class, recorder)
+    if profiler is not None:
+        game_class = profiler.instrument_game_class(game_class)
+
+    with profiler if profiler is not None else nullcontext(), \
+            tracing.span("match", game=game_class.id, seed=seed, agent_1=agent_1_class.agent_type_id, agent_2=agent_2_class.agent_type_id) as match_span, \
+            metrics.collect(recorder.metrics):
+        start = time.perf_counter()
+        random.seed(seed)
+        # The seating coin is tossed even when the seat is given, so that the game's random stream is the
+        # same for a seed whatever the seating. That is what lets the two legs of a pair share their deals.
+        coin = random.choice([0,1])
+        agent_1_seat = coin if agent_1_seat is None else agent_1_seat
+        if agent_1_seat == 0:
+            game = game_class(show_state=show_state, agent_1_kwargs=agent_1_kwargs, agent_2_kwargs=agent_2_kwargs)
+            game.init_game(agent_1_class, agent_2_class)
+            player_1_score, player_2_score = recorder.play(game, [agent_1_class, agent_2_class])
+        else:
+            game = game_class(show_state=show_state, agent_1_kwargs=agent_2_kwargs, agent_2_kwargs=agent_1_kwargs)
+            game.init_game(agent_2_class, agent_1_class)
+            player_2_score, player_1_score = recorder.play(game, [agent_2_class, agent_1_class])
+        match_span.set(agent_1_seat=agent_1_seat, agent_1_score=player_1_score, agent_2_score=player_2_score, turns=recorder.turns)
+        duration = time.perf_counter() - start
+    metadata["metrics"] = recorder.metrics.summary()
+
+    if profiler is not None:
+        metadata["profile_path"] = os.path.join(profile_dir, f"{game_class.id}_{seed}_{agent_1_seat}.json")
+        profiler.save(metadata["profile_path"], game=game_class.id, seed=seed, agent_1_seat=agent_1_seat, turns=recorder.turns, **{k: metadata[k] for k in ("agent_1_path", "agent_2_path")})
+    if not isolate_agent_rng:
+        # Other games drew from the same random stream, so the seed and actions don't reproduce this one.
+        seed = None
+    return MatchResult(player_1_score, player_2_score, agent_1_seat, duration, recorder.turns, seed, recorder.actions, metadata, pair_id)
+
+def record_match(store : MatchStore, game_id, agent_1_id, agent_2_id, result : MatchResult) -> int:
+    return store.append(
+        game_id,
+        agent_1_id,
+        result.agent_1_score,
+        agent_2_id,
+        result.agent_2_score,
+        agent_1_seat=result.agent_1_seat,
+        duration=result.duration,
+        turns=result.turns,
+        seed=result.seed,
+        metadata=result.metadata,
+        actions=result.actions,
+        pair_id=result.pair_id,
+    )
+
+def match_specs(num_matches, paired = False) -> list[dict]:
+    """Keyword arguments for play_match, one dict per match. Paired matches come as consecutive specs
+    that share a seed and a pair_id, with agent 1 in the first seat and then in the second, so seat
+    advantage and the luck of the deal cancel out within a pair. num_matches is rounded up to whole pairs."""
+    if not paired:
+        return [{} for _ in range(num_matches)]
+    specs = []
+    for _ in range((num_matches + 1) // 2):
+        seed = random.SystemRandom().getrandbits(32)
+        pair_id = uuid.uuid4().hex
+        specs.append({"seed": seed, "agent_1_seat": 0, "pair_id": pair_id})
+        specs.append({"seed": seed, "agent_1_seat": 1, "pair_id": pair_id})
+    return specs
+
+def may_start(spec, stop) -> bool:
+    # Once stop is set no new match is started, except for the second leg of a pair that has started.
+    return stop is None or not stop.is_set() or (spec.get("pair_id") is not None and spec.get("agent_1_seat") == 1)
+
+# Set once per worker process by _init_worker so that classes are only imported once.
+_worker_match_args = None
+_worker_profile_dir = None
+
+def _init_worker(agent_1_path, agent_2_path, game_path, show_state, agent_1_kwargs, agent_2_kwargs, profile_dir):
+    global _worker_match_args, _worker_profile_dir
+    # Forked workers inherit the parent's random state, so reseed to avoid identical matches.
+    random.seed()
+    _worker_match_args = (
+        util.import_class(agent_1_path),
+        util.import_class(agent_2_path),
+        util.import_class(game_path),
+        show_state,
+        agent_1_kwargs,
+        agent_2_kwargs,
+    )
+    _worker_profile_dir = profile_dir
+
+def _play_worker_match(spec):
+    return play_match(*_worker_match_args, profile_dir=_worker_profile_dir, **spec)
+
+def iter_matches(agent_1_path, agent_2_path, game_path, num_matches = 1, show_state=False, agent_1_kwargs = {}, agent_2_kwargs = {}, workers = 1, concurrency = 1, stop = None, profile_dir = None, paired = False):
+    """Yields a MatchResult for each match as it finishes.
+    With workers > 1 the matches are spread across a process pool. Otherwise, with concurrency > 1
+    up to that many matches are interleaved on one event loop in this process.
+    With paired, matches are played in mirrored pairs (see match_specs).
+    Once the optional threading.Event stop is set no new matches are started, but the results of
+    matches that are already being played (and of the second legs of their pairs) are still yielded."""
+    specs = match_specs(num_matches, paired)
+    if profile_dir is not None and workers <= 1 and concurrency > 1:
+        # The sampler could follow each game thread, but tracemalloc can't tell concurrent matches apart.
+        raise ValueError("Profiling can't be combined with concurrency > 1, use workers instead")
+    if paired and workers <= 1 and concurrency > 1:
+        # Concurrent games share the random module, so the two legs wouldn't get the same deal.
+        raise ValueError("paired can't be combined with concurrency > 1, use workers instead")
+    if workers <= 1:
+        agent_1_class = util.import_class(agent_1_path)
+        agent_2_class = util.import_class(agent_2_path)
+        game_class = util.import_class(game_path)
+        if concurrency > 1:
+            import api.async_play as async_play
+            yield from async_play.iter_matches(agent_1_class, agent_2_class, game_class, len(specs), concurrency, show_state, agent_1_kwargs, agent_2_kwargs, stop, specs)
+            return
+        for spec in specs:
+            if not may_start(spec, stop):
+                return
+            yield play_match(agent_1_class, agent_2_class, game_class, show_state, agent_1_kwargs, agent_2_kwargs, profile_dir=profile_dir, **spec)
+        return
+
+    initargs = (agent_1_path, agent_2_path, game_path, show_state, agent_1_kwargs, agent_2_kwargs, profile_dir)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as executor:
+        # Only keep as many matches in flight as there are workers, so stopping early wastes nothing.
+        pending = set()
+        started = 0
+        while True:
+            while started < len(specs) and len(pending) < workers and may_start(specs[started], stop):
+                pending.add(executor.submit(_play_worker_match, specs[started]))
+                started += 1
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+def play_game(agent_1_path, agent_2_path, game_path, num_matches = 1, save_results = True, show_state=False, agent_1_kwargs = {}, agent_2_kwargs = {}, workers = 1, concurrency = 1, store_path = DEFAULT_STORE_PATH, stopping_rule = None, stopping_kwargs = {}, profile = False, profile_dir = "profiles", trace = None, paired = False):
+    """Plays num_matches matches between the two agents. With a stopping_rule ("wilson" or "sprt", see
+    api.stopping) num_matches is only an upper bound: no new matches are started once the rule is satisfied.
+    With paired, every seed is played twice with the seats swapped (see match_specs) and the stopping
+    rule sees the mean score of each pair.
+    With profile, every match is profiled and a JSON profile per match is written to profile_dir.
+    With trace, spans for every match, turn and LLM request are appended to that JSONL file (see api.tracing)."""
+    if trace:
+        tracing.enable(trace)
     agent_1_class = util.import_class(agent_1_path)
     agent_2_class = util.import_class(agent_2_path)
     agent_1_id = agent_1_class.agent_type_id
@@ -35,18 +283,14 @@ def play_game(agent_1_path, agent_2_path, game_path, num_matches = 1, save_resul
     #print(f"{agent_2_id} elo: ", agent_2_rating)
 
     # Get historical win percentage
-    matches = util.load_json("matches.json")
-    agent_1_total = 0
-    total_matches = 0
-    for m in matches:
-        if m["game"] == game_class.id and agent_1_id in m and agent_2_id in m:
-            agent_1_total += m[agent_1_id]
-            total_matches += 1
-
-    if total_matches > 0:
-        print(f"Historical average scores for these two agents across {num_matches} matches:")
-        print(f'{agent_1_id} avg score: ', agent_1_total/num_matches)
-        print(f'{agent_2_id} avg score: ', 1 - agent_1_total / num_matches)
+    store = MatchStore(store_path)
+    history = store.records(game_class.id, (agent_1_id, agent_2_id))
+    if len(history) > 0:
+        agent_1_total = sum(m["agent_1_score"] if m["agent_1"] == agent_1_id else m["agent_2_score"] for m in history)
+        agent_2_total = sum(m["agent_2_score"] if m["agent_1"] == agent_1_id else m["agent_1_score"] for m in history)
+        print(f"Historical average scores for these two agents across {len(history)} matches:")
+        print(f'{agent_1_id} avg score: ', agent_1_total / len(history))
+        print(f'{agent_2_id} avg score: ', agent_2_total / len(history))
 
     #Q1 = 10**(agent_1_rating / 400)
     #Q2 = 10**(agent_2_rating / 400)
@@ -54,33 +298,36 @@ def play_game(agent_1_path, agent_2_path, game_path, num_matches = 1, save_resul
     #agent_1_expected_score = Q1 / (Q1 + Q2)
     #agent_2_expected_score = Q2 / (Q1 + Q2)
 
-    for _ in range(num_matches):
-        if random.choice([0,1]):
-            game = game_class(show_state=show_state, agent_1_kwargs=agent_1_kwargs, agent_2_kwargs=agent_2_kwargs)
-            game.init_game(agent_1_class, agent_2_class)
-            player_1_score, player_2_score = game.play()
-        else:
-            game = game_class(show_state=show_state, agent_1_kwargs=agent_2_kwargs, agent_2_kwargs=agent_1_kwargs)
-            game.init_game(agent_2_class, agent_1_class)
-            player_2_score, player_1_score = game.play()
+    rule = make_stopping_rule(stopping_rule, paired, **stopping_kwargs) if stopping_rule else None
+    stop = threading.Event()
+    matches_played = 0
+    first_legs = {}
 
+    for result in iter_matches(agent_1_path, agent_2_path, game_path, num_matches, show_state, agent_1_kwargs, agent_2_kwargs, workers, concurrency, stop, profile_dir if profile else None, paired):
+        player_1_score, player_2_score = result.agent_1_score, result.agent_2_score
         print(f"{agent_1_id} score: ", player_1_score)
         print(f"{agent_2_id} score: ", player_2_score)
+        if "profile_path" in result.metadata:
+            print("Profile written to", result.metadata["profile_path"])
 
         player_1_total += player_1_score
         player_2_total += player_2_score
+        matches_played += 1
+
+        if rule is not None:
+            if result.pair_id is None:
+                rule.update(player_1_score)
+            elif result.pair_id in first_legs:
+                # The legs of a pair are correlated, so together they are one observation.
+                rule.update((first_legs.pop(result.pair_id) + player_1_score) / 2)
+            else:
+                first_legs[result.pair_id] = player_1_score
+            if not stop.is_set() and rule.should_stop():
+                print(f"Stopping rule satisfied after {matches_played} matches, not starting any more")
+                stop.set()
 
         if save_results:
-            matches = []
-            matches.append(
-                {
-                    "game": game_class.id,
-                    agent_1_id: player_1_score,
-                    agent_2_id: player_2_score,
-                }
-            )
-            util.save_json(matches, f"runs/gamebench/{game_class.id}/{agent_1_id}_{agent_2_id}.json")
-            # util.save_json(matches, f"{game_class.id}.{agent_1_id}.{agent_2_id}.json")
+            record_match(store, game_class.id, agent_1_id, agent_2_id, result)
             print("Saved match information")
 
             #agent_1_rating = agent_1_rating + K * (player_1_score - agent_1_expected_score)
@@ -95,8 +342,10 @@ def play_game(agent_1_path, agent_2_path, game_path, num_matches = 1, save_resul
             #util.save_json(all_ratings, "elo_ratings.json")
 
     print("")
-    print(f"Agent 1 ({agent_1_id}) average score: ", player_1_total/num_matches)
-    print(f"Agent 2 ({agent_2_id}) average score: ", player_2_total/num_matches)
+    print(f"Agent 1 ({agent_1_id}) average score: ", player_1_total/matches_played)
+    print(f"Agent 2 ({agent_2_id}) average score: ", player_2_total/matches_played)
+    if rule is not None:
+        print(rule.report())
 
 if __name__ == "__main__":
     os.environ["AZURE_OPENAI_ENDPOINT"] = "<api_endpoint>"
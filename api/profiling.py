@@ -0,0 +1,166 @@
+import fire
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+# Everything that happens during a match is attributed to one of these phases. Time spent in the game
+# outside of get_observation, update and the agents (move generation, rendering, scoring...) is "engine".
+PHASES = ["engine", "get_observation", "update", "take_action"]
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    parts = os.path.normpath(code.co_filename).split(os.sep)
+    return f"{code.co_name} ({'/'.join(parts[-2:])}:{code.co_firstlineno})"
+
+class MatchProfiler:
+    """Profiles a single match: a background thread samples the match thread's stack every interval
+    seconds, and tracemalloc tracks memory. Wall time, net allocations and samples are all attributed
+    to the innermost phase that was active."""
+
+    def __init__(self, interval : float = 0.005, trace_memory : bool = True, top : int = 25):
+        self.interval = interval
+        self.trace_memory = trace_memory
+        self.top = top
+        self.phases = {phase: {"calls": 0, "time": 0.0, "net_alloc_bytes": 0, "samples": 0} for phase in PHASES}
+        self.stacks = Counter() # "phase;outermost frame;...;innermost frame" -> samples
+        self._stack = ["engine"]
+        self._started_tracemalloc = False
+        self._stop = threading.Event()
+
+    def _now(self):
+        return time.perf_counter(), tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+
+    def _switch(self):
+        # Charges everything since the last phase change to the phase on top of the stack.
+        now, memory = self._now()
+        stats = self.phases[self._stack[-1]]
+        stats["time"] += now - self._last_time
+        stats["net_alloc_bytes"] += memory - self._last_memory
+        self._last_time, self._last_memory = now, memory
+
+    @contextmanager
+    def phase(self, name : str):
+        self._switch()
+        self._stack.append(name)
+        self.phases[name]["calls"] += 1
+        try:
+            yield
+        finally:
+            self._switch()
+            self._stack.pop()
+
+    def instrument_game_class(self, game_class):
+        """Returns a subclass of game_class whose get_observation and update are attributed to their own phases."""
+        profiler = self
+
+        def get_observation(self, *args, **kwargs):
+            with profiler.phase("get_observation"):
+                return game_class.get_observation(self, *args, **kwargs)
+
+        def update(self, *args, **kwargs):
+            with profiler.phase("update"):
+                return game_class.update(self, *args, **kwargs)
+
+        return type(game_class.__name__, (game_class,), {
+            "get_observation": get_observation,
+            "update": update,
+            "__module__": game_class.__module__,
+            "__qualname__": game_class.__qualname__,
+        })
+
+    def _sample(self, thread_id):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            phase = self._stack[-1]
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            self.phases[phase]["samples"] += 1
+            self.stacks[";".join([phase] + labels[::-1])] += 1
+
+    def start(self):
+        """Starts profiling the calling thread."""
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            tracemalloc.reset_peak()
+            self._start_snapshot = tracemalloc.take_snapshot()
+        self.phases["engine"]["calls"] = 1
+        self._start_time = time.perf_counter()
+        self._last_time, self._last_memory = self._now()
+        self._sampler = threading.Thread(target=self._sample, args=(threading.get_ident(),), daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._switch()
+        self._stop.set()
+        self._sampler.join()
+        self.duration = time.perf_counter() - self._start_time
+        self.peak_bytes = None
+        self.top_allocations = []
+        if self.trace_memory:
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+            end_snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            self.top_allocations = [
+                {"location": str(stat.traceback[0]), "size_diff": stat.size_diff, "count_diff": stat.count_diff}
+                for stat in end_snapshot.compare_to(self._start_snapshot, "lineno")[:self.top]
+            ]
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+
+    # As a context manager, profiling stops even when the match raises, so that a pooled worker isn't
+    # left sampling and tracing memory in later matches.
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def top_functions(self) -> dict:
+        """The functions most often seen on top of the stack, per phase."""
+        counts = {phase: Counter() for phase in PHASES}
+        for stack, samples in self.stacks.items():
+            frames = stack.split(";")
+            counts[frames[0]][frames[-1]] += samples
+        return {phase: counts[phase].most_common(self.top) for phase in PHASES}
+
+    def report(self) -> dict:
+        return {
+            "duration": self.duration,
+            "interval": self.interval,
+            "phases": self.phases,
+            "peak_bytes": self.peak_bytes,
+            "top_functions": self.top_functions(),
+            "top_allocations": self.top_allocations,
+            "stacks": dict(self.stacks), # collapsed stacks, e.g. for flamegraph.pl
+        }
+
+    def save(self, path : str, **info):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({**info, **self.report()}, f, indent=4)
+
+def summarize(*paths):
+    """Prints the per-phase breakdown of one or more profile artifacts, e.g. `python api/profiling.py profiles/*.json`."""
+    for path in paths:
+        with open(path) as f:
+            profile = json.load(f)
+        print(f"{path}: {profile.get('game')} seed {profile.get('seed')}, {profile['duration']:.3f}s")
+        for phase, stats in profile["phases"].items():
+            share = stats["time"] / profile["duration"] if profile["duration"] else 0
+            print(f"    {phase:<16} {stats['calls']:>7} calls {stats['time']:>9.3f}s ({share:6.1%}) {stats['net_alloc_bytes'] / 1e6:>9.2f} MB net {stats['samples']:>7} samples")
+        if profile.get("peak_bytes") is not None:
+            print(f"    peak traced memory {profile['peak_bytes'] / 1e6:.2f} MB")
+
+if __name__ == "__main__":
+    fire.Fire(summarize)
@@ -0,0 +1,102 @@
+import fire
+import api.util as util
+import json
+import subprocess
+import sys
+from dataclasses import dataclass
+from api.classes import Rules
+
+@dataclass(frozen=True)
+class GameSpec:
+    """Static metadata about a game, available without importing its engine."""
+    id : str # same as the game class's id
+    class_path : str
+    title : str
+    num_teams : int = 2
+    agents_per_team : int = 1 # how many instances of each team's agent class the game creates
+    in_paper : bool = True # whether the game is part of the published results (rating.games)
+
+    def load(self):
+        """Imports and returns the game class."""
+        return util.import_class(self.class_path)
+
+    @property
+    def rules(self) -> Rules:
+        # The rules live on the game class, so this is the one piece of metadata that needs an import.
+        return self.load().rules
+
+GAMES = [
+    GameSpec("air_land_sea", "games.air_land_sea.game.AirLandSea", "Air Land and Sea"),
+    GameSpec("arctic_scavengers", "games.arctic_scavengers.arctic_scavengers.ArcticScavengers", "Arctic Scavengers"),
+    GameSpec("are_you_the_traitor", "games.are_you_the_traitor.aytt.AreYouTheTraitor", "Are you the traitor?"),
+    GameSpec("codenames", "games.codenames.game.CodenamesGame", "Codenames", agents_per_team=2),
+    GameSpec("hive", "games.hive.game.HiveGame", "Hive"),
+    GameSpec("pit", "games.pit.pit.PitGame", "Pit"),
+    GameSpec("santorini", "games.santorini.santorini.Santorini", "Santorini"),
+    GameSpec("sea_battle", "games.sea_battle.SeaBattle", "Sea Battle", agents_per_team=3),
+    GameSpec("two_rooms_and_a_boom", "games.two_rooms_and_a_boom.two_rooms.TwoRoomsAndaBoom", "Two Rooms and a Boom"),
+    GameSpec("tic_tac_toe", "games.tic_tac_toe.TicTacToe", "Tic Tac Toe", in_paper=False),
+]
+
+games = {spec.id: spec for spec in GAMES}
+
+def get(game_id : str) -> GameSpec:
+    if game_id not in games:
+        raise ValueError(f"Unknown game {game_id}, expected one of {list(games)}")
+    return games[game_id]
+
+def paper_games() -> list[GameSpec]:
+    return [spec for spec in GAMES if spec.in_paper]
+
+def list_games():
+    """Prints the registered games. Nothing is imported to do so."""
+    for spec in GAMES:
+        print(f"{spec.id:<22} {spec.title:<22} {spec.num_teams} teams x {spec.agents_per_team} agents  {spec.class_path}")
+
+# Run in a fresh interpreter by cold_start, so that nothing is already imported.
+_COLD_START_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import api.util as util
+game_class = util.import_class(sys.argv[1])
+imported = time.perf_counter()
+from agents.random_agent import RandomAgent
+agents_imported = time.perf_counter()
+game = game_class()
+game.init_game(RandomAgent, RandomAgent)
+initialized = time.perf_counter()
+print(json.dumps({
+    "import_seconds": imported - start,
+    "init_game_seconds": initialized - agents_imported,
+    "modules": len(sys.modules),
+}))
+"""
+
+def cold_start(game_ids = None, repeat = 3):
+    """Measures, in a fresh interpreter per game, how long importing the game class and setting up a
+    first game take. Reports the best of repeat runs."""
+    if game_ids is None:
+        game_ids = list(games)
+    elif isinstance(game_ids, str):
+        game_ids = [game_ids]
+
+    results = {}
+    print(f"{'game':<22} {'import ms':>10} {'init_game ms':>13} {'modules':>8}")
+    for game_id in game_ids:
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run(
+                [sys.executable, "-c", _COLD_START_SCRIPT, get(game_id).class_path],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        best = min(runs, key=lambda r: r["import_seconds"] + r["init_game_seconds"])
+        results[game_id] = best
+        print(f"{game_id:<22} {best['import_seconds'] * 1e3:>10.1f} {best['init_game_seconds'] * 1e3:>13.1f} {best['modules']:>8}")
+    return results
+
+def _cold_start_cli(game_ids = None, repeat = 3):
+    cold_start(game_ids, repeat)
+
+if __name__ == "__main__":
+    fire.Fire({"list": list_games, "cold_start": _cold_start_cli})
@@ -0,0 +1,85 @@
+import fire
+import api.util as util
+import time
+from api.classes import Action
+from api.match_store import MatchStore, DEFAULT_STORE_PATH
+from api.play_game import MatchResult, play_match
+
+class ReplayDivergence(Exception):
+    """Raised when a replayed match stops following its recording, e.g. because the engine changed."""
+
+def replay_agent_class(agent_class, actions):
+    """Returns a subclass of agent_class that plays back the recorded actions instead of deciding.
+    actions is an iterator shared by every agent in the match, since the recording interleaves them."""
+    def take_action(self, rules, observation, available_actions, show_state):
+        try:
+            agent_id, *action = next(actions)
+        except StopIteration:
+            raise ReplayDivergence("The game asked for more actions than were recorded")
+        if agent_id != self.agent_id:
+            raise ReplayDivergence(f"Expected agent {agent_id} to act, but agent {self.agent_id} was asked")
+        # [agent_id, None] is an agent that returned None rather than an Action.
+        if action == [None]:
+            return None
+        action_id, openended_response = action
+        return Action(action_id=action_id, openended_response=openended_response)
+
+    return type(agent_class.__name__, (agent_class,), {
+        "take_action": take_action,
+        "__module__": agent_class.__module__,
+        "__qualname__": agent_class.__qualname__,
+    })
+
+def replay_match(store : MatchStore, match_id : int, show_state = False) -> MatchResult:
+    """Feeds a recorded match's actions back through the game engine, without running the agents."""
+    record = store.record(match_id)
+    actions = store.actions(match_id)
+    if record is None or actions is None or record["seed"] is None:
+        raise ValueError(f"Match {match_id} was not recorded with a seed and action stream")
+
+    metadata = record["metadata"]
+    recorded = iter(actions)
+    result = play_match(
+        replay_agent_class(util.import_class(metadata["agent_1_path"]), recorded),
+        replay_agent_class(util.import_class(metadata["agent_2_path"]), recorded),
+        util.import_class(metadata["game_path"]),
+        show_state,
+        metadata.get("agent_1_kwargs", {}),
+        metadata.get("agent_2_kwargs", {}),
+        seed=record["seed"],
+        agent_1_seat=record["agent_1_seat"],
+    )
+
+    if next(recorded, None) is not None:
+        raise ReplayDivergence(f"Match {match_id} ended before all recorded actions were used")
+    if (result.agent_1_score, result.agent_2_score) != (record["agent_1_score"], record["agent_2_score"]):
+        raise ReplayDivergence(
+            f"Match {match_id} replayed to {result.agent_1_score} - {result.agent_2_score}, "
+            f"but was recorded as {record['agent_1_score']} - {record['agent_2_score']}"
+        )
+    return result
+
+def replay(match_ids = None, game = None, store_path = DEFAULT_STORE_PATH, repeat = 1, show_state = False):
+    """Replays the given matches (or every replayable match, optionally of one game) repeat times and
+    reports engine throughput. Useful to benchmark engine changes against real recorded games."""
+    store = MatchStore(store_path)
+    if match_ids is None:
+        match_ids = store.replayable_ids(game)
+    elif isinstance(match_ids, int):
+        match_ids = [match_ids]
+
+    turns = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for match_id in match_ids:
+            result = replay_match(store, match_id, show_state)
+            turns += result.turns
+    elapsed = time.perf_counter() - start
+
+    n_matches = len(match_ids) * repeat
+    print(f"Replayed {n_matches} matches ({turns} turns) in {elapsed:.3f}s")
+    if n_matches > 0 and elapsed > 0:
+        print(f"{n_matches / elapsed:.1f} matches/s, {turns / elapsed:.1f} turns/s")
+
+if __name__ == "__main__":
+    fire.Fire(replay)
@@ -0,0 +1,111 @@
+import math
+from abc import ABC, abstractmethod
+from statistics import NormalDist
+
+# Sequential stopping rules for a single matchup. Each rule sees agent 1's score after every match
+# (clipped to [0, 1], so ties count as 0.5) and decides when enough matches have been played. With
+# paired matches, each observation is instead the mean score over the two legs of a pair.
+
+def wilson_interval(total_score : float, n : int, confidence : float = 0.95) -> tuple[float, float]:
+    """Wilson score interval for agent 1's mean score after n matches."""
+    if n == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = total_score / n
+    denominator = 1 + z**2 / n
+    center = (p + z**2 / (2 * n)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / denominator
+    return center - half_width, center + half_width
+
+class StoppingRule(ABC):
+    def __init__(self):
+        self.n = 0
+        self.total_score = 0.0
+        self.paired = False # each observation is a pair of mirrored matches
+
+    def observations(self) -> str:
+        return f"{self.n} pairs ({2 * self.n} matches)" if self.paired else f"{self.n} matches"
+
+    def update(self, agent_1_score : float):
+        self.n += 1
+        self.total_score += min(max(agent_1_score, 0.0), 1.0)
+
+    @abstractmethod
+    def should_stop(self) -> bool:
+        pass
+
+    @abstractmethod
+    def report(self) -> str:
+        pass
+
+class WilsonStopping(StoppingRule):
+    """Stops once the Wilson interval on agent 1's mean score is at most 2 * precision wide."""
+
+    def __init__(self, precision : float = 0.1, confidence : float = 0.95, min_matches : int = 10):
+        super().__init__()
+        self.precision = precision
+        self.confidence = confidence
+        self.min_matches = min_matches
+
+    def should_stop(self) -> bool:
+        low, high = wilson_interval(self.total_score, self.n, self.confidence)
+        return self.n >= self.min_matches and (high - low) / 2 <= self.precision
+
+    def report(self) -> str:
+        low, high = wilson_interval(self.total_score, self.n, self.confidence)
+        mean = self.total_score / self.n if self.n else float("nan")
+        reached = "reached" if (high - low) / 2 <= self.precision else "not reached"
+        return (
+            f"Wilson interval (precision={self.precision}, confidence={self.confidence}, min_matches={self.min_matches}): "
+            f"agent 1 mean score {mean:.3f}, {self.confidence:.0%} interval [{low:.3f}, {high:.3f}] "
+            f"(half-width {(high - low) / 2:.3f}, target {reached}) after {self.observations()}"
+        )
+
+class SPRTStopping(StoppingRule):
+    """Wald's sequential probability ratio test of H0: agent 1's expected score is p0 against
+    H1: it is p1. Fractional scores enter the log-likelihood ratio as fractional wins."""
+
+    def __init__(self, p0 : float = 0.4, p1 : float = 0.6, alpha : float = 0.05, beta : float = 0.05, min_matches : int = 1):
+        super().__init__()
+        self.p0 = p0
+        self.p1 = p1
+        self.alpha = alpha
+        self.beta = beta
+        self.min_matches = min_matches
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        self.llr = 0.0
+
+    def update(self, agent_1_score : float):
+        super().update(agent_1_score)
+        score = min(max(agent_1_score, 0.0), 1.0)
+        self.llr += score * math.log(self.p1 / self.p0) + (1 - score) * math.log((1 - self.p1) / (1 - self.p0))
+
+    def should_stop(self) -> bool:
+        return self.n >= self.min_matches and not self.lower < self.llr < self.upper
+
+    def report(self) -> str:
+        if self.llr >= self.upper:
+            decision = f"accepted H1 (agent 1 scores {self.p1}), error rate at most {self.alpha}"
+        elif self.llr <= self.lower:
+            decision = f"accepted H0 (agent 1 scores {self.p0}), error rate at most {self.beta}"
+        else:
+            decision = "no decision"
+        mean = self.total_score / self.n if self.n else float("nan")
+        return (
+            f"SPRT (p0={self.p0}, p1={self.p1}, alpha={self.alpha}, beta={self.beta}): "
+            f"LLR {self.llr:.3f} with bounds [{self.lower:.3f}, {self.upper:.3f}], {decision}; "
+            f"agent 1 mean score {mean:.3f} after {self.observations()}"
+        )
+
+stopping_rules = {
+    "wilson": WilsonStopping,
+    "sprt": SPRTStopping,
+}
+
+def make_stopping_rule(name : str, paired : bool = False, **kwargs) -> StoppingRule:
+    if name not in stopping_rules:
+        raise ValueError(f"Unknown stopping rule {name}, expected one of {list(stopping_rules)}")
+    rule = stopping_rules[name](**kwargs)
+    rule.paired = paired
+    return rule
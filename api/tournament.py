@@ -0,0 +1,187 @@
+import fire
+import api.util as util
+import itertools
+import json
+import os
+import random
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from api.play_game import MatchResult, play_match, record_match
+from api.match_store import MatchStore, DEFAULT_STORE_PATH
+
+# A manifest describes a grid of agents x games x match counts, for example:
+# {
+#     "agents": {
+#         "random": "agents.random_agent.RandomAgent",
+#         "gpt-4": {"path": "agents.gpt.GPT4", "kwargs": {"max_retries": 3}}
+#     },
+#     "games": {
+#         "sea_battle": "games.sea_battle.SeaBattle",
+#         "hive": {"path": "games.hive.game.HiveGame", "num_matches": 5}
+#     },
+#     "num_matches": 10,
+#     "pairs": [["gpt-4", "random"]]  # optional, defaults to every pair of distinct agents
+# }
+
+@dataclass(frozen=True)
+class Job:
+    game : str # manifest key of the game
+    agent_1 : str # manifest key of the first agent
+    agent_2 : str # manifest key of the second agent
+    num_matches : int
+
+    @property
+    def id(self):
+        return f"{self.game}/{self.agent_1}_{self.agent_2}"
+
+def _spec(spec):
+    # Agents and games can be given either as a bare class path or as a dict with a "path" key.
+    return {"path": spec} if isinstance(spec, str) else spec
+
+def expand_jobs(manifest) -> list[Job]:
+    agents = manifest["agents"]
+    games = {key: _spec(spec) for key, spec in manifest["games"].items()}
+    pairs = manifest.get("pairs") or list(itertools.combinations(agents, 2))
+    for pair in pairs:
+        for agent in pair:
+            if agent not in agents:
+                raise ValueError(f"Pair {pair} references unknown agent {agent}")
+
+    return [
+        Job(game, agent_1, agent_2, spec.get("num_matches", manifest.get("num_matches", 1)))
+        for game, spec in games.items()
+        for agent_1, agent_2 in pairs
+    ]
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {"id": uuid.uuid4().hex, "jobs": {}}
+    state = util.load_json(state_path)
+    state.setdefault("id", uuid.uuid4().hex)
+    return state
+
+def save_state(state, state_path):
+    # Write to a temporary file first so an interrupted run never leaves a truncated state file behind.
+    os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_path, state_path)
+
+def stored_progress(store : MatchStore, tournament_id : str, job : Job, game_id : str, agent_1_id : str, agent_2_id : str) -> dict:
+    """The progress of job according to the matches in the store. Each match is tagged with the
+    tournament and job when it is stored, so the match and the progress marker are one write, and a
+    crash can't leave a match stored but not counted."""
+    tag = {"id": tournament_id, "job": job.id}
+    records = [record for record in store.records(game_id, (agent_1_id, agent_2_id)) if record["metadata"].get("tournament") == tag]
+    return {
+        "completed": len(records),
+        "totals": [sum(record["agent_1_score"] for record in records), sum(record["agent_2_score"] for record in records)],
+    }
+
+def _play_job_match(agent_1_path, agent_2_path, game_path, show_state, agent_1_kwargs, agent_2_kwargs):
+    # import_class goes through importlib, so each worker only imports a class the first time it sees it.
+    return play_match(
+        util.import_class(agent_1_path),
+        util.import_class(agent_2_path),
+        util.import_class(game_path),
+        show_state,
+        agent_1_kwargs,
+        agent_2_kwargs,
+    )
+
+def run_tournament(manifest_path, state_path = None, workers = 1, show_state = False, save_results = True, store_path = DEFAULT_STORE_PATH, ratings_every = 0):
+    """Plays every job in the manifest. An interrupted tournament picks up where it stopped when run
+    again with the same state file. With save_results, progress is counted from the matches in the
+    store (see stored_progress) and state_path only keeps the tournament's id and a copy of the
+    progress. Otherwise the progress is recorded in state_path after each match.
+    With ratings_every, the overall Bradley-Terry standings of every agent in the store are printed
+    every that many matches and at the end (see rating.OnlineRatings)."""
+    manifest = util.load_json(manifest_path)
+    state_path = state_path or os.path.splitext(manifest_path)[0] + ".state.json"
+    state = load_state(state_path)
+    agents = {key: _spec(spec) for key, spec in manifest["agents"].items()}
+    games = {key: _spec(spec) for key, spec in manifest["games"].items()}
+    jobs = expand_jobs(manifest)
+    store = MatchStore(store_path)
+
+    # One entry per match that still needs to be played.
+    pending = []
+    ids = {}
+    for job in jobs:
+        agent_1, agent_2 = agents[job.agent_1], agents[job.agent_2]
+        # The ids the store uses.
+        ids[job.id] = (
+            util.import_class(games[job.game]["path"]).id,
+            util.import_class(agent_1["path"]).agent_type_id,
+            util.import_class(agent_2["path"]).agent_type_id,
+        )
+        progress = state["jobs"].setdefault(job.id, {"completed": 0, "totals": [0, 0]})
+        if save_results:
+            progress.update(stored_progress(store, state["id"], job, *ids[job.id]))
+        match_args = (
+            agent_1["path"],
+            agent_2["path"],
+            games[job.game]["path"],
+            show_state,
+            agent_1.get("kwargs", {}),
+            agent_2.get("kwargs", {}),
+        )
+        pending += [(job, match_args)] * max(0, job.num_matches - progress["completed"])
+    save_state(state, state_path)
+
+    done = sum(job.num_matches for job in jobs) - len(pending)
+    print(f"{len(jobs)} jobs, {done} matches already played, {len(pending)} remaining")
+
+    ratings = None
+    if ratings_every:
+        # Imported here so that running a tournament doesn't need the rating dependencies otherwise.
+        from rating import OnlineRatings
+        ratings = OnlineRatings()
+        ratings.sync(store)
+    played = 0
+
+    def finish(job, match_args, result : MatchResult):
+        nonlocal played
+        played += 1
+        progress = state["jobs"][job.id]
+        progress["completed"] += 1
+        progress["totals"][0] += result.agent_1_score
+        progress["totals"][1] += result.agent_2_score
+        game_id, agent_1_id, agent_2_id = ids[job.id]
+        if save_results:
+            result.metadata["tournament"] = {"id": state["id"], "job": job.id}
+            record_match(store, game_id, agent_1_id, agent_2_id, result)
+        save_state(state, state_path)
+        print(f"[{progress['completed']}/{job.num_matches}] {job.id}: {result.agent_1_score} - {result.agent_2_score}")
+        if ratings is not None:
+            if save_results:
+                ratings.sync(store)
+            else:
+                ratings.add(game_id, agent_1_id, result.agent_1_score, agent_2_id, result.agent_2_score)
+            if played % ratings_every == 0 and "all" in ratings.points:
+                print(ratings.report())
+
+    if workers <= 1:
+        for job, match_args in pending:
+            finish(job, match_args, _play_job_match(*match_args))
+    else:
+        # Forked workers inherit the parent's random state, so reseed each of them.
+        with ProcessPoolExecutor(max_workers=workers, initializer=random.seed) as executor:
+            futures = {executor.submit(_play_job_match, *match_args): (job, match_args) for job, match_args in pending}
+            for future in as_completed(futures):
+                finish(*futures[future], future.result())
+
+    print("")
+    for job in jobs:
+        progress = state["jobs"][job.id]
+        if progress["completed"] > 0:
+            averages = [total / progress["completed"] for total in progress["totals"]]
+            print(f"{job.id}: {job.agent_1} avg score {averages[0]:.3f}, {job.agent_2} avg score {averages[1]:.3f} over {progress['completed']} matches")
+    if ratings is not None and "all" in ratings.points:
+        print("")
+        print(ratings.report())
+
+if __name__ == "__main__":
+    fire.Fire(run_tournament)
@@ -0,0 +1,148 @@
+import contextvars
+import fire
+import itertools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Optional
+
+# Nested spans (match -> turn -> take_action -> llm_request, plus the RAP/MCTS internals) written as one
+# JSON object per line. Tracing is off unless the GAMEBENCH_TRACE environment variable names a trace
+# file; it is an environment variable so that process pool workers pick it up as well.
+TRACE_ENV = "GAMEBENCH_TRACE"
+
+# Children copy these attributes from their parent unless they set them themselves, so every span
+# can be filtered by game, agent or turn on its own.
+INHERITED = ("game", "seed", "agent_type_id", "turn")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_files = {}
+
+class Span:
+    def __init__(self, name : str, parent : Optional["Span"], attrs : dict):
+        self.name = name
+        self.id = f"{os.getpid()}-{next(_ids)}"
+        self.parent_id = parent.id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else self.id
+        self.attrs = {key: parent.attrs[key] for key in INHERITED if parent is not None and key in parent.attrs}
+        self.attrs.update(attrs)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, key : str, value : float = 1):
+        """Increments a numeric attribute, e.g. token counts summed over a turn's requests."""
+        self.attrs[key] = self.attrs.get(key, 0) + value
+
+class _NoopSpan:
+    def set(self, **attrs):
+        pass
+
+    def add(self, key, value = 1):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+def trace_path() -> Optional[str]:
+    return os.environ.get(TRACE_ENV)
+
+def enable(path : str):
+    """Sends spans from this process and the processes it starts to path."""
+    os.environ[TRACE_ENV] = path
+
+def current_span():
+    """The innermost open span, for adding attributes to it. A no-op object when tracing is off."""
+    return _current_span.get() or NOOP_SPAN
+
+def _write(record : dict, path : str):
+    line = json.dumps(record, default=str) + "\n"
+    with _lock:
+        if path not in _files:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            _files[path] = open(path, "a", buffering=1)
+        _files[path].write(line)
+
+@contextmanager
+def span(name : str, **attrs):
+    """Opens a span for the duration of the with block. Exceptions are recorded on the span and re-raised."""
+    path = trace_path()
+    if path is None:
+        yield NOOP_SPAN
+        return
+
+    current = Span(name, _current_span.get(), attrs)
+    token = _current_span.set(current)
+    start_time = time.time()
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=repr(e))
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _current_span.reset(token)
+        _write({
+            "name": name,
+            "id": current.id,
+            "parent_id": current.parent_id,
+            "trace_id": current.trace_id,
+            "start": start_time,
+            "duration": duration,
+            **current.attrs,
+        }, path)
+
+def _percentile(values : list, q : float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def summarize(path : str, top : int = 10):
+    """Prints latency percentiles per span name, followed by the slowest turns, the prompt tokens that
+    were served from the provider's prompt cache per model, and the take_action spans with the most retries. E.g. `python api/tracing.py traces.jsonl`."""
+    spans = []
+    with open(path) as f:
+        for line in f:
+            spans.append(json.loads(line))
+
+    by_name = defaultdict(list)
+    for s in spans:
+        by_name[s["name"]].append(s)
+    print(f"{'span':<20} {'count':>8} {'total s':>10} {'p50 s':>9} {'p99 s':>9} {'max s':>9}")
+    for name, group in sorted(by_name.items(), key=lambda item: -sum(s["duration"] for s in item[1])):
+        durations = [s["duration"] for s in group]
+        print(f"{name:<20} {len(group):>8} {sum(durations):>10.3f} {_percentile(durations, 0.5):>9.4f} {_percentile(durations, 0.99):>9.4f} {max(durations):>9.4f}")
+
+    turns = sorted(by_name["turn"], key=lambda s: -s["duration"])[:top]
+    if turns:
+        print(f"\nSlowest turns:")
+        for s in turns:
+            print(f"    {s['duration']:9.3f}s {s.get('game')} turn {s.get('turn')} {s.get('agent_type_id')} (trace {s['trace_id']})")
+
+    requests = [s for s in by_name["llm_request"] if "prompt_tokens" in s]
+    if requests:
+        # Requests that reused a cached prompt prefix should start answering sooner.
+        print(f"\n{'model':<28} {'requests':>9} {'prompt tok':>11} {'cached':>7} {'p50 s cached':>13} {'p50 s uncached':>15}")
+        by_model = defaultdict(list)
+        for s in requests:
+            by_model[s.get("model")].append(s)
+        for name, group in sorted(by_model.items(), key=lambda item: str(item[0])):
+            prompt = sum(s["prompt_tokens"] for s in group)
+            cached = sum(s.get("cached_prompt_tokens", 0) for s in group)
+            hits = [s["duration"] for s in group if s.get("cached_prompt_tokens")]
+            misses = [s["duration"] for s in group if not s.get("cached_prompt_tokens")]
+            p50 = lambda durations: f"{_percentile(durations, 0.5):.3f}" if durations else "-"
+            print(f"{str(name):<28} {len(group):>9} {prompt:>11} {cached / max(prompt, 1):>7.1%} {p50(hits):>13} {p50(misses):>15}")
+
+    retried = sorted((s for s in by_name["take_action"] if s.get("retries")), key=lambda s: -s["retries"])[:top]
+    if retried:
+        print(f"\nMost retries:")
+        for s in retried:
+            print(f"    {s['retries']:3d} retries, {s.get('llm_requests', 0)} requests, {s['duration']:9.3f}s {s.get('game')} turn {s.get('turn')} {s.get('agent_type_id')}")
+
+if __name__ == "__main__":
+    fire.Fire(summarize)
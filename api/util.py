@@ -18,4 +18,8 @@ def load_json(file_path):
 def import_class(class_path):
     module_path, class_name = class_path.rsplit(".", 1)
     module = importlib.import_module(module_path)
-    return getattr(module, class_name)
\ No newline at end of file
+    return getattr(module, class_name)
+
+def class_path(cls):
+    """Inverse of import_class."""
+    return f"{cls.__module__}.{cls.__qualname__}"
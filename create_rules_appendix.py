@@ -1,21 +1,21 @@
-import api.util as util
+import api.registry as registry
 
-game_paths = [
-    "games.arctic_scavengers.arctic_scavengers.ArcticScavengers",
-    "games.are_you_the_traitor.aytt.AreYouTheTraitor",
-    "games.two_rooms_and_a_boom.two_rooms.TwoRoomsAndaBoom",
-    "games.air_land_sea.game.AirLandSea",
-    "games.codenames.game.CodenamesGame",
-    "games.hive.game.HiveGame",
-    "games.santorini.santorini.Santorini",
-    "games.pit.pit.PitGame",
-    "games.sea_battle.SeaBattle"
+# Same order as the appendix in the paper.
+game_ids = [
+    "arctic_scavengers",
+    "are_you_the_traitor",
+    "two_rooms_and_a_boom",
+    "air_land_sea",
+    "codenames",
+    "hive",
+    "santorini",
+    "pit",
+    "sea_battle"
 ]
 
 latex = ""
-for path in game_paths:
-    game_class = util.import_class(path)
-    rules = game_class.rules
+for game_id in game_ids:
+    rules = registry.get(game_id).rules
 
     latex += "\\textbf{" + rules.title + "} " + rules.summary + "\n\n"
     if rules.additional_details:
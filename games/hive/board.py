@@ -1,13 +1,11 @@
 from .pieces import HivePiece, Grasshopper, Spider
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
 import numpy as np
-from matplotlib.animation import FuncAnimation
-from multiprocessing import Process
-from PIL import Image
 import io
 import os
 
+# matplotlib and PIL are imported where the board is drawn, so games that never render (image_mode
+# off) don't pay for them.
+
 class HiveBoardVisualizer:
     def __init__(self, board, piece_images=None):
         self.board = board
@@ -18,6 +16,7 @@ class HiveBoardVisualizer:
 
     def draw_hexagon(self, ax, center, size=1, fill_color='white', edge_color='black'):
         """Draw a hexagon given a center, size."""
+        import matplotlib.patches as patches
         hexagon = patches.RegularPolygon(center, numVertices=6, radius=size, orientation=0,
                                         facecolor=fill_color, edgecolor=edge_color, linewidth=1.5)
         ax.add_patch(hexagon)
@@ -35,6 +34,9 @@ class HiveBoardVisualizer:
         
     def draw_board(self, interactive=False):
         """Draw and display the Hive board."""
+        import matplotlib.pyplot as plt
+        from PIL import Image
+
         fig, ax = plt.subplots(figsize=(5.12, 5.12), dpi=100)
         ax.set_aspect('equal')
         ax.axis('off')  # Hide the axes
@@ -1,10 +1,10 @@
 import ast
 import random
 from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from typing import Dict, List, Tuple, TYPE_CHECKING
 
-from colorama import Back, Fore, Style
-from santorinai.board import Board, Pawn
+if TYPE_CHECKING:
+    from santorinai.board import Board, Pawn
 
 from api.classes import Action, Agent, AvailableActions, Game, Observation, Rules
 
@@ -40,7 +40,7 @@ class Santorini(Game):
     agents: List[Agent] = None
     show_state: bool = False
     game_is_over: bool = False
-    board: Board = None
+    board: "Board" = None
     colored_output: bool = True
     DIRECTION_NAME_MATRIX = [
         ["northwest", "north", "northeast"],
@@ -53,9 +53,11 @@ class Santorini(Game):
             agent_1(team_id=1, agent_id=0, **self.agent_1_kwargs),
             agent_2(team_id=2, agent_id=1, **self.agent_2_kwargs),
         ]
+        from santorinai.board import Board
+
         self.board = Board(2)
 
-    def pawn_letter(self, pawn: Pawn) -> str:
+    def pawn_letter(self, pawn: "Pawn") -> str:
         letter_mapping = {
             1: "A",
             2: "X",
@@ -64,12 +66,12 @@ class Santorini(Game):
         }
         return letter_mapping[pawn.number]
 
-    def get_pawns(self, agent: Agent) -> List[Pawn]:
+    def get_pawns(self, agent: Agent) -> List["Pawn"]:
         return [
             pawn for pawn in self.board.pawns if pawn.player_number == agent.team_id
         ]
 
-    def get_opponent_pawns(self, agent: Agent) -> List[Pawn]:
+    def get_opponent_pawns(self, agent: Agent) -> List["Pawn"]:
         return [
             pawn for pawn in self.board.pawns if pawn.player_number != agent.team_id
         ]
@@ -111,6 +113,8 @@ class Santorini(Game):
     def board_string_for_user(self) -> str:
         """Return a string representation of the board to be displayed to a human user in the terminal."""
         # TODO: replace board_string_for_user with a print board for user function
+        from colorama import Back, Fore, Style
+
         level_color_mapping = {
             0: Back.BLACK,
             1: Back.BLUE,
@@ -171,7 +175,7 @@ class Santorini(Game):
         matrix_lookup = (relative_position[0] + 1, relative_position[1] + 1)
         return self.DIRECTION_NAME_MATRIX[matrix_lookup[0]][matrix_lookup[1]]
 
-    def relative_position(self, pawn: Pawn, direction: str) -> Tuple[int, int]:
+    def relative_position(self, pawn: "Pawn", direction: str) -> Tuple[int, int]:
         """Given a pawn and a direction name (e.g. "north"), return the position adjacent to the pawn in that direction."""
         # try:
         #     assert direction in self.DIRECTION_NAME_MAPPING
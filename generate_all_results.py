@@ -1,6 +1,13 @@
-from api.util import load_json
+from api.util import load_json, save_json
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
 import random
+import sys
+import matplotlib
+matplotlib.use("Agg") # figures are only saved, some of them from worker processes
 import seaborn as sns
 import functools
 
@@ -13,12 +20,67 @@ from rating import *
 
 import pandas as pd
 
+# Bootstraps and figures are cached in CACHE_DIR, keyed by a hash of the matches they come from and
+# of rating_config (and of this script, for figures). A rerun only refits the slices whose matches
+# changed and only redraws the figures that depend on them.
+CACHE_DIR = "results_cache"
+
+# With --laplace, rating uncertainty comes from one fit per slice and its Fisher information
+# (rating.laplace_slices) instead of 1000 bootstrap refits. Fine for a quick look, the paper uses the bootstrap,
+# which is also the one that resamples mirrored pairs together.
+uncertainty = "laplace" if "--laplace" in sys.argv[1:] else "bootstrap"
+
+def content_hash(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
 complete_matches = {
     g: get_matches(g) for g in games
 } | {"all": get_matches()}
-complete_bootstrapped_params = {
-    g: bootstrap_params(m) for g, m in complete_matches.items()
-} | {"all": bootstrap_params(get_matches())}
+# Mirrored pairs of matches are resampled together.
+complete_clusters = {
+    g: get_clusters(g) for g in games
+} | {"all": get_clusters()}
+# The published agents first, then any other agent in the store.
+players = discover_players()
+n_players = len(players)
+rating_config = {"uncertainty": uncertainty, "n_bootstrap": 1000, "method": "multinomial", "seed": 0, "chunk_size": 50, "players": players}
+slice_keys = {name: content_hash(rating_config, m, complete_clusters[name]) for name, m in complete_matches.items()}
+
+def load_cached_params(name):
+    path = os.path.join(CACHE_DIR, f"{uncertainty}_{name}.npz")
+    if os.path.exists(path):
+        cached = np.load(path)
+        if str(cached["key"]) == slice_keys[name]:
+            return cached["params"]
+    return None
+
+complete_bootstrapped_params = {name: load_cached_params(name) for name in complete_matches}
+stale_slices = [name for name, params in complete_bootstrapped_params.items() if params is None]
+if stale_slices:
+    print(f"Computing {uncertainty} ratings for {', '.join(stale_slices)}")
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if uncertainty == "laplace":
+        fresh_params = laplace_slices(complete_matches["all"], stale_slices, rating_config["n_bootstrap"], rating_config["seed"], players=players)
+    else:
+        fresh_params = bootstrap_slices(complete_matches["all"], stale_slices, rating_config["n_bootstrap"], rating_config["method"], rating_config["seed"], players=players, chunk_size=rating_config["chunk_size"], clusters=complete_clusters["all"])
+    for name, params in fresh_params.items():
+        np.savez(os.path.join(CACHE_DIR, f"{uncertainty}_{name}.npz"), params=params, key=slice_keys[name])
+        complete_bootstrapped_params[name] = params
+
+with open(__file__, "rb") as f:
+    script_hash = hashlib.sha256(f.read()).hexdigest()
+figure_keys_path = os.path.join(CACHE_DIR, "figures.json")
+figure_keys = load_json(figure_keys_path) if os.path.exists(figure_keys_path) else {}
+
+def figure_key(*slices):
+    return content_hash(script_hash, [slice_keys[s] for s in slices])
+
+def needs_render(path, key):
+    """Whether path is missing or was drawn from other inputs. If so, it is taken to be drawn now."""
+    if os.path.exists(path) and figure_keys.get(path) == key:
+        return False
+    figure_keys[path] = key
+    return True
 
 ################################################################################
 ################################################################################
@@ -36,58 +98,51 @@ sorted_indices = np.argsort(ratings)
 sorted_data = bootstrapped_params[:, sorted_indices]
 sorted_labels = [players[i] for i in sorted_indices]
 
-fig, ax = plt.subplots(constrained_layout=True, dpi=300)
-sns.boxplot(data=sorted_data, whis=(5, 95), fliersize=0, ax=ax)
-ax.set_ylabel("Rating")
-ax.set_xticks(ticks=range(len(players)), labels=sorted_labels)
-#ax.tick_params(axis='x', rotation=30)
+if needs_render("figures/overall_rating.png", figure_key("all")):
+    fig, ax = plt.subplots(constrained_layout=True, dpi=300)
+    sns.boxplot(data=sorted_data, whis=(5, 95), fliersize=0, ax=ax)
+    ax.set_ylabel("Rating")
+    ax.set_xticks(ticks=range(len(players)), labels=sorted_labels)
+    #ax.tick_params(axis='x', rotation=30)
 
-plt.savefig("figures/overall_rating.png")
+    plt.savefig("figures/overall_rating.png")
 
 ################################################################################
 
-fig, ax = plt.subplots(constrained_layout=True, dpi=300)
+if needs_render("figures/overall_probabilities.png", figure_key("all")):
+    fig, ax = plt.subplots(constrained_layout=True, dpi=300)
 
-matrix = np.zeros((n_players, n_players))
-for i in range(n_players):
-    for j in range(n_players):
-        matrix[i, j] = choix.probabilities([i, j], ratings)[0]
+    matrix = win_probabilities(ratings)
 
-sns.heatmap(matrix, ax=ax, annot=True, xticklabels=players, yticklabels=players, fmt=".2f")
-#ax.set_title("Win probabilities")
-ax.set_ylabel("Probability this agent...")
-ax.set_xlabel("... beats this agent")
-ax.tick_params(axis='x', rotation=30)
-ax.tick_params(axis='y', rotation=0)
-ax.invert_yaxis()
+    sns.heatmap(matrix, ax=ax, annot=True, xticklabels=players, yticklabels=players, fmt=".2f")
+    #ax.set_title("Win probabilities")
+    ax.set_ylabel("Probability this agent...")
+    ax.set_xlabel("... beats this agent")
+    ax.tick_params(axis='x', rotation=30)
+    ax.tick_params(axis='y', rotation=0)
+    ax.invert_yaxis()
 
-plt.savefig("figures/overall_probabilities.png")
+    plt.savefig("figures/overall_probabilities.png")
 
 ################################################################################
 
-fig, ax = plt.subplots(constrained_layout=True, dpi=300)
-
 n_games = defaultdict(int)
-counts = np.array([0] * n_players)
-for match in complete_matches["all"]:
-    agents = list(match.keys())[1:]
-    counts[players.index(agents[0])] += 1
-    counts[players.index(agents[1])] += 1
+counts = np.bincount(match_rows(complete_matches["all"], players)[:, :2].astype(int).ravel(), minlength=n_players)
 
 sorted_indices = np.argsort(counts)
 sorted_players = [players[i] for i in sorted_indices]
 sorted_counts = counts[sorted_indices]
-sns.barplot(x=sorted_players, y=sorted_counts, ax=ax)
-#ax.tick_params(axis='x', rotation=30)
-#ax.set_ylabel("Agent")
-#ax.set_xlabel("Number of matches collected")
+if needs_render("figures/num_matches_per_agent.png", figure_key("all")):
+    fig, ax = plt.subplots(constrained_layout=True, dpi=300)
+    sns.barplot(x=sorted_players, y=sorted_counts, ax=ax)
+    #ax.tick_params(axis='x', rotation=30)
+    #ax.set_ylabel("Agent")
+    #ax.set_xlabel("Number of matches collected")
 
-plt.savefig("figures/num_matches_per_agent.png")
+    plt.savefig("figures/num_matches_per_agent.png")
 
 ################################################################################
 
-fig, ax = plt.subplots(constrained_layout=True, dpi=300)
-
 n_games = defaultdict(int)
 for match in complete_matches["all"]:
     game = match["game"]
@@ -98,14 +153,16 @@ counts = np.array(counts)
 sorted_indices = np.argsort(counts)
 sorted_games = [games[i] for i in sorted_indices]
 sorted_counts = counts[sorted_indices]
-sns.barplot(x=[shorter_names[g] for g in sorted_games], y=sorted_counts, ax=ax)
-labels = ax.get_xticklabels()
-#plt.setp(labels, rotation=45, ha="right", rotation_mode="anchor")
-#ax.tick_params(axis='x', rotation=30)
-#ax.set_ylabel("Game")
-#ax.set_xlabel("Number of matches collected")
+if needs_render("figures/num_matches_per_game.png", figure_key("all")):
+    fig, ax = plt.subplots(constrained_layout=True, dpi=300)
+    sns.barplot(x=[shorter_names[g] for g in sorted_games], y=sorted_counts, ax=ax)
+    labels = ax.get_xticklabels()
+    #plt.setp(labels, rotation=45, ha="right", rotation_mode="anchor")
+    #ax.tick_params(axis='x', rotation=30)
+    #ax.set_ylabel("Game")
+    #ax.set_xlabel("Number of matches collected")
 
-plt.savefig("figures/num_matches_per_game.png")
+    plt.savefig("figures/num_matches_per_game.png")
 
 ################################################################################
 sns.set_context("paper", font_scale=2)
@@ -132,12 +189,13 @@ x = np.array(x)
 y = np.array(y)
 hue = np.array(hue)
 
-fig, ax = plt.subplots(figsize=(10, 7), constrained_layout=True, dpi=300)
-sns.scatterplot(x=x, y=y, hue=hue, style=hue, palette='bright', s=300, ax=ax)
-#ax.set_ylim(-2.5, 3)
-ax.set_ylabel("Proportional rating")
-#plt.xticks(rotation=45, ha="right", rotation_mode="anchor")
-plt.savefig("figures/rating_scatter.png")
+if needs_render("figures/rating_scatter.png", figure_key(*complete_matches)):
+    fig, ax = plt.subplots(figsize=(10, 7), constrained_layout=True, dpi=300)
+    sns.scatterplot(x=x, y=y, hue=hue, style=hue, palette='bright', s=300, ax=ax)
+    #ax.set_ylim(-2.5, 3)
+    ax.set_ylabel("Proportional rating")
+    #plt.xticks(rotation=45, ha="right", rotation_mode="anchor")
+    plt.savefig("figures/rating_scatter.png")
 
 ################################################################################
 
@@ -208,8 +266,10 @@ ratings_df.loc[:, "Overall"] = ratings
 for agent in players:
     scores_df.loc[agent, "Overall"] = scores[agent] / n_matches[agent] if n_matches[agent] > 0 else float("nan")
 
-latex("ratings_table", ratings_df)
-latex("scores_table", scores_df)
+if needs_render("figures/ratings_table.tex", figure_key(*complete_matches)):
+    latex("ratings_table", ratings_df)
+if needs_render("figures/scores_table.tex", figure_key(*complete_matches)):
+    latex("scores_table", scores_df)
 
 ################################################################################
 
@@ -222,7 +282,6 @@ import matplotlib.pyplot as plt
 import numpy as np
 import functools
 import seaborn as sns
-from rating import *
 
 sns.set(style='whitegrid')
 sns.set_context("paper", font_scale=1.5)
@@ -238,20 +297,9 @@ def make_figures(game, matches):
 
     ################################################################################
 
-    n_matches = defaultdict(int)
-
-    for match in matches:
-        agents = list(match.keys())[1:]
-        n_matches[agents[0], agents[1]] += 1
-        n_matches[agents[1], agents[0]] += 1
-
-    matrix = np.zeros((n_players, n_players), dtype="int")
-    for i, player1 in enumerate(players):
-        for j, player2 in enumerate(players):
-            if player1 == player2:
-                continue
-
-            matrix[i][j] = n_matches[player1, player2]
+    rows = match_rows(matches, players)
+    matrix = pairwise_counts(n_players, rows).toarray().astype("int")
+    np.fill_diagonal(matrix, 0)
 
     sns.heatmap(matrix, ax=ax_nmatches, annot=True, xticklabels=players, yticklabels=players)
     ax_nmatches.tick_params(axis='x', rotation=30)
@@ -264,23 +312,9 @@ def make_figures(game, matches):
     ################################################################################
 
 
-    wins = defaultdict(int)
-    for match in matches:
-        agents = list(match.keys())[1:]
-        wins[agents[0], agents[1]] += match[agents[0]]
-        wins[agents[1], agents[0]] += match[agents[1]]
-
-    for (agent1, agent2), score in wins.items():
-        wins[agent1, agent2] = score
-
-    matrix = np.empty((len(players), len(players)))
-    matrix.fill(np.nan)
-    for i, player1 in enumerate(players):
-        for j, player2 in enumerate(players):
-            if player1 == player2:
-                continue
-
-            matrix[i, j] = wins[player1, player2]
+    # matrix[i, j] is the total score i earned against j, i.e. the transpose of pairwise_points.
+    matrix = sparse_points(n_players, rows).T.toarray()
+    np.fill_diagonal(matrix, np.nan)
 
     sns.heatmap(matrix, ax=ax_score, annot=True, xticklabels=players, yticklabels=players)
 
@@ -307,10 +341,7 @@ def make_figures(game, matches):
 
     ################################################################################
 
-    matrix = np.zeros((n_players, n_players))
-    for i in range(n_players):
-        for j in range(n_players):
-            matrix[i, j] = choix.probabilities([i, j], ratings)[0]
+    matrix = win_probabilities(ratings)
 
     sns.heatmap(matrix, ax=ax_prob, annot=True, xticklabels=players, yticklabels=players, fmt=".2f")
     ax_prob.set_title("Win probabilities")
@@ -326,5 +357,13 @@ def make_figures(game, matches):
     plt.savefig(f"figures/{game}.png")
     plt.close()
 
-for game in games:
-    make_figures(game, complete_matches[game])
\ No newline at end of file
+stale_games = [game for game in games if needs_render(f"figures/{game}.png", figure_key(game))]
+if pool_context() is None:
+    for game in stale_games:
+        make_figures(game, complete_matches[game])
+else:
+    # The figures are independent, so they are drawn in forked workers that share the bootstraps above.
+    with ProcessPoolExecutor(mp_context=pool_context()) as executor:
+        list(executor.map(make_figures, stale_games, [complete_matches[game] for game in stale_games]))
+
+save_json(figure_keys, figure_keys_path)
\ No newline at end of file
@@ -1,9 +1,16 @@
-from api.util import load_json
-from collections import defaultdict
+from api.match_store import MatchStore, DEFAULT_STORE_PATH
+import api.registry as registry
+from collections import Counter, defaultdict
 import random
 import functools
+import multiprocessing
+import time
+import zlib
+import fire
 import choix
 import numpy as np
+import scipy.sparse
+from concurrent.futures import ProcessPoolExecutor
 
 ################################################################################
 ################################################################################
@@ -31,68 +38,433 @@ import numpy as np
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-def lsr_pairwise(n_items, data, alpha=0.0, initial_params=None):
-    weights, chain = choix.lsr._init_lsr(n_items, alpha, initial_params)
-    for p1, p2, p1score, p2score in data:
-        chain[p1, p2] += float(p2score) / (weights[p1] + weights[p2])
-        chain[p2, p1] += float(p1score) / (weights[p1] + weights[p2])
-    chain -= np.diag(chain.sum(axis=1))
+def pairwise_points(n_items, data):
+    """points[i, j] is the total score item j earned in matches against item i.
+    data is a sequence (or an (n, 4) array) of (p1, p2, p1score, p2score) rows."""
+    data = np.asarray(data, dtype=float).reshape(-1, 4)
+    p1 = data[:, 0].astype(np.intp)
+    p2 = data[:, 1].astype(np.intp)
+    points = np.bincount(p1 * n_items + p2, weights=data[:, 3], minlength=n_items * n_items)
+    points += np.bincount(p2 * n_items + p1, weights=data[:, 2], minlength=n_items * n_items)
+    return points.reshape(n_items, n_items)
+
+
+def _lsr_step(points, alpha, initial_params, buffers):
+    # Same chain as the per-match loop, but the weights only depend on the pair, so the scores
+    # of a pair can be summed once (pairwise_points) and divided by w_i + w_j in one go.
+    n_items = len(points)
+    denominator, chain = buffers
+    if initial_params is None:
+        weights = np.ones(n_items)
+    else:
+        weights = choix.utils.exp_transform(initial_params)
+    np.add.outer(weights, weights, out=denominator)
+    np.divide(points, denominator, out=chain)
+    chain += alpha
+    chain[np.diag_indices(n_items)] -= chain.sum(axis=1)
     return choix.utils.log_transform(choix.utils.statdist(chain))
 
 
+def lsr_pairwise(n_items, data, alpha=0.0, initial_params=None):
+    buffers = np.empty((n_items, n_items)), np.empty((n_items, n_items))
+    return _lsr_step(pairwise_points(n_items, data), alpha, initial_params, buffers)
+
+
+def ilsr_points(points, alpha=0.0, initial_params=None, max_iter=100, tol=1e-8):
+    """ilsr_pairwise on precomputed pairwise_points. The chain buffers are reused across iterations."""
+    n_items = len(points)
+    buffers = np.empty((n_items, n_items)), np.empty((n_items, n_items))
+    fun = lambda params: _lsr_step(points, alpha, params, buffers)
+    return choix.lsr._ilsr(fun, initial_params, max_iter, tol)
+
+
 def ilsr_pairwise(
     n_items, data, alpha=0.0, initial_params=None, max_iter=100, tol=1e-8
 ):
-    fun = functools.partial(lsr_pairwise, n_items=n_items, data=data, alpha=alpha)
-    return choix.lsr._ilsr(fun, initial_params, max_iter, tol)
+    return ilsr_points(pairwise_points(n_items, data), alpha, initial_params, max_iter, tol)
 
 ################################################################################
 ################################################################################
 ################################################################################
 
+# The agents of the published results, in the order the figures show them. discover_players adds any
+# other agent found in a match store after these.
 players = ["random", "human", "gpt-3", "gpt-3-cot", "gpt-4", "gpt-4-cot", "gpt-4-rap"]
 n_players = len(players)
 
-def get_matches(game=None):
-    if game:
-        return [m for m in load_json("matches.json") if m["game"] == game]
-    return load_json("matches.json")
+def get_matches(game=None, store_path=DEFAULT_STORE_PATH):
+    return MatchStore(store_path).matches(game)
+
+def get_clusters(game=None, store_path=DEFAULT_STORE_PATH):
+    """The pair id (or None) of each match get_matches returns, for MatchCounts."""
+    return MatchStore(store_path).clusters(game)
 
-def get_params(matches):
-    wins = []
-    for match in matches:
+def discover_players(store_path=DEFAULT_STORE_PATH, known=players):
+    """Every agent in the store, known ones first, the rest in the order they first played."""
+    return list(known) + [agent for agent in MatchStore(store_path).agents() if agent not in known]
+
+def match_rows(matches, players=players):
+    """One (p1, p2, p1score, p2score) row per match, as indices into players."""
+    index = {player: i for i, player in enumerate(players)}
+    rows = np.empty((len(matches), 4))
+    for k, match in enumerate(matches):
         agents = list(match.keys())[1:]
-        if match[agents[0]] == match[agents[1]]:
-            continue
+        rows[k] = index[agents[0]], index[agents[1]], match[agents[0]], match[agents[1]]
+    return rows
+
+
+def sparse_points(n_items, rows):
+    """pairwise_points as a sparse matrix, for pools where most pairs never met."""
+    p1 = rows[:, 0].astype(np.intp)
+    p2 = rows[:, 1].astype(np.intp)
+    # Duplicate entries are summed on conversion.
+    return scipy.sparse.coo_matrix(
+        (np.concatenate([rows[:, 3], rows[:, 2]]), (np.concatenate([p1, p2]), np.concatenate([p2, p1]))),
+        shape=(n_items, n_items),
+    ).tocsr()
+
+
+def pairwise_counts(n_items, rows):
+    """Sparse symmetric matrix of the number of matches between each pair."""
+    ones = np.ones((len(rows), 4))
+    ones[:, :2] = rows[:, :2]
+    return sparse_points(n_items, ones)
+
 
-        i = players.index(agents[0])
-        j = players.index(agents[1])
+def win_probabilities(params):
+    """probabilities[i, j] is the probability that i beats j."""
+    return 1 / (1 + np.exp(params[None, :] - params[:, None]))
 
-        wins.append((i, j, match[agents[0]], match[agents[1]]))
 
-    params = ilsr_pairwise(len(players), wins, alpha=0.001)
-    return params
+def fit_points(points, initial_params=None):
+    return ilsr_points(points, alpha=0.001, initial_params=initial_params)
 
 
-def bootstrap_params(matches):
-    weights = defaultdict(int)
-    for match in matches:
-        weights[match["game"]] += 1
+def fit_rows(rows, initial_params=None, players=players):
+    # Ties say nothing about who is stronger in this model, so they are left out.
+    decisive = rows[rows[:, 2] != rows[:, 3]]
+    return fit_points(pairwise_points(len(players), decisive), initial_params)
 
-    bootstrapped_params = np.array(
-        [
-            get_params(
-                random.choices(
-                    matches, k=len(matches), weights=[1 / weights[m["game"]] for m in matches]
-                )
+
+def get_params(matches, initial_params=None, players=players):
+    return fit_rows(match_rows(matches, players), initial_params, players)
+
+
+class MatchCounts:
+    """Matches compressed to how often each distinct (game, p1, p2, p1score, p2score) outcome occurred.
+    The fit only depends on these counts, so a bootstrap resample is just a new count per outcome and
+    never has to touch the matches again.
+    clusters optionally gives an id per match (None for none), and matches with the same id, such as
+    the two legs of a mirrored pair (see api.play_game.match_specs), are resampled together as one
+    unit. The counts are then of distinct units, i.e. of distinct combinations of outcomes."""
+
+    def __init__(self, matches, players=players, clusters=None):
+        self.n_players = len(players)
+        self.games = sorted({match["game"] for match in matches})
+        game_index = {game: i for i, game in enumerate(self.games)}
+        rows = np.column_stack([[game_index[match["game"]] for match in matches], match_rows(matches, players)])
+        outcomes, outcome_of, self.counts = np.unique(rows, axis=0, return_inverse=True, return_counts=True)
+        self.game = outcomes[:, 0].astype(np.intp)
+
+        # Row u of points is what one occurrence of outcome u adds to the flattened pairwise_points, so
+        # the points of any count vector are a single product. It is sparse (two entries per row), so
+        # it stays small for large agent pools.
+        n = self.n_players
+        p1 = outcomes[:, 1].astype(np.intp)
+        p2 = outcomes[:, 2].astype(np.intp)
+        decisive = outcomes[:, 3] != outcomes[:, 4]
+        outcome_ids = np.arange(len(outcomes))
+        self.points = scipy.sparse.coo_matrix(
+            (
+                np.concatenate([outcomes[:, 4] * decisive, outcomes[:, 3] * decisive]),
+                (np.concatenate([outcome_ids, outcome_ids]), np.concatenate([p1 * n + p2, p2 * n + p1])),
+            ),
+            shape=(len(outcomes), n * n),
+        ).tocsc()
+
+        if clusters is not None:
+            members = defaultdict(list)
+            for k, (cluster, outcome) in enumerate(zip(clusters, outcome_of.ravel())):
+                members[k if cluster is None else cluster].append(outcome)
+            units = Counter(tuple(sorted(outcome_ids)) for outcome_ids in members.values())
+            self.counts = np.array(list(units.values()))
+            self.game = self.game[[unit[0] for unit in units]]
+            # A unit adds up the points of its outcomes.
+            incidence = scipy.sparse.coo_matrix(
+                (
+                    np.ones(sum(len(unit) for unit in units)),
+                    ([u for u, unit in enumerate(units) for _ in unit], [outcome for unit in units for outcome in unit]),
+                ),
+                shape=(len(units), len(outcomes)),
             )
-            for _ in range(1000)
-        ]
-    )
+            self.points = (incidence.tocsr() @ self.points).tocsc()
+
+    def probabilities(self, game=None):
+        """Resampling probability of each outcome: uniform over the game's matches (or units), or for all
+        matches (game=None) weighted so that every game is equally likely, as bootstrap_params always did."""
+        if game is None:
+            per_game = np.bincount(self.game, weights=self.counts)
+            weights = self.counts / per_game[self.game]
+        else:
+            if game not in self.games:
+                raise ValueError(f"No matches for {game}")
+            weights = self.counts * (self.game == self.games.index(game))
+        return weights / weights.sum()
+
+    def size(self, game=None):
+        return int(self.counts.sum() if game is None else self.counts[self.game == self.games.index(game)].sum())
+
+    def resample(self, rng, n_bootstrap, game=None, method="multinomial"):
+        """n_bootstrap x outcomes counts. multinomial draws as many matches as the slice has, poisson
+        gives every match an independent Poisson weight with the same mean."""
+        probabilities = self.probabilities(game)
+        if method == "multinomial":
+            return rng.multinomial(self.size(game), probabilities, size=n_bootstrap)
+        if method == "poisson":
+            return rng.poisson(self.size(game) * probabilities, size=(n_bootstrap, len(probabilities)))
+        raise ValueError(f"Unknown bootstrap method {method}, expected multinomial or poisson")
+
+    def pairwise_points(self, counts):
+        """pairwise_points of the matches that a counts vector (or each row of a batch of them) describes."""
+        counts = np.asarray(counts)
+        return (self.points.T @ counts.T).T.reshape(*counts.shape[:-1], self.n_players, self.n_players)
+
+
+# The MatchCounts being bootstrapped, set once per worker rather than sent with every chunk.
+_bootstrap_counts = None
+
+def _init_bootstrap_worker(counts):
+    global _bootstrap_counts
+    _bootstrap_counts = counts
+
+
+def _fit_chunk(game, size, method, seed, initial_params):
+    # Resamples are drawn where they are fitted, a chunk at a time, so they never all sit in memory.
+    resampled = _bootstrap_counts.resample(np.random.default_rng(seed), size, game, method)
+    return np.array([fit_points(points, initial_params) for points in _bootstrap_counts.pairwise_points(resampled)])
+
+
+def pool_context():
+    # generate_all_results.py is a plain script, which spawned workers would re-run on import.
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
 
-    return bootstrapped_params
 
-games = ["sea_battle", "two_rooms_and_a_boom", "are_you_the_traitor", "air_land_sea", "santorini", "hive", "pit", "arctic_scavengers", "codenames"]
+def bootstrap_slices(matches, slices=("all",), n_bootstrap=1000, method="multinomial", seed=None, workers=None, players=players, chunk_size=50, clusters=None):
+    """Bootstrapped params (n_bootstrap x len(players)) for each slice, which is either a game or "all"
+    for all the matches together. The matches are compressed once and every slice is drawn from the
+    same counts; chunks of chunk_size resamples are drawn and fitted in workers processes (all cores by
+    default). Each chunk has its own random stream derived from seed, the slice's name and the chunk's
+    position, so a slice comes out the same whichever other slices are computed with it and however
+    many workers there are. Without a seed, the streams are seeded from the random module, so
+    random.seed still makes the results reproducible. With clusters (see MatchCounts), correlated
+    matches are resampled together."""
+    counts = MatchCounts(matches, players, clusters)
+    seed = seed if seed is not None else random.getrandbits(64)
+
+    names, jobs = [], []
+    for name in slices:
+        game = None if name == "all" else name
+        # Resamples stay close to the full data, so starting from its fit saves most of the iterations.
+        full_params = fit_points(counts.pairwise_points(counts.counts * (counts.probabilities(game) > 0)))
+        for chunk, start in enumerate(range(0, n_bootstrap, chunk_size)):
+            names.append(name)
+            jobs.append((game, min(chunk_size, n_bootstrap - start), method, [seed, zlib.crc32(name.encode()), chunk], full_params))
+
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        _init_bootstrap_worker(counts)
+        results = [_fit_chunk(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context(), initializer=_init_bootstrap_worker, initargs=(counts,)) as executor:
+            results = list(executor.map(_fit_chunk, *zip(*jobs)))
+
+    chunks = defaultdict(list)
+    for name, result in zip(names, results):
+        chunks[name].append(result)
+    return {name: np.concatenate(chunks[name]) for name in slices}
+
+
+def bootstrap_params(matches, n_bootstrap=1000, method="multinomial", seed=None, workers=None, players=players, clusters=None):
+    return bootstrap_slices(matches, ["all"], n_bootstrap, method, seed, workers, players, clusters=clusters)["all"]
+
+
+def fisher_information(points, params, alpha=0.001):
+    """Fisher information of Bradley-Terry params at a fit to points, counting alpha pseudo-comparisons
+    each way between every pair, as in the fit itself."""
+    comparisons = points + points.T + 2 * alpha
+    # win[i, j] is the probability that j beats i, and win.T that i beats j.
+    win = 1 / (1 + np.exp(params[:, None] - params[None, :]))
+    weights = comparisons * win * win.T
+    np.fill_diagonal(weights, 0)
+    return np.diag(weights.sum(axis=1)) - weights
+
+
+def fisher_covariance(points, params, alpha=0.001):
+    """Covariance of Bradley-Terry params from the inverse Fisher information of the fit to points.
+    Params are only identified up to a constant, so this is the covariance of the params centered over
+    the agents that have played (a pseudo-inverse); agents without any decisive match get nan."""
+    played = (points + points.T).sum(axis=1) > 0
+    information = fisher_information(points[np.ix_(played, played)], params[played], alpha)
+    covariance = np.full((len(params), len(params)), np.nan)
+    covariance[np.ix_(played, played)] = np.linalg.pinv(information)
+    return covariance
+
+
+def win_probability_intervals(params, covariance, z=1.96):
+    """Lower and upper bounds on win_probabilities from the delta method: the interval on
+    params[i] - params[j] is mapped through the logistic function."""
+    variance = np.diag(covariance)
+    sd = np.sqrt(np.maximum(variance[:, None] + variance[None, :] - 2 * covariance, 0))
+    difference = params[:, None] - params[None, :]
+    return 1 / (1 + np.exp(-(difference - z * sd))), 1 / (1 + np.exp(-(difference + z * sd)))
+
+
+def laplace_slices(matches, slices=("all",), n_samples=1000, seed=None, players=players):
+    """A fast stand-in for bootstrap_slices: each slice is fitted once, to the matches weighted the way
+    the bootstrap resamples them (every game equally for "all"), and n_samples params are drawn from
+    the normal approximation with fisher_covariance. The result has the same shape as the bootstrap's,
+    so it goes into the same figures and tables. Agents that haven't played in a slice keep their fitted
+    rating in every sample. The Fisher information treats every match as independent, so clusters such
+    as mirrored pairs (see MatchCounts) are ignored; use bootstrap_slices with clusters for paired data."""
+    counts = MatchCounts(matches, players)
+    seed = seed if seed is not None else random.getrandbits(64)
+
+    samples = {}
+    for name in slices:
+        game = None if name == "all" else name
+        points = counts.pairwise_points(counts.size(game) * counts.probabilities(game))
+        params = fit_points(points)
+        covariance = fisher_covariance(points, params)
+        played = ~np.isnan(np.diag(covariance))
+        rng = np.random.default_rng([seed, zlib.crc32(name.encode())])
+        draws = np.tile(params, (n_samples, 1))
+        # The covariance is singular (ratings are only defined up to a constant), hence eigh.
+        draws[:, played] += rng.multivariate_normal(np.zeros(played.sum()), covariance[np.ix_(played, played)], size=n_samples, method="eigh")
+        # Centered like the params of a fit.
+        samples[name] = draws - draws.mean(axis=1, keepdims=True)
+    return samples
+
+
+class OnlineRatings:
+    """Per-game and overall ("all") Bradley-Terry ratings that follow matches as they are recorded.
+    "all" weighs every game equally, so it agrees with generate_all_results.
+
+    A match only adds to its game's pairwise points, and a refit starts from the previous params, so
+    keeping up costs a few O(agents^2) ILSR iterations per query no matter how many matches came
+    before. Fits are lazy: they happen on the first query after new matches. Agents are added as
+    they appear, so tournament agents don't need to be in players."""
+
+    def __init__(self, agents=()):
+        self.agents = []
+        self.index = {}
+        self.points = {}
+        self.params = {}
+        self.matches = defaultdict(int)
+        self.stale = set()
+        self.last_id = None
+        for agent in agents:
+            self._agent(agent)
+
+    def _agent(self, agent):
+        if agent not in self.index:
+            self.index[agent] = len(self.agents)
+            self.agents.append(agent)
+            for game in self.points:
+                self.points[game] = np.pad(self.points[game], (0, 1))
+                self.params[game] = np.append(self.params[game], 0.0)
+        return self.index[agent]
+
+    def _slice(self, game):
+        if game not in self.points:
+            n = len(self.agents)
+            self.points[game] = np.zeros((n, n))
+            self.params[game] = np.zeros(n)
+        return self.points[game]
+
+    def add(self, game, agent_1, agent_1_score, agent_2, agent_2_score):
+        if agent_1 == agent_2:
+            return
+        i, j = self._agent(agent_1), self._agent(agent_2)
+        points = self._slice(game)
+        self.matches[game] += 1
+        self.matches["all"] += 1
+        # Ties say nothing about who is stronger in this model, as in fit_rows.
+        if agent_1_score != agent_2_score:
+            points[i, j] += agent_2_score
+            points[j, i] += agent_1_score
+            self.stale.add(game)
+        # Even a tie changes the weight of its game in "all" (see _weigh_games).
+        self._slice("all")
+        self.stale.add("all")
+
+    def _weigh_games(self):
+        # "all" weighs every game equally, like bootstrap_slices and laplace_slices: each match of a
+        # game counts total / (games x the game's matches) times.
+        games = [game for game in self.points if game != "all"]
+        total = self.matches["all"]
+        self.points["all"] = sum(self.points[game] * total / (len(games) * self.matches[game]) for game in games)
+
+    def sync(self, store):
+        """Adds the matches recorded in store since the last sync."""
+        records = store.records(after_id=self.last_id)
+        for r in records:
+            self.add(r["game"], r["agent_1"], r["agent_1_score"], r["agent_2"], r["agent_2_score"])
+        if records:
+            self.last_id = records[-1]["id"]
+        return len(records)
+
+    def fit(self, game="all"):
+        if game not in self.points:
+            raise ValueError(f"No matches for {game}")
+        if game in self.stale:
+            if game == "all":
+                self._weigh_games()
+            self.params[game] = fit_points(self.points[game], self.params[game])
+            self.stale.discard(game)
+        return self.params[game]
+
+    def standings(self, game="all"):
+        """(agent, rating, standard error) tuples, best first. The error is nan for agents that haven't
+        played a decisive match in the game."""
+        params = self.fit(game)
+        errors = np.sqrt(np.diag(fisher_covariance(self.points[game], params)))
+        return sorted(zip(self.agents, params, errors), key=lambda standing: -standing[1])
+
+    def win_probability(self, agent_1, agent_2, game="all", z=1.96):
+        """Probability that agent_1 beats agent_2, with the bounds of its interval."""
+        params = self.fit(game)
+        i, j = self.index[agent_1], self.index[agent_2]
+        low, high = win_probability_intervals(params, fisher_covariance(self.points[game], params), z)
+        return win_probabilities(params)[i, j], low[i, j], high[i, j]
+
+    def report(self, game="all"):
+        lines = [f"{game} ({self.matches[game]} matches):"]
+        for agent, rating, error in self.standings(game):
+            if not np.isnan(error):
+                lines.append(f"    {agent:<20} {rating:7.3f} +- {1.96 * error:.3f}")
+        return "\n".join(lines)
+
+
+def print_standings(game="all", store_path=DEFAULT_STORE_PATH):
+    """Prints current ratings with 95% intervals for a game, or for all games together."""
+    ratings = OnlineRatings()
+    ratings.sync(MatchStore(store_path))
+    print(ratings.report(game))
+
+
+def watch(game="all", store_path=DEFAULT_STORE_PATH, interval=30):
+    """Prints the standings every interval seconds while a tournament fills the store. Only the
+    matches recorded since the previous check are read."""
+    ratings = OnlineRatings()
+    store = MatchStore(store_path)
+    while True:
+        if ratings.sync(store) and game in ratings.points:
+            print(ratings.report(game) + "\n")
+        time.sleep(interval)
+
+games = [spec.id for spec in registry.paper_games()]
 games.sort()
 
 better_names = {
@@ -106,4 +478,7 @@ shorter_names = {
     "sea_battle": "SB", "two_rooms_and_a_boom": "TRB", "are_you_the_traitor": "AYT",
     "air_land_sea": "ALS", "santorini": "SN", "hive": "HV", "pit": "PT",
     "arctic_scavengers": "AS", "codenames": "CN"
-}
\ No newline at end of file
+}
+
+if __name__ == "__main__":
+    fire.Fire({"standings": print_standings, "watch": watch})
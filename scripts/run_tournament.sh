@@ -0,0 +1,3 @@
+python3 api/tournament.py \
+    --manifest_path scripts/tournament.json \
+    --workers 32
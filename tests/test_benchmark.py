@@ -0,0 +1,7 @@
+from api.benchmark import bench_game
+
+def test_same_seed_same_turns():
+    for game_path, num_games in (("games.tic_tac_toe.TicTacToe", 20), ("games.sea_battle.SeaBattle", 3)):
+        for harness in (True, False):
+            runs = [bench_game(game_path, num_games=num_games, seed=7, harness=harness)["turns"] for _ in range(3)]
+            assert len(set(runs)) == 1, (game_path, harness, runs)
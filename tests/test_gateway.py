@@ -0,0 +1,115 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from agents.gateway import Gateway
+
+LIMITS = '{"default": {"max_concurrency": 2, "requests_per_minute": 100000, "tokens_per_minute": 1e9}}'
+
+def test_arequest_limits_concurrency(tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_GATEWAY_LIMITS", LIMITS)
+    gateway = Gateway(str(tmp_path / "gateway.db"))
+    in_flight, peak = 0, 0
+
+    async def send():
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+
+    async def main():
+        await asyncio.gather(*[gateway.arequest("deployment", send, 10) for _ in range(8)])
+
+    asyncio.run(main())
+    assert peak == 2
+
+def test_arequest_does_not_block_the_loop_on_a_locked_limiter(tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_GATEWAY_LIMITS", LIMITS)
+    path = str(tmp_path / "gateway.db")
+    gateway = Gateway(path)
+    locked = threading.Event()
+
+    def hold_lock():
+        # Another process in the middle of a write.
+        connection = sqlite3.connect(path, isolation_level=None)
+        connection.execute("BEGIN IMMEDIATE")
+        locked.set()
+        time.sleep(0.5)
+        connection.execute("COMMIT")
+
+    async def send():
+        return "ok"
+
+    async def main():
+        threading.Thread(target=hold_lock).start()
+        locked.wait()
+        start = time.perf_counter()
+        ticks = []
+
+        async def ticker():
+            for _ in range(10):
+                ticks.append(time.perf_counter() - start)
+                await asyncio.sleep(0.02)
+
+        await asyncio.gather(gateway.arequest("deployment", send, 10), ticker())
+        return ticks
+
+    ticks = asyncio.run(main())
+    assert sum(tick < 0.4 for tick in ticks) == 10
+
+def test_calls_record_the_successful_attempt(tmp_path, monkeypatch):
+    import httpx
+    import openai
+    from types import SimpleNamespace
+    import api.metrics as metrics
+    monkeypatch.setenv("LLM_GATEWAY_LIMITS", '{"default": {"requests_per_minute": 100000, "tokens_per_minute": 1e9, "max_backoff": 0.01}}')
+    gateway = Gateway(str(tmp_path / "gateway.db"))
+    failures = 0
+
+    def send():
+        nonlocal failures
+        if failures < 2:
+            failures += 1
+            raise openai.APIConnectionError(request=httpx.Request("POST", "http://stub"))
+        return "response"
+
+    async def asend():
+        return send()
+
+    async def decide():
+        # Like OpenAITextAgent.agenerate, which records the call in the task that awaited the request.
+        await gateway.arequest("deployment", asend, 10)
+        metrics.record_call("model", 200, 20, seconds=0.25)
+
+    agent = SimpleNamespace(agent_id=0, agent_type_id="agent", team_id=0)
+    match_metrics = metrics.MatchMetrics()
+    match_metrics.register(agent, 0)
+    with metrics.collect(match_metrics), metrics.acting(agent):
+        gateway.request("deployment", send, 10)
+        metrics.record_call("model", 100, 10, seconds=0.5)
+        failures = 1
+        asyncio.run(decide())
+
+    calls = match_metrics.summary()["agents"]["0"]["calls"]
+    assert [(call["attempt"], call["prompt_tokens"], call["seconds"], call["call"]) for call in calls] == [(2, 100, 0.5, 1), (1, 200, 0.25, 2)]
+    assert match_metrics.agents[0]["request_retries"] == 3
+
+def test_failed_requests_give_their_tokens_back(tmp_path, monkeypatch):
+    import pytest
+    monkeypatch.setenv("LLM_GATEWAY_LIMITS", '{"default": {"requests_per_minute": 100000, "tokens_per_minute": 1000}}')
+    path = str(tmp_path / "gateway.db")
+    gateway = Gateway(path)
+
+    def send():
+        raise ValueError("bad request")
+
+    async def asend():
+        send()
+
+    with pytest.raises(ValueError):
+        gateway.request("deployment", send, 900)
+    with pytest.raises(ValueError):
+        asyncio.run(gateway.arequest("deployment", asend, 900))
+    level = sqlite3.connect(path).execute("SELECT level FROM buckets WHERE name = 'deployment:tokens'").fetchone()[0]
+    assert level > 900
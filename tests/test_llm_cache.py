@@ -0,0 +1,26 @@
+import os
+from types import SimpleNamespace
+import agents.clients as clients
+import api.metrics as metrics
+from agents.llm_cache import LLMCache, lookup, store
+
+def test_lookups_are_counted(tmp_path, monkeypatch):
+    cache = LLMCache(str(tmp_path / "llm_cache.db"))
+    monkeypatch.setitem(clients._clients, ("llm_cache", os.getpid()), cache)
+    agent = SimpleNamespace(agent_id=0, agent_type_id="agent", team_id=0)
+    match_metrics = metrics.MatchMetrics()
+    match_metrics.register(agent, 0)
+    messages = [{"role": "user", "content": "hi"}]
+    sampled = {"temperature": 0.2}
+
+    with metrics.collect(match_metrics), metrics.acting(agent):
+        assert lookup("model", messages, sampled) == (None, None)
+        key, response = lookup("model", messages, sampled, max_temperature=0.2)
+        assert key is not None and response is None
+        store(key, "model", "answer")
+        assert lookup("model", messages, sampled, max_temperature=0.2) == (key, "answer")
+
+    totals = match_metrics.summary()["agents"]["0"]
+    assert (totals["cached_responses"], totals["cache_misses"], totals["cache_bypassed"]) == (1, 1, 1)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["bypassed"]) == (1, 1, 1)
@@ -0,0 +1,6 @@
+import pytest
+from api.play_game import iter_matches
+
+def test_paired_rejects_concurrency():
+    with pytest.raises(ValueError, match="paired"):
+        next(iter_matches("agents.random_agent.RandomAgent", "agents.random_agent.RandomAgent", "games.tic_tac_toe.TicTacToe", 4, concurrency=4, paired=True))
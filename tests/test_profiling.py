@@ -0,0 +1,30 @@
+import os
+import threading
+import tracemalloc
+from dataclasses import dataclass
+import pytest
+from agents.random_agent import RandomAgent
+from api.play_game import play_match
+from games.tic_tac_toe import TicTacToe
+
+@dataclass
+class CrashingAgent(RandomAgent):
+    agent_type_id : str = "crashing"
+
+    def take_action(self, rules, observation, available_actions, show_state):
+        raise RuntimeError("agent crashed")
+
+def test_profiler_stops_when_match_raises(tmp_path):
+    threads = threading.active_count()
+    with pytest.raises(RuntimeError):
+        play_match(CrashingAgent, RandomAgent, TicTacToe, seed=1, profile_dir=str(tmp_path))
+    assert not tracemalloc.is_tracing()
+    assert threading.active_count() == threads
+
+def test_paired_legs_keep_their_profiles(tmp_path):
+    paths = [
+        play_match(RandomAgent, RandomAgent, TicTacToe, seed=5, profile_dir=str(tmp_path), agent_1_seat=seat, pair_id="pair").metadata["profile_path"]
+        for seat in (0, 1)
+    ]
+    assert len(set(paths)) == 2
+    assert all(os.path.exists(path) for path in paths)
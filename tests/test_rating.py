@@ -0,0 +1,85 @@
+import choix
+import functools
+import numpy as np
+from rating import MatchCounts, OnlineRatings, bootstrap_params, fit_points, ilsr_points, lsr_pairwise, pairwise_points
+
+def test_online_all_weighs_games_like_laplace():
+    rng = np.random.default_rng(0)
+    agents = ["a", "b", "c"]
+    matches = []
+    # Unequal game sizes and opposite strengths, so pooling and weighting disagree.
+    for game, n, strength in (("hive", 200, [2.0, 1.0, 0.0]), ("pit", 20, [0.0, 1.0, 2.0])):
+        for _ in range(n):
+            i, j = rng.choice(3, size=2, replace=False)
+            win = rng.random() < 1 / (1 + np.exp(strength[j] - strength[i]))
+            matches.append({"game": game, agents[i]: float(win), agents[j]: float(not win)})
+
+    online = OnlineRatings(agents)
+    for match in matches:
+        (agent_1, score_1), (agent_2, score_2) = list(match.items())[1:]
+        online.add(match["game"], agent_1, score_1, agent_2, score_2)
+
+    counts = MatchCounts(matches, agents)
+    offline = fit_points(counts.pairwise_points(counts.size() * counts.probabilities()))
+    assert np.allclose(online.fit("all"), offline, atol=1e-4)
+    for game in ("hive", "pit"):
+        assert np.allclose(online.fit(game), fit_points(counts.pairwise_points(counts.size(game) * counts.probabilities(game))), atol=1e-4)
+
+def _reference_lsr(n_items, data, alpha=0.0, initial_params=None):
+    # The per-match loop lsr_pairwise had before pairwise_points.
+    weights, chain = choix.lsr._init_lsr(n_items, alpha, initial_params)
+    for p1, p2, p1score, p2score in data:
+        chain[p1, p2] += float(p2score) / (weights[p1] + weights[p2])
+        chain[p2, p1] += float(p1score) / (weights[p1] + weights[p2])
+    chain -= np.diag(chain.sum(axis=1))
+    return choix.utils.log_transform(choix.utils.statdist(chain))
+
+def test_ilsr_points_matches_per_match_loop():
+    rng = np.random.default_rng(1)
+    n_items = 6
+    # Agent 5 plays no matches, and only some pairs of the others meet.
+    pairs = [(0, 1), (0, 2), (1, 3), (2, 4), (3, 4)]
+    data = []
+    for _ in range(60):
+        i, j = pairs[rng.integers(len(pairs))]
+        score = rng.choice([0.0, 0.5, 1.0])
+        data.append((i, j, score, 1.0 - score))
+
+    points = pairwise_points(n_items, data)
+    initial = rng.normal(size=n_items)
+    assert np.allclose(lsr_pairwise(n_items, data, alpha=0.001, initial_params=initial), _reference_lsr(n_items, data, 0.001, initial))
+    reference = choix.lsr._ilsr(functools.partial(_reference_lsr, n_items, data, 0.001), None, 100, 1e-8)
+    assert np.all(np.isfinite(reference))
+    assert np.allclose(ilsr_points(points, alpha=0.001), reference, atol=1e-6)
+
+def _paired_matches(rng, n_pairs, same_winner):
+    # Two legs per pair. With same_winner the legs are perfectly correlated, otherwise each is won by a
+    # different agent.
+    matches, clusters = [], []
+    for pair in range(n_pairs):
+        first = rng.random() < 0.6
+        for leg in range(2):
+            win = first if same_winner or leg == 0 else not first
+            matches.append({"game": "hive", "a": float(win), "b": float(not win)})
+            clusters.append(f"pair-{pair}")
+    return matches, clusters
+
+def test_cluster_resampling_keeps_pairs_together():
+    rng = np.random.default_rng(2)
+    matches, clusters = _paired_matches(rng, 30, same_winner=False)
+    counts = MatchCounts(matches, ["a", "b"], clusters)
+    points = counts.pairwise_points(counts.resample(rng, 200))
+    # Every pair is one win each, so any resample of whole pairs has as many wins for a as for b.
+    assert np.array_equal(points[:, 0, 1], points[:, 1, 0])
+    assert points[:, 0, 1].sum() == 200 * 30
+
+    independent = MatchCounts(matches, ["a", "b"])
+    points = independent.pairwise_points(independent.resample(rng, 200))
+    assert not np.array_equal(points[:, 0, 1], points[:, 1, 0])
+
+def test_cluster_bootstrap_is_no_narrower_on_correlated_pairs():
+    matches, clusters = _paired_matches(np.random.default_rng(3), 100, same_winner=True)
+    spread = lambda params: np.std(params[:, 0] - params[:, 1])
+    independent = bootstrap_params(matches, 400, seed=0, workers=1, players=["a", "b"])
+    clustered = bootstrap_params(matches, 400, seed=0, workers=1, players=["a", "b"], clusters=clusters)
+    assert spread(clustered) > 1.2 * spread(independent)
@@ -0,0 +1,37 @@
+from dataclasses import dataclass
+from api.classes import Action
+from api.match_store import MatchStore
+from api.play_game import play_match, record_match
+from api.replay import replay_match
+from agents.random_agent import RandomAgent
+from games.tic_tac_toe import TicTacToe
+
+@dataclass
+class FallbackAgent(RandomAgent):
+    """Gives up on every decision, like an LLM agent out of retries."""
+    agent_type_id : str = "fallback"
+
+    def take_action(self, rules, observation, available_actions, show_state):
+        return Action(action_id=None)
+
+def test_replay_fallback_action(tmp_path):
+    store = MatchStore(str(tmp_path / "matches.db"), legacy_json=None)
+    result = play_match(FallbackAgent, RandomAgent, TicTacToe, seed=3)
+    assert any(action[1:] == [None, None] for action in result.actions)
+    match_id = record_match(store, TicTacToe.id, FallbackAgent.agent_type_id, RandomAgent.agent_type_id, result)
+
+    replayed = replay_match(store, match_id)
+    assert (replayed.agent_1_score, replayed.agent_2_score) == (result.agent_1_score, result.agent_2_score)
+
+def test_concurrent_matches_are_not_replayable(tmp_path):
+    from api.async_play import iter_matches
+    from games.sea_battle import SeaBattle
+    store = MatchStore(str(tmp_path / "matches.db"), legacy_json=None)
+    sequential = record_match(store, SeaBattle.id, RandomAgent.agent_type_id, RandomAgent.agent_type_id, play_match(RandomAgent, RandomAgent, SeaBattle, seed=5))
+    for result in iter_matches(RandomAgent, RandomAgent, SeaBattle, num_matches=8, max_concurrent=8):
+        assert result.seed is None and result.actions
+        record_match(store, SeaBattle.id, RandomAgent.agent_type_id, RandomAgent.agent_type_id, result)
+
+    assert store.replayable_ids(SeaBattle.id) == [sequential]
+    for match_id in store.replayable_ids():
+        replay_match(store, match_id)
@@ -0,0 +1,17 @@
+import pytest
+from api.stopping import StoppingRule, make_stopping_rule
+
+def test_paired_report_counts_pairs():
+    rule = make_stopping_rule("wilson", paired=True, precision=0.5, min_matches=1)
+    for score in [1.0, 0.5, 0.0]:
+        rule.update(score)
+    assert rule.report().endswith("after 3 pairs (6 matches)")
+    assert make_stopping_rule("wilson").report().endswith("after 0 matches")
+
+def test_rule_without_report_fails_at_construction():
+    class Incomplete(StoppingRule):
+        def should_stop(self):
+            return False
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,10 @@
+from agents.stub_llm import StubLLM
+
+def test_prefixes_are_bounded():
+    stub = StubLLM(max_prefixes=50)
+    system = {"role": "system", "content": "x" * 5000}
+    for i in range(200):
+        stub.cached_tokens([system, {"role": "user", "content": str(i)}])
+    assert len(stub.prefixes) == 50
+    # The shared prefix is used on every request, so it is never the one evicted.
+    assert stub.cached_tokens([system, {"role": "user", "content": "new"}]) == 1250
@@ -0,0 +1,22 @@
+import json
+from api.match_store import MatchStore
+from api.tournament import run_tournament
+
+def test_resume_counts_stored_matches(tmp_path, monkeypatch):
+    # Away from matches.json, which a new store would import.
+    monkeypatch.chdir(tmp_path)
+    manifest_path, state_path, store_path = (str(tmp_path / name) for name in ("manifest.json", "manifest.state.json", "matches.db"))
+    manifest = {"agents": {"a": "agents.random_agent.RandomAgent", "b": "agents.random_agent.RandomAgent"}, "games": {"ttt": "games.tic_tac_toe.TicTacToe"}, "num_matches": 3}
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    run_tournament(manifest_path, store_path=store_path)
+
+    # A crash after the last match was stored but before the state file was updated.
+    with open(state_path) as f:
+        state = json.load(f)
+    state["jobs"]["ttt/a_b"]["completed"] = 2
+    with open(state_path, "w") as f:
+        json.dump(state, f)
+    run_tournament(manifest_path, store_path=store_path)
+
+    assert len(MatchStore(store_path, legacy_json=None).records("tic_tac_toe")) == 3